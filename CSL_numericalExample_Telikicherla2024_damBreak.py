@@ -1,17 +1,26 @@
 import os
+import json
 import time
 import numpy as np
 import pandas as pd
-from pyevtk.hl import pointsToVTK
+from pyevtk.hl import pointsToVTK, imageToVTK
 import taichi as ti
+from taichi.lang.util import to_numpy_type
 import colorama
 import sys
+from stepping import SubstepLauncher
+from output import FrameWriter
+from checkpoint import save_checkpoint, load_checkpoint
+from timeseries import TimeSeriesWriter
+from profiler import PhaseProfiler
+from fields import placeParticleFields
 
 time0 = time.time()
 ti.init(arch=ti.gpu, default_ip = ti.i32, default_fp = ti.f64, device_memory_GB=3.0)
 
 #-----------switches-----------#
-isFBar = False # F-Bar pressure stabilization
+volumeUpdate = "det" # "det", "incremental" or "svd": how J = detF is updated (see README)
+isFBar = False # F-Bar pressure stabilization (see stabilizeVolume)
 # isDivvBar = False # True: use $\boldsymbol{\nabla} \cdot \boldsymbol{v}_0$; false: use $\boldsymbol{\nabla} \cdot \boldsymbol{v}_p$
 isInterTimeStepDivv, deltaSL = False, 1
 isPenaltyBC_elseBruteforceBC, betaNor = False, 1e6 # penalty
@@ -21,6 +30,21 @@ isAPIC_elsePIC = 1
 isCSL_elseMPM, gammaNewmark, betaNewmark = True, 0.5, 0.25 # isCSLFLIPscheme2== False
 eta_v, eta_u, eta_p = 0, 0, 0 # eta_v: how much FLIP in v, similar expression for u and p.
 ifAV, c_artificial, c_L, c_Q = 0, 50, 0.12, 2.0 # artificial viscosity (Telikicherla et al. 2024)
+isImplicitPressure, cgTolerance, cgMaxIterations = False, 1e-6, 200 # semi-implicit pressure by CG, relative residual, iteration cap
+isCacheRK = True # reuse the RK shape functions of P2G in G2P
+consistencyChecks = "output" # "off", "output" or "always" (see README)
+isGatherP2G, sortInterval = False, 10 # gather P2G from particles binned by cell
+isDiagonalMass = True # diagonal grid mass (see README)
+neighbourRadius, freeSurfaceThreshold = 1.0, 0.75 # [dx], kernel sum of a free-surface particle
+isSparseGrid, gridBlockSize = False, 8 # grid in pointer blocks activated by particles
+particleFloat = getattr(ti, os.environ.get("DAMBREAK_PARTICLE_FP", "f64")) # particle storage precision
+gridFloat = getattr(ti, os.environ.get("DAMBREAK_GRID_FP", "f64")) # grid storage precision
+rkFloat = getattr(ti, os.environ.get("DAMBREAK_RK_FP", "f64")) # RK moment matrix precision
+particleLayout = os.environ.get("DAMBREAK_PARTICLE_LAYOUT", "soa") # "soa", "aos" or "hybrid"
+ensembleSize = int(os.environ.get("DAMBREAK_ENSEMBLE_SIZE", 1)) # dam-breaks advanced side by side
+numRanks, rank = int(os.environ.get("DAMBREAK_NUM_RANKS", 1)), int(os.environ.get("DAMBREAK_RANK", 0)) # slab decomposition (see decomposition.py)
+rankCapacity = 2.0 # decomposed: particle slots per process, relative to an even share num_p_all / numRanks
+ensembleParameters = {} # name -> values per ensemble member (see README)
 # n_const = 7
 
 omega = 1
@@ -32,9 +56,24 @@ a_g = -9.81 # [m s^{-2}], a_g (should be negative)
 # E, G = K * 2 * (1 - nu), K * (1 - nu)/(1 + nu) # [Pa] Young's modulus, [Pa] Shear modulus
 # mu, lambd = E / (2 * (1 + nu)), E * nu / ((1 + nu) * (1 - 2 * nu))
 #-----------numericalParameter-----------#
-dim, sizeScale = 2, 1 # 6*1.05714285714 # 1
+dim, sizeScale = int(os.environ.get("DAMBREAK_DIM", 2)), 1 # 6*1.05714285714 # 1; dim = 3: extruded to a depth of D_fluid
 epsilon = 1e-15 # Numerical tolerance
 simTime, timeTotal, dt = 3, 0e-15, 1e-6 # total simulation time, simulation time initialize, timestep
+substepsPerLaunch = 100 # substeps per ti.graph launch
+frameRate, framesPerOutput = 1e-2, 1 # [s] time between frames, write VTK/PNG every framesPerOutput-th frame
+numOutputBuffers = 2 # host buffers of the background writer
+frameFormat, seriesCompression, seriesDowncast = "vtk", "zlib", False # "vtk" or "series" (see README)
+particleOutput = ["ID", "simgaxx", "simgayy", "simgaxy", "v_x", "v_y", "v_z", "Pressure", "Partition of Unity", "Consistency",
+                  "Gradx Consistency", "Grady Consistency", "Deformation", "Velocity Mag", "Acceleration Y"] # VTK point data, see particleOutputs
+gridOutput = [] # VTK image data, see gridOutputs
+isAdaptiveTimeStep, CFL, dtMin, dtMax = False, 0.1, 1e-7, 1e-4 # CFL time step (see getCFLTimeStep)
+checkpointInterval, checkpointsKept = 0, 3 # frames between checkpoints (0: off)
+isResume = False # True: continue from the newest checkpoint in checkpointPath
+isProfiled = False # time the substep phases (see profiler.py)
+diagnosticsInterval = 0 # substeps between diagnostics (0: at frames)
+settingsOverride = json.loads(os.environ.get("DAMBREAK_SETTINGS", "{}")) # overrides from the environment
+assert set(settingsOverride) <= set(globals()), f"unknown settings {sorted(set(settingsOverride) - set(globals()))}"
+globals().update(settingsOverride)
 
 def format_with_exp(value):
     return f"{value:.2e}"
@@ -66,18 +105,29 @@ if isPenaltyBC_elseBruteforceBC:
 if isInterTimeStepDivv:
     filepath, vtkpath = append_params(filepath, vtkpath, deltaSL=deltaSL)
 
-filepath, vtkpath = append_params(filepath, vtkpath, dt=dt)
+if isAdaptiveTimeStep:
+    filepath, vtkpath = append_params(filepath, vtkpath, CFL=CFL)
+else:
+    filepath, vtkpath = append_params(filepath, vtkpath, dt=dt)
 
-np_x = 65
-np_y = 65*2
-num_p = np_x * np_y
+checkpointPath = f"checkpoint_{vtkpath}"
+
+np_x = int(os.environ.get("DAMBREAK_NP_X", 65))
+np_y = np_x*2
+np_z = np_x if dim == 3 else 1
+num_p = np_x * np_y * np_z # per ensemble case
+num_p_all = ensembleSize * num_p
+particleCapacity = num_p_all if numRanks == 1 else int(np.ceil(rankCapacity * num_p_all / numRanks)) # particle slots of this process; the empty ones have material -1
+firstParticle = rank * num_p_all // numRanks # decomposed: this process initializes particles [firstParticle, firstParticle + numInitialParticles)
+numInitialParticles = (rank + 1) * num_p_all // numRanks - firstParticle
 
 len_domain = float(0.4375/sizeScale) # [m]
 W_fluid = float(0.057/sizeScale) # [m] # Width of Liquid square (true dimension)
 H_fluid = float(0.114/sizeScale) # [m] # Height of Liquid square (true dimension)
-volume0_p = W_fluid*H_fluid/num_p
+D_fluid = W_fluid # [m] # Depth of Liquid square (3D)
+volume0_p = W_fluid*H_fluid*D_fluid/num_p if dim == 3 else W_fluid*H_fluid/num_p
 
-num_cell = int(100 + 4) # num_g+2+2 by num_g+2+2 including the boundaries
+num_cell = int(int(os.environ.get("DAMBREAK_NUM_CELL", 100)) + 4) # num_g+2+2 by num_g+2+2 including the boundaries; DAMBREAK_NUM_CELL cells across the tank
 num_g = int(num_cell + 1) 
 dx = len_domain  / float(num_cell - 4) # len_domain / float(num_g - 1)
 inv_dx = 1 / dx
@@ -86,55 +136,112 @@ aNorm = 1.5 # RK normalized Kernel function support size
 a = aNorm * dx # RK Kernel function support size
 nodeNum = int(a*inv_dx*2 + epsilon) # (max) Number of 1D grid nodes in the support of each particle
 shift = float(a*inv_dx - 1.0) # set as 0.5, used to find "base"
+numStencil = nodeNum**dim # grid nodes in the support of each particle
+stencil = list(np.ndindex(*[nodeNum] * dim)) # their offsets from "base", flat index s in the order of ti.ndrange
 
-fb = ti.Vector.field(2, dtype=ti.f64, shape=()) # gravity
-fb[None] = [0, W_fluid*H_fluid*rho*a_g] # [m kg s^{-2}], Set initial gravity direction to -y
+fb = ti.Vector.field(dim, dtype=ti.f64, shape=()) # gravity
+fb[None] = [0, W_fluid*H_fluid*rho*a_g] + [0] * (dim - 2) # [m kg s^{-2}], Set initial gravity direction to -y (the same body force in 3D)
 
 beta = betaNor * rho * dx**2 # volume0_p # 1e30 # Penalty parameter on EBC
 
-xtdt_p = ti.Vector.field(2, dtype=ti.f64, shape=num_p) # Particle position
-vtdt_p = ti.Vector.field(2, dtype=ti.f64, shape=num_p) # Particle velocity
-Lt_p = ti.Matrix.field(2, 2, dtype=ti.f64, shape=num_p) # Velocity gradient (APIC)
-Ft_p = ti.Matrix.field(2, 2, dtype=ti.f64, shape=num_p) # Deformation gradient
-sigma = ti.Matrix.field(2, 2, dtype=ti.f64, shape=num_p) # Particle stress
-atdt_p = ti.Vector.field(2, dtype=ti.f64, shape=num_p)
+assert consistencyChecks in ("off", "output", "always"), f"unknown consistencyChecks {consistencyChecks!r}"
+assert volumeUpdate in ("det", "incremental", "svd"), f"unknown volumeUpdate {volumeUpdate!r}"
+assert not (isFBar and volumeUpdate == "incremental"), "F-bar replaces detF by the cell mean, which the incremental volume update would then accumulate"
+
+# Ensemble: case b owns particles [b*num_p, (b+1)*num_p) and grid nodes [b*num_g, (b+1)*num_g) in x, shifted by b*num_g*dx
+assert dim == 2 or not (ensembleSize > 1 or isPenaltyBC_elseBruteforceBC or isGatherP2G), "ensembles, the penalty BC and the gather P2G are 2D only"
+assert ensembleSize == 1 or not (isPenaltyBC_elseBruteforceBC or isAdaptiveTimeStep), "ensembles use the bruteforce BC and a fixed dt"
+assert numRanks == 1 or (dim == 2 and ensembleSize == 1 and not (isPenaltyBC_elseBruteforceBC or isGatherP2G or isFBar)), "decomposed runs are 2D single cases with the bruteforce BC, the scatter P2G and no F-bar"
+assert not isImplicitPressure or (isMixedFormulation_elsePointwise and not isPenaltyBC_elseBruteforceBC and ensembleSize == 1 and numRanks == 1), "the implicit pressure is solved for the nodal pressure of the mixed formulation of a single case, with the bruteforce BC"
+visc_b = ti.field(dtype=ti.f64, shape=ensembleSize) # per-case parameters, see setEnsembleParameters
+kappa_b = ti.field(dtype=ti.f64, shape=ensembleSize)
+rho_b = ti.field(dtype=ti.f64, shape=ensembleSize)
+eta_v_b = ti.field(dtype=ti.f64, shape=ensembleSize)
+eta_u_b = ti.field(dtype=ti.f64, shape=ensembleSize)
+eta_p_b = ti.field(dtype=ti.f64, shape=ensembleSize)
+c_artificial_b = ti.field(dtype=ti.f64, shape=ensembleSize)
+W_fluid_b = ti.field(dtype=ti.f64, shape=ensembleSize)
+H_fluid_b = ti.field(dtype=ti.f64, shape=ensembleSize)
+volume0_b = ti.field(dtype=ti.f64, shape=ensembleSize)
+fb_b = ti.Vector.field(dim, dtype=ti.f64, shape=ensembleSize)
+
+def setEnsembleParameters(parameters):
+    # Fill the per-case fields from name -> B values, the globals standing in for missing names; re-run initialize_Cubes() after changing W_fluid/H_fluid
+    values = {name: np.broadcast_to(np.asarray(parameters.get(name, globals()[name]), dtype=np.float64), ensembleSize)
+              for name in ["visc", "kappa", "rho", "eta_v", "eta_u", "eta_p", "c_artificial", "W_fluid", "H_fluid"]}
+    for name, value in values.items():
+        globals()[name + "_b"].from_numpy(np.ascontiguousarray(value))
+    volume0_b.from_numpy(values["W_fluid"] * values["H_fluid"] / num_p)
+    fb_b.from_numpy(np.stack([np.zeros(ensembleSize), values["W_fluid"] * values["H_fluid"] * values["rho"] * a_g] + [np.zeros(ensembleSize)] * (dim - 2), axis=1))
+
+@ti.func
+def caseValue(value, caseField: ti.template(), p):
+    # Parameter of particle p: the global value, or the entry of p's case in an ensemble
+    return caseField[p // num_p] if ti.static(ensembleSize > 1) else value
+
+xtdt_p = ti.Vector.field(dim, dtype=ti.f64) # Particle position
+vtdt_p = ti.Vector.field(dim, dtype=particleFloat) # Particle velocity
+Lt_p = ti.Matrix.field(dim, dim, dtype=particleFloat) # Velocity gradient (APIC)
+Ft_p = ti.Matrix.field(dim, dim, dtype=ti.f64) # Deformation gradient
+sigma = ti.Matrix.field(dim, dim, dtype=particleFloat) # Particle stress
+atdt_p = ti.Vector.field(dim, dtype=particleFloat)
 # if isCSLFLIPscheme2:
-at_p = ti.Vector.field(2, dtype=float, shape=num_p)
-utdt_p = ti.Vector.field(2, dtype=ti.f64, shape=num_p)
-Delta_utdt_p = ti.Vector.field(2, dtype=ti.f64, shape=num_p)
-material = ti.field(dtype=int, shape=num_p) # Material id
-volumet_p = ti.field(dtype=ti.f64, shape=num_p) # Particle volume
-mt_p = ti.field(dtype=ti.f64, shape=num_p)
-
-mt_I = ti.Matrix.field(2, 2, dtype=ti.f64, shape=(num_g, num_g)) 
-volumet_I = ti.field(dtype=ti.f64, shape=(num_g, num_g))
-ptdt_I = ti.field(dtype=ti.f64, shape=(num_g, num_g))
-pt_I = ti.field(dtype=ti.f64, shape=(num_g, num_g))
-ft_I = ti.Vector.field(2, dtype=float, shape=(num_g, num_g))
-vtdt_I = ti.Vector.field(2, dtype=float, shape=(num_g, num_g))
-vt_I = ti.Vector.field(2, dtype=float, shape=(num_g, num_g))
-atdt_I = ti.Vector.field(2, dtype=float, shape=(num_g, num_g))
-at_I = ti.Vector.field(2, dtype=float, shape=(num_g, num_g))
-Delta_utdt_I = ti.Vector.field(2, dtype=float, shape=(num_g, num_g))
-Delta_ut_I = ti.Vector.field(2, dtype=float, shape=(num_g, num_g))
-utdt_I = ti.Vector.field(2, dtype=float, shape=(num_g, num_g))
-ut_I = ti.Vector.field(2, dtype=float, shape=(num_g, num_g))
-
-volume0_0 = ti.field(dtype=ti.f64, shape=(num_g - 1, num_g - 1)) # Pressure stabilization (F-bar)
-volumet_0 = ti.field(dtype=ti.f64, shape=(num_g - 1, num_g - 1)) # Pressure stabilization (F-bar)
-cell = ti.field(dtype=ti.f64, shape=(num_g - 1, num_g - 1)) # Pressure stabilization (F-bar)
-
-detF = ti.field(dtype=ti.f64, shape=num_p) # determinant of F (deformation gradient)
-
-PartitionOfUnity = ti.field(dtype=ti.f64, shape=num_p) # Check for each particle (POU)
-Cons = ti.field(dtype=ti.f64, shape=num_p) # Check for each particle (consistency)
-Cons_dx = ti.field(dtype=ti.f64, shape=num_p) # Check for each particle (gradient consistency)
-Cons_dy = ti.field(dtype=ti.f64, shape=num_p) # Check for each particle (gradient consistency)
-
-ptdt_p = ti.field(dtype=ti.f64, shape=num_p)
-pt_p = ti.field(dtype=ti.f64, shape=num_p)
-divvt_p = ti.field(dtype=ti.f64, shape=num_p) # \boldsymbol{nabla} \cdot \boldsymbol{v}_p^{t}
-rho_p = ti.field(dtype=ti.f64, shape=num_p)
+at_p = ti.Vector.field(dim, dtype=particleFloat)
+utdt_p = ti.Vector.field(dim, dtype=ti.f64)
+Delta_utdt_p = ti.Vector.field(dim, dtype=particleFloat)
+material = ti.field(dtype=int) # Material id
+volumet_p = ti.field(dtype=particleFloat) # Particle volume
+mt_p = ti.field(dtype=particleFloat)
+
+gridShape = None if isSparseGrid else (ensembleSize * num_g,) + (num_g,) * (dim - 1) # sparse: placed into gridBlock below
+mt_I = ti.Vector.field(dim, dtype=gridFloat, shape=gridShape) if isDiagonalMass else ti.Matrix.field(dim, dim, dtype=gridFloat, shape=gridShape) # see massEntry
+volumet_I = ti.field(dtype=gridFloat, shape=gridShape)
+ptdt_I = ti.field(dtype=gridFloat, shape=gridShape)
+pt_I = ti.field(dtype=gridFloat, shape=gridShape)
+ft_I = ti.Vector.field(dim, dtype=gridFloat, shape=gridShape)
+vtdt_I = ti.Vector.field(dim, dtype=gridFloat, shape=gridShape)
+vt_I = ti.Vector.field(dim, dtype=gridFloat, shape=gridShape)
+atdt_I = ti.Vector.field(dim, dtype=gridFloat, shape=gridShape)
+at_I = ti.Vector.field(dim, dtype=gridFloat, shape=gridShape)
+Delta_utdt_I = ti.Vector.field(dim, dtype=gridFloat, shape=gridShape)
+Delta_ut_I = ti.Vector.field(dim, dtype=gridFloat, shape=gridShape)
+utdt_I = ti.Vector.field(dim, dtype=gridFloat, shape=gridShape)
+ut_I = ti.Vector.field(dim, dtype=gridFloat, shape=gridShape)
+if isImplicitPressure: # Semi-implicit pressure: CG on the nodal pressure, in f64 whatever gridFloat
+    cgPressure = ti.field(dtype=ti.f64, shape=gridShape) # solution, starting from the pressure of the previous substep
+    cgResidual = ti.field(dtype=ti.f64, shape=gridShape)
+    cgDirection = ti.field(dtype=ti.f64, shape=gridShape)
+    cgProduct = ti.field(dtype=ti.f64, shape=gridShape) # operator times cgDirection
+    cgDiagonal = ti.field(dtype=ti.f64, shape=gridShape) # Jacobi preconditioner, 0 on the nodes without pressure unknown
+    cgForce = ti.Vector.field(dim, dtype=ti.f64, shape=gridShape) # nodal pressure forces inside the operator
+    cgAlpha, cgRZ, cgRR, cgBB = [ti.field(dtype=ti.f64, shape=()) for _ in range(4)] # step length, r.z, r.r, b.b
+implicitPressureFields = [cgPressure, cgResidual, cgDirection, cgProduct, cgDiagonal, cgForce] if isImplicitPressure else []
+if isSparseGrid:
+    gridBlock = ti.root.pointer(ti.axes(*range(dim)), ((ensembleSize * num_g + gridBlockSize - 1) // gridBlockSize,) + ((num_g + gridBlockSize - 1) // gridBlockSize,) * (dim - 1))
+    for gridField in [mt_I, volumet_I, ptdt_I, pt_I, ft_I, vtdt_I, vt_I, atdt_I, at_I, Delta_utdt_I, Delta_ut_I, utdt_I, ut_I] + implicitPressureFields:
+        gridBlock.dense(ti.axes(*range(dim)), gridBlockSize).place(gridField)
+
+rankColumns = ti.field(int, shape=2) # decomposed: grid columns [lo, hi) reached by the particles of this rank, set by decomposition.py
+
+cellShape = (ensembleSize * num_g - 1,) + (num_g - 1,) * (dim - 1) # grid cells, cell of a particle = floor(x / dx)
+volume0_0 = ti.field(dtype=ti.f64, shape=cellShape) # Pressure stabilization (F-bar): initial volume of the particles in the cell
+volumet_0 = ti.field(dtype=ti.f64, shape=cellShape) # Pressure stabilization (F-bar): their current volume
+cell = ti.field(dtype=ti.f64, shape=cellShape) # Pressure stabilization (F-bar): their volume-weighted div(v)
+
+detF = ti.field(dtype=particleFloat) # determinant of F (deformation gradient)
+
+PartitionOfUnity = ti.field(dtype=ti.f64, shape=particleCapacity) # Check for each particle (POU)
+Cons = ti.field(dtype=ti.f64, shape=particleCapacity) # Check for each particle (consistency)
+Cons_dx = ti.field(dtype=ti.f64, shape=particleCapacity) # Check for each particle (gradient consistency)
+Cons_dy = ti.field(dtype=ti.f64, shape=particleCapacity) # Check for each particle (gradient consistency)
+Cons_dz = ti.field(dtype=ti.f64, shape=particleCapacity) if dim == 3 else None # Check for each particle (gradient consistency, 3D)
+
+ptdt_p = ti.field(dtype=particleFloat)
+pt_p = ti.field(dtype=particleFloat)
+divvt_p = ti.field(dtype=particleFloat) # \boldsymbol{nabla} \cdot \boldsymbol{v}_p^{t}
+rho_p = ti.field(dtype=particleFloat)
+placeParticleFields([xtdt_p, vtdt_p, Lt_p, Ft_p, sigma, atdt_p, at_p, utdt_p, Delta_utdt_p, material, volumet_p, mt_p, detF, ptdt_p, pt_p, divvt_p, rho_p], particleCapacity, particleLayout,
+                    hotFields=[xtdt_p, vtdt_p, Lt_p, sigma, volumet_p, mt_p]) # read together in P2G and G2P
 
 # -----------$div(\boldsymbol{v}_p^t)$-projection method
 # divvt_0_numerator = ti.field(dtype=ti.f64, shape=(num_g, num_g))
@@ -151,15 +258,66 @@ x_L_left = ti.Vector.field(2, dtype=ti.f64, shape=num_cell-4)
 x_L_right = ti.Vector.field(2, dtype=ti.f64, shape=num_cell-4)
 x_L_bot = ti.Vector.field(2, dtype=ti.f64, shape=num_cell-4)
 x_L_top = ti.Vector.field(2, dtype=ti.f64, shape=num_cell-4)
+if isPenaltyBC_elseBruteforceBC:
+    mt_I_BC = ti.Vector.field(dim, dtype=gridFloat, shape=gridShape) if isDiagonalMass else ti.Matrix.field(dim, dim, dtype=gridFloat, shape=gridShape) # Constant penalty term added to mt_I (assemblePenaltyBC)
+    if isSparseGrid: # only the blocks along the walls get activated
+        ti.root.pointer(ti.axes(*range(dim)), (num_g + gridBlockSize - 1) // gridBlockSize).dense(ti.axes(*range(dim)), gridBlockSize).place(mt_I_BC)
+penaltyFields = [mt_I_BC] if isPenaltyBC_elseBruteforceBC else []
+
+# --------------------RK shape function cache (P2G -> G2P)
+base_p = ti.Vector.field(dim, dtype=int, shape=particleCapacity) # "base" of each particle at P2G
+Psi_p = ti.Vector.field(numStencil, dtype=particleFloat, shape=particleCapacity) # phi at P2G
+dPsi_p = ti.Matrix.field(numStencil, dim, dtype=particleFloat, shape=particleCapacity) # grad phi at P2G
+
+# --------------------Particle bins of the gather P2G and the neighbourhoods (counting sort by "base", i.e. a cell-linked list)
+assert not (isGatherP2G and isSparseGrid), "the gather P2G visits every grid node"
+numBins = ensembleSize * num_g * num_g # one bin per grid node, bin of a particle = its "base"
+binMargin = 0 if sortInterval == 1 else 1 # [cells] a particle may move this far from its bin before a re-sort
+isNeighbourhoodOutput = bool({"Free Surface", "Smoothed Density"} & set(particleOutput)) # updateNeighbourhoods() on the output frames
+if isGatherP2G or isNeighbourhoodOutput:
+    binCount = ti.field(dtype=int, shape=numBins)
+    binStart = ti.field(dtype=int, shape=numBins + 1) # exclusive prefix sum of binCount
+    binnedParticles = ti.field(dtype=int, shape=particleCapacity) # particle ids ordered by bin
+    binBase_p = ti.Vector.field(2, dtype=int, shape=particleCapacity) # "base" of each particle at the last sort
+    substepsSinceSort = ti.field(dtype=int, shape=())
+    isSortDue = ti.field(dtype=int, shape=())
+if isNeighbourhoodOutput:
+    freeSurface_p = ti.field(dtype=int, shape=particleCapacity) # 1: particle on the free surface (updateNeighbourhoods)
+    rhoSmoothed_p = ti.field(dtype=ti.f64, shape=particleCapacity) # Shepard-smoothed particle density (updateNeighbourhoods)
+binFields = ([binCount, binStart, binnedParticles, binBase_p] if isGatherP2G or isNeighbourhoodOutput else []) + ([freeSurface_p, rhoSmoothed_p] if isNeighbourhoodOutput else [])
+
+def memoryBudget():
+    # Bytes of the fields above by group, from their shapes and dtypes (the sparse grid counts as dense, i.e. an upper bound)
+    def nbytes(fields):
+        return sum(int(np.prod(f.shape)) * getattr(f, "n", 1) * getattr(f, "m", 1) * np.dtype(to_numpy_type(f.dtype)).itemsize for f in fields)
+    groups = {
+        "particle state": [xtdt_p, vtdt_p, Lt_p, Ft_p, sigma, atdt_p, at_p, utdt_p, Delta_utdt_p, material, volumet_p, mt_p, detF, ptdt_p, pt_p, divvt_p, rho_p],
+        "RK cache": [base_p, Psi_p, dPsi_p],
+        "consistency checks": [PartitionOfUnity, Cons, Cons_dx, Cons_dy] + ([Cons_dz] if dim == 3 else []),
+        "bins, neighbourhoods": binFields,
+        "grid": [mt_I, volumet_I, ptdt_I, pt_I, ft_I, vtdt_I, vt_I, atdt_I, at_I, Delta_utdt_I, Delta_ut_I, utdt_I, ut_I] + ([volume0_0, volumet_0, cell] if isFBar else [])
+                + implicitPressureFields + penaltyFields,
+    }
+    budget = {name: nbytes(fields) for name, fields in groups.items()}
+    numNodes = int(np.prod(mt_I.shape)) # gridShape is None on the sparse grid, whose fields still report the shape they cover
+    perParticle = sum(v for name, v in budget.items() if name != "grid") / particleCapacity
+    return {"bytes": budget, "bytesPerParticle": perParticle, "bytesPerNode": budget["grid"] / numNodes,
+            "particles": particleCapacity, "nodes": numNodes}
+
+@ti.func
+def isActive(p): # False for the empty particle slots of a decomposed run
+    if ti.static(numRanks > 1):
+        return material[p] >= 0
+    else:
+        return True
 
 @ti.func 
 def getRK(xp, base, a): 
-    phiMat = ti.Matrix.zero(ti.f64,3,3)                  # Initialize the matrix of phi values for each surrounding grid node at the current particle location
-    dphiXMat = ti.Matrix.zero(ti.f64,3,3)                # Initialize the matrix of dphi/dx values for each surrounding grid node at the current particle location
-    dphiYMat = ti.Matrix.zero(ti.f64,3,3)                # Initialize the matrix of dphi/dy values for each surrounding grid node at the current particle location
-    M = ti.Matrix.zero(ti.f64,3,3)                       # Initialize the moment matrix 
+    phiVec = ti.Vector.zero(ti.f64, numStencil)           # Initialize the vector of phi values for each surrounding grid node at the current particle location
+    dphiMat = ti.Matrix.zero(ti.f64, numStencil, dim)     # Initialize the matrix of dphi/dx_d values (one row per grid node) at the current particle location
+    M = ti.Matrix.zero(rkFloat, dim + 1, dim + 1)         # Initialize the moment matrix of the linear basis [1, x, y(, z)]
     w = ti.Matrix.zero(ti.f64, nodeNum, dim)             # Initialize the kernel function vector for weights at each grid node for each coordinate direction (1D)
-    weight = ti.Matrix.zero(ti.f64, nodeNum, nodeNum)    # Kernel weights in 2D 
+    weight = ti.Vector.zero(ti.f64, numStencil)          # Kernel weights in 2D/3D
     for i, d in ti.static(ti.ndrange(nodeNum, dim)):
         gridNode = float( i + base[d] ) * dx            # Current grid node location
         if gridNode >= 0:
@@ -174,259 +332,496 @@ def getRK(xp, base, a):
                     w[i,d] = z - 1
                 elif 1 <= z: 
                     w[i,d] = 0 
-    for i, j in ti.static(ti.ndrange(nodeNum, nodeNum)): 
-        gridNode = [float(i+base[0]) * dx, float(j+base[1]) * dx] # Current grid node location
-        if gridNode[0] >= 0 and gridNode[1] >= 0: 
-            weight[i,j] = w[i,0] * w[j,1] # Define kernel function weights in 2D
-            Pxi = (ti.Vector([1.0, xp[0] - gridNode[0], xp[1] - gridNode[1]])) # Define P(xi - xp)
-            if weight[i,j] != 0:
-                M += weight[i,j] * Pxi @ Pxi.transpose() # Define the moment matrix   
+    for s in ti.static(range(numStencil)): 
+        offset = ti.static(stencil[s])
+        gridNode = (base + ti.Vector(offset)).cast(ti.f64) * dx # Current grid node location
+        if gridNode.min() >= 0: 
+            weight[s] = w[offset[0], 0] * w[offset[1], 1] # Define kernel function weights in 2D
+            if ti.static(dim == 3):
+                weight[s] *= w[offset[2], 2]
+            Pxi = tensorBasis(xp - gridNode) # Define P(xi - xp)
+            if weight[s] != 0:
+                M += (weight[s] * Pxi).outer_product(Pxi) # Define the moment matrix   
 
     # M_inv = M.inverse()
-    M_inv = (M + epsilon * ti.Matrix.identity(ti.f64, 3)).inverse()
-
-    for i, j in ti.static(ti.ndrange(nodeNum, nodeNum)): # Loop over neighboring grid nodes                    
-        gridNode = [float(i+base[0]) * dx, float(j+base[1]) * dx] # Current grid node location
-        if weight[i,j] != 0:
-            if gridNode[0] >= 0 and gridNode[1] >= 0:
-                Pxi = ti.Vector([1.0, xp[0] - gridNode[0], xp[1] - gridNode[1]])  # Define P(xi - xp)
-                Pxp = ti.Vector([1.0, xp[0] - xp[0], xp[1] - xp[1]])
-                dPxpX = ti.Vector([0.0, -1.0, 0.0])
-                dPxpY = ti.Vector([0.0, 0.0, -1.0])
-
-                phi = weight[i,j] * (Pxp.transpose() @ M_inv @ Pxi)                   # Define phi
-                dphi_x1 = weight[i,j] * (dPxpX.transpose() @ M_inv @ Pxi)             # Define dphi/dx
-                dphi_x2 = weight[i,j] * (dPxpY.transpose() @ M_inv @ Pxi)             # Define dphi/dy
-                
-                phiMat[i,j] = phi[0]
-                dphiXMat[i,j] = dphi_x1[0]
-                dphiYMat[i,j] = dphi_x2[0]
-
-    return phiMat, dphiXMat, dphiYMat
+    M_inv = (M + epsilon * ti.Matrix.identity(rkFloat, dim + 1)).inverse()
+
+    for s in ti.static(range(numStencil)): # Loop over neighboring grid nodes                    
+        gridNode = (base + ti.Vector(ti.static(stencil[s]))).cast(ti.f64) * dx # Current grid node location
+        if weight[s] != 0:
+            if gridNode.min() >= 0:
+                Pxi = tensorBasis(xp - gridNode)  # Define P(xi - xp)
+                Pxp = tensorBasis(xp - xp)
+                phiVec[s] = weight[s] * (M_inv.transpose() @ Pxp).dot(Pxi)                # Define phi
+                for d in ti.static(range(dim)):
+                    dPxp = ti.Vector.zero(ti.f64, dim + 1)
+                    dPxp[d + 1] = -1.0
+                    dphiMat[s, d] = weight[s] * (M_inv.transpose() @ dPxp).dot(Pxi)      # Define dphi/dx_d
+
+    return phiVec, dphiMat
+
+@ti.func
+def tensorBasis(r):
+    # Linear basis P = [1, r_x, r_y(, r_z)]
+    P = ti.Vector.zero(ti.f64, dim + 1)
+    P[0] = 1.0
+    for d in ti.static(range(dim)):
+        P[d + 1] = r[d]
+    return P
+
+@ti.func
+def shapeGradient(dPsi_I, s: ti.template()):
+    # Gradient of the shape function of stencil node s (row s of the dphi matrix of getRK)
+    B_I = ti.Vector.zero(ti.f64, dim)
+    for d in ti.static(range(dim)):
+        B_I[d] = dPsi_I[s, d]
+    return B_I
+
+@ti.func
+def massEntry(M):
+    # A dim x dim grid-mass term in the storage of mt_I: its diagonal if isDiagonalMass (the lumped mass and the penalty S are diagonal)
+    if ti.static(isDiagonalMass):
+        return ti.Vector([M[d, d] for d in ti.static(range(dim))])
+    else:
+        return M
+
+@ti.func
+def massDiagonal(m):
+    # Diagonal of a grid mass m stored by massEntry
+    if ti.static(isDiagonalMass):
+        return m
+    else:
+        return ti.Vector([m[d, d] for d in ti.static(range(dim))])
 
 @ti.func 
-def penaltybc(): 
+def penaltybc(): # x_L_*, dx and beta are fixed, so this is assembled once into mt_I_BC
+    ti.static_assert(dim == 2, "the penalty EBC is 2D only")
     for k in x_L_left:
         base = (x_L_left[k] * inv_dx - shift).cast(int)
-        Psi_I, _, _ = getRK(x_L_left[k], base, a)
+        Psi_I, _ = getRK(x_L_left[k], base, a)
         s1 = 1
         s2 = 0
         S = ti.Matrix([[s1, 0], [0, s2]])
-        for i, j in ti.static(ti.ndrange(nodeNum, nodeNum)):
-            offset = ti.Vector([i, j])
+        for s in ti.static(range(numStencil)):
+            offset = ti.Vector(ti.static(stencil[s]))
             if float(base[0] + offset[0]) >= 2: # <= 2:
-                mt_I[base + offset] += dx * beta * Psi_I[i,j] * S
+                mt_I_BC[base + offset] += massEntry(dx * beta * Psi_I[s] * S)
             if float(base[0] + offset[0]) < 2: # >= num_cell - 2:
-                mt_I[base + offset] += dx * beta * S
+                mt_I_BC[base + offset] += massEntry(dx * beta * S)
 
     for k in x_L_right:
         base = (x_L_right[k] * inv_dx - shift).cast(int)
-        Psi_I, _, _ = getRK(x_L_right[k], base, a)
+        Psi_I, _ = getRK(x_L_right[k], base, a)
         s1 = 1
         s2 = 0
         S = ti.Matrix([[s1, 0], [0, s2]])
-        for i, j in ti.static(ti.ndrange(nodeNum, nodeNum)):
-            offset = ti.Vector([i, j])
+        for s in ti.static(range(numStencil)):
+            offset = ti.Vector(ti.static(stencil[s]))
             if float(base[0] + offset[0]) <= num_cell - 2: # >= num_cell - 2:
-                mt_I[base + offset] += dx * beta * Psi_I[i,j] * S
+                mt_I_BC[base + offset] += massEntry(dx * beta * Psi_I[s] * S)
             if float(base[0] + offset[0]) > num_cell - 2: # >= num_cell - 2:
-                mt_I[base + offset] += dx * beta * S
+                mt_I_BC[base + offset] += massEntry(dx * beta * S)
 
     for k in x_L_bot:
         base = (x_L_bot[k] * inv_dx - shift).cast(int)
-        Psi_I, _, _ = getRK(x_L_bot[k], base, a)
+        Psi_I, _ = getRK(x_L_bot[k], base, a)
         s1 = 0
         s2 = 1
         S = ti.Matrix([[s1, 0], [0, s2]])
-        for i, j in ti.static(ti.ndrange(nodeNum, nodeNum)):
-            offset = ti.Vector([i, j])
+        for s in ti.static(range(numStencil)):
+            offset = ti.Vector(ti.static(stencil[s]))
             if float(base[1] + offset[1]) >= 2: # <= 2:
-                mt_I[base + offset] += dx * beta * Psi_I[i,j] * S
+                mt_I_BC[base + offset] += massEntry(dx * beta * Psi_I[s] * S)
             if float(base[1] + offset[1]) < 2: # >= num_cell - 2:
-                mt_I[base + offset] += dx * beta * S
+                mt_I_BC[base + offset] += massEntry(dx * beta * S)
 
     for k in x_L_top:
         base = (x_L_top[k] * inv_dx - shift).cast(int)
-        Psi_I, _, _ = getRK(x_L_top[k], base, a)
+        Psi_I, _ = getRK(x_L_top[k], base, a)
         s1 = 0
         s2 = 1
         S = ti.Matrix([[s1, 0], [0, s2]])
-        for i, j in ti.static(ti.ndrange(nodeNum, nodeNum)):
-            offset = ti.Vector([i, j])
+        for s in ti.static(range(numStencil)):
+            offset = ti.Vector(ti.static(stencil[s]))
             if float(base[1] + offset[1]) <= num_cell - 2: # >= num_cell - 2:
-                mt_I[base + offset] += dx * beta * Psi_I[i,j] * S
+                mt_I_BC[base + offset] += massEntry(dx * beta * Psi_I[s] * S)
             if float(base[1] + offset[1]) > num_cell - 2: # >= num_cell - 2:
-                mt_I[base + offset] += dx * beta * S
+                mt_I_BC[base + offset] += massEntry(dx * beta * S)
 
 @ti.kernel
-def substep():
+def assemblePenaltyBC():
+    for I in ti.grouped(mt_I_BC):
+        mt_I_BC[I] = massEntry(ti.Matrix.zero(gridFloat, dim, dim))
+    penaltybc()
+
+@ti.func
+def stressP2G(p):
+    # Stress of particle p in the P2G forces; without its pressure when that is solved for on the grid (isImplicitPressure)
+    if ti.static(isImplicitPressure):
+        return sigma[p] + ptdt_p[p] * ti.Matrix.identity(ti.f64, dim)
+    else:
+        return sigma[p]
+
+@ti.func
+def sortParticles(interval: ti.template()): # counting sort by "base", every interval calls (0: never) or once a particle has moved more than binMargin from its bin
+    ti.static_assert(dim == 2, "the particle bins are 2D only")
+    isSortDue[None] = 0
+    if ti.static(interval > 0):
+        isSortDue[None] = substepsSinceSort[None] >= interval
+    for p in xtdt_p:
+        base = (xtdt_p[p] * inv_dx - shift).cast(int)
+        if ti.abs(base - binBase_p[p]).max() > binMargin:
+            isSortDue[None] = 1
+    for k in binCount:
+        if isSortDue[None]:
+            binCount[k] = 0
+    for p in xtdt_p:
+        if isSortDue[None]:
+            binBase_p[p] = (xtdt_p[p] * inv_dx - shift).cast(int)
+            ti.atomic_add(binCount[binBase_p[p][0] * num_g + binBase_p[p][1]], 1)
+    ti.loop_config(serialize=True)
+    for k in range(numBins):
+        if isSortDue[None]:
+            binStart[k + 1] = binStart[k] + binCount[k]
+            binCount[k] = 0 # refilled below as the fill level of the bin
+    for p in xtdt_p:
+        if isSortDue[None]:
+            k = binBase_p[p][0] * num_g + binBase_p[p][1]
+            binnedParticles[binStart[k] + ti.atomic_add(binCount[k], 1)] = p
+    if isSortDue[None]:
+        substepsSinceSort[None] = 0
+    substepsSinceSort[None] += 1
+
+@ti.func
+def gatherP2G(dt): # every node sums the terms of the P2G scatter in substep() over the particles binned around it
     for i, j in mt_I:
-        mt_I[i, j] = [[0, 0],[0, 0]]
-        volumet_I[i, j] = 0
-
-        ptdt_I[i, j] = 0
-        pt_I[i, j] = 0
-
-        vtdt_I[i, j] = [0,0]
-        vt_I[i, j] = [0,0]
-
-        utdt_I[i, j] = [0,0]
-        ut_I[i, j] = [0,0]
-
-        Delta_utdt_I[i, j] = [0,0]
-        Delta_ut_I[i, j] = [0,0]
+        node = ti.Vector([i, j])
+        volumet, mt, ptdt, pt = ti.cast(0, ti.f64), ti.cast(0, ti.f64), ti.cast(0, ti.f64), ti.cast(0, ti.f64)
+        vt, at, ut, Delta_ut, ft = ti.Vector.zero(ti.f64, dim), ti.Vector.zero(ti.f64, dim), ti.Vector.zero(ti.f64, dim), ti.Vector.zero(ti.f64, dim), ti.Vector.zero(ti.f64, dim)
+        for bx in range(ti.max(i - nodeNum + 1 - binMargin, 0), ti.min(i + binMargin + 1, ensembleSize * num_g)):
+            for by in range(ti.max(j - nodeNum + 1 - binMargin, 0), ti.min(j + binMargin + 1, num_g)):
+                k = bx * num_g + by
+                for n in range(binStart[k], binStart[k + 1]):
+                    p = binnedParticles[n]
+                    offset = node - base_p[p] # position of the node in the particle's stencil
+                    if offset.min() < 0 or offset.max() >= nodeNum:
+                        continue
+                    fx = (xtdt_p[p] * inv_dx - base_p[p].cast(ti.f64)) * dx
+                    Psi_I, dPsi_I = Psi_p[p], dPsi_p[p]
+                    for s in ti.static(range(numStencil)):
+                        if offset[0] == ti.static(stencil[s][0]) and offset[1] == ti.static(stencil[s][1]):
+                            B_I = shapeGradient(dPsi_I, s)
+                            dpos = offset.cast(ti.f64)*dx - fx
+                            vt_I_APIC = Lt_p[p] @ dpos
+                            volumet += Psi_I[s] * volumet_p[p]
+                            mt += Psi_I[s] * mt_p[p]
+                            vt += Psi_I[s] * mt_p[p] * (vtdt_p[p] + isAPIC_elsePIC * vt_I_APIC)
+                            at += Psi_I[s] * mt_p[p] * atdt_p[p]
+                            ut += Psi_I[s] * mt_p[p] * utdt_p[p]
+                            Delta_ut += Psi_I[s] * mt_p[p] * Delta_utdt_p[p]
+                            ft += volumet_p[p] * Psi_I[s] * caseValue(fb[None], fb_b, p) - volumet_p[p] * ( stressP2G(p) @ B_I )
+                            ptdt += Psi_I[s]*volumet_p[p]*ptdt_p[p] - dt*caseValue(kappa, kappa_b, p)*volumet_p[p]*Psi_I[s]*divvt_p[p]
+                            pt += Psi_I[s]*volumet_p[p]*ptdt_p[p]
+        volumet_I[i, j] += volumet
+        mt_I[i, j] += massEntry(mt * ti.Matrix.identity(ti.f64, dim))
+        vt_I[i, j] += vt
+        at_I[i, j] += at
+        ut_I[i, j] += ut
+        Delta_ut_I[i, j] += Delta_ut
+        ft_I[i, j] += ft
+        ptdt_I[i, j] += ptdt
+        pt_I[i, j] += pt
+
+@ti.func
+def writeConsistency(p, base, Psi_I, dPsi_I):
+    # PoU, consistency and gradient consistency of particle p's RK shape functions, reproducing x*y (whose z derivative is 0 in 3D)
+    pou, cons, cons_dx, cons_dy, cons_dz = ti.cast(0, ti.f64), ti.cast(0, ti.f64), ti.cast(0, ti.f64), ti.cast(0, ti.f64), ti.cast(0, ti.f64)
+    for s in ti.static(range(numStencil)):
+        gridNode = (base + ti.Vector(ti.static(stencil[s]))).cast(ti.f64) * dx # Current grid node location
+        pou += Psi_I[s] # POU
+        cons += Psi_I[s] * gridNode[0] * gridNode[1] # Consistency
+        cons_dx += dPsi_I[s, 0] * gridNode[0] * gridNode[1] # Gradient consistency
+        cons_dy += dPsi_I[s, 1] * gridNode[0] * gridNode[1] # Gradient consistency
+        if ti.static(dim == 3):
+            cons_dz += dPsi_I[s, 2] * gridNode[0] * gridNode[1] # Gradient consistency
+    PartitionOfUnity[p] = pou
+    Cons[p] = cons - xtdt_p[p][0] * xtdt_p[p][1]
+    Cons_dx[p] = cons_dx - float(1.0) * xtdt_p[p][1]
+    Cons_dy[p] = cons_dy - float(1.0) * xtdt_p[p][0]
+    if ti.static(dim == 3):
+        Cons_dz[p] = cons_dz
 
-        atdt_I[i, j] = [0,0]
-        at_I[i, j] = [0,0]
-        ft_I[i, j] = [0,0]
-
-        # volume0_0[i,j] = 0
-        # volumet_0[i,j] = 0
-        # cell[i,j] = 0
-
-        # divvt_0_denominator[i, j] = 0
-        # divvt_0_numerator[i, j] = 0
-        # divvt_0[i, j] = 0
-
-    if isPenaltyBC_elseBruteforceBC:
-        penaltybc()
+@ti.kernel
+def computeConsistency():
+    # The checks of writeConsistency() at the current positions, outside the substep (consistencyChecks = "output")
+    for p in xtdt_p:
+        if not isActive(p):
+            continue
+        base = (xtdt_p[p] * inv_dx - shift).cast(int)
+        Psi_I, dPsi_I = getRK(xtdt_p[p], base, a)
+        writeConsistency(p, base, Psi_I, dPsi_I)
+
+@ti.func
+def neighbourBins(x, radius):
+    # Bins [lo, hi] of sortParticles() that can hold particles within radius of x; their particles are
+    # binnedParticles[binStart[k]:binStart[k + 1]] with k = bx * num_g + by
+    lo = ti.max(((x - radius) * inv_dx - shift).cast(int) - binMargin, 0)
+    hi = ti.min(((x + radius) * inv_dx - shift).cast(int) + binMargin, ti.Vector([ensembleSize * num_g - 1, num_g - 1]))
+    return lo, hi
+
+@ti.func
+def smoothingKernel(r, radius):
+    # 2D cubic B-spline of support radius, normalized to unit integral (same shape as the RK kernel of getRK)
+    z = r / radius
+    w = ti.cast(0, ti.f64)
+    if z < 0.5:
+        w = 2/3 - 4*z**2 + 4*z**3
+    elif z < 1:
+        w = 4/3 - 4*z + 4*z**2 - (4/3)*z**3
+    return 60 / (7 * ti.math.pi * radius**2) * w
 
+@ti.kernel
+def updateNeighbourhoods():
+    # Free-surface flag and smoothed density from the particles within neighbourRadius, O(N): bins are re-sorted only
+    # once a particle has left its bin. The tank walls are accounted for by mirror images of the neighbours. 2D only.
+    sortParticles(0)
+    radius = neighbourRadius * dx
+    for p in xtdt_p:
+        xCase = (p // num_p * num_g * dx) if ti.static(ensembleSize > 1) else 0.0 # x shift of the case's grid tile
+        walls = ti.Vector([2 * dx + xCase, len_domain + 2 * dx + xCase, 2 * dx, len_domain + 2 * dx]) # left, right, bottom, top
+        volumeSum, massSum = ti.cast(0, ti.f64), ti.cast(0, ti.f64)
+        lo, hi = neighbourBins(xtdt_p[p], radius)
+        for bx in range(lo[0], hi[0] + 1):
+            for by in range(lo[1], hi[1] + 1):
+                k = bx * num_g + by
+                for n in range(binStart[k], binStart[k + 1]):
+                    q = binnedParticles[n]
+                    r = (xtdt_p[q] - xtdt_p[p]).norm()
+                    if r < radius: # the mirror images of q are within radius of p only if q is
+                        W = smoothingKernel(r, radius)
+                        for w in ti.static(range(4)): # mirror image of q across each wall close to p
+                            if ti.abs(xtdt_p[p][w // 2] - walls[w]) < radius:
+                                mirrored = xtdt_p[q]
+                                mirrored[w // 2] = 2 * walls[w] - mirrored[w // 2]
+                                W += smoothingKernel((mirrored - xtdt_p[p]).norm(), radius)
+                        volumeSum += volumet_p[q] * W
+                        massSum += mt_p[q] * W
+        rhoSmoothed_p[p] = massSum / (volumeSum + epsilon)
+        freeSurface_p[p] = volumeSum < freeSurfaceThreshold # about 1 inside the fluid, 1/2 at a flat surface
+
+@ti.func
+def clearNode(I):
+    if ti.static(isPenaltyBC_elseBruteforceBC):
+        mt_I[I] = mt_I_BC[I] # penalty term on the EBC
+    else:
+        mt_I[I] = massEntry(ti.Matrix.zero(gridFloat, dim, dim))
+    volumet_I[I] = 0
+
+    ptdt_I[I] = 0
+    pt_I[I] = 0
+
+    vtdt_I[I] = ti.Vector.zero(gridFloat, dim)
+    vt_I[I] = ti.Vector.zero(gridFloat, dim)
+
+    utdt_I[I] = ti.Vector.zero(gridFloat, dim)
+    ut_I[I] = ti.Vector.zero(gridFloat, dim)
+
+    Delta_utdt_I[I] = ti.Vector.zero(gridFloat, dim)
+    Delta_ut_I[I] = ti.Vector.zero(gridFloat, dim)
+
+    atdt_I[I] = ti.Vector.zero(gridFloat, dim)
+    at_I[I] = ti.Vector.zero(gridFloat, dim)
+    ft_I[I] = ti.Vector.zero(gridFloat, dim)
+
+    # divvt_0_denominator[i, j] = 0
+    # divvt_0_numerator[i, j] = 0
+    # divvt_0[i, j] = 0
+
+@ti.func
+def clearGrid():
+    if ti.static(isSparseGrid):
+        for I in ti.grouped(gridBlock): # deactivated blocks read as zero and are skipped by the grid loops
+            ti.deactivate(gridBlock, I)
+        if ti.static(isPenaltyBC_elseBruteforceBC):
+            for I in ti.grouped(mt_I_BC):
+                mt_I[I] = mt_I_BC[I] # penalty term on the EBC
+    elif ti.static(numRanks > 1): # only the columns the particles of this rank reach
+        for i, j in ti.ndrange((rankColumns[0], rankColumns[1]), num_g):
+            clearNode(ti.Vector([i, j]))
+    else:
+        for I in ti.grouped(mt_I):
+            clearNode(I)
+    if ti.static(isFBar):
+        for I in ti.grouped(cell):
+            volume0_0[I] = 0
+            volumet_0[I] = 0
+            cell[I] = 0
+
+@ti.func
+def particleToGrid(dt):
     for p in xtdt_p: 
+        if not isActive(p):
+            continue
         # cellBase = (xtdt_p[p] * inv_dx).cast(int)
         base = (xtdt_p[p] * inv_dx - shift).cast(int) # Define the bottom left corner of the surrounding 3x3 grid of neighboring nodes
         fx = (xtdt_p[p] * inv_dx - base.cast(ti.f64)) * dx # Define the vector from "base" to the current particle
-        PartitionOfUnity[p] = ti.cast(0, ti.f64) # reset PoU, consistency, and gradient consistency for each particle
-        Cons[p] = ti.cast(0, ti.f64)
-        Cons_dx[p] = ti.cast(0, ti.f64)
-        Cons_dy[p] = ti.cast(0, ti.f64)
-
-        Psi_I, Psi_Icommax, Psi_Icommay = getRK(xtdt_p[p], base, a)
-
-        for i, j in ti.static(ti.ndrange(nodeNum, nodeNum)): # for I \in 3 by 3 grid
-            gridNode = [float(i+base[0]) * dx, float(j+base[1]) * dx] # Current grid node location
-            B_I = ti.Vector([Psi_Icommax[i,j], Psi_Icommay[i,j]]) # Assemble a phi gradient vector
-            PartitionOfUnity[p] += Psi_I[i,j] # POU
-            Cons[p] += Psi_I[i,j] * gridNode[0] * gridNode[1] # Consistency
-            Cons_dx[p] += B_I[0] * gridNode[0] * gridNode[1] # Gradient consistency
-            Cons_dy[p] += B_I[1] * gridNode[0] * gridNode[1] # Gradient consistency
-
-            offset = ti.Vector([i, j]) # Vector of grid node positions relative to "base" 
-            dpos = offset.cast(ti.f64)*dx - fx # A vector from the current grid node to the current particle
-            vt_I_APIC = Lt_p[p] @ dpos # define the contribution of the velocity gradient to the particle momentum 
-            volumet_I[base + offset] += Psi_I[i,j] * volumet_p[p]
-            mt_I[base + offset] += Psi_I[i,j] * mt_p[p] * ti.Matrix.identity(ti.f64, 2)
-            vt_I[base + offset] += Psi_I[i,j] * mt_p[p] * (vtdt_p[p] + isAPIC_elsePIC * vt_I_APIC) # obtain $(mv)^t_I$
-            at_I[base + offset] += Psi_I[i,j] * mt_p[p] * atdt_p[p]
-            ut_I[base + offset] += Psi_I[i,j] * mt_p[p] * utdt_p[p]
-            Delta_ut_I[base + offset] += Psi_I[i,j] * mt_p[p] * Delta_utdt_p[p]
-            ft_I[base + offset] +=  volumet_p[p] * Psi_I[i,j] * fb[None] - volumet_p[p] * ( sigma[p] @ B_I )
-            ptdt_I[base + offset] += Psi_I[i,j]*volumet_p[p]*ptdt_p[p] - dt*kappa*volumet_p[p]*Psi_I[i,j]*divvt_p[p]
-            pt_I[base + offset] += Psi_I[i,j]*volumet_p[p]*ptdt_p[p]
-
-        Cons[p] -= xtdt_p[p][0] * xtdt_p[p][1] # Consistency
-        Cons_dx[p] -= float(1.0) * xtdt_p[p][1] # Gradient consistency
-        Cons_dy[p] -= float(1.0) * xtdt_p[p][0] # Gradient consistency
 
-    for i, j in mt_I:
-        if volumet_I[i, j] != 0:
-            ptdt_I[i,j] /= (volumet_I[i,j] + epsilon) # pressure-volume parameter to pressure
-            pt_I[i,j] /= (volumet_I[i,j] + epsilon)
-        if mt_I[i, j][0,0] != 0 and mt_I[i, j][1,1] != 0:# and volumet_I[i, j] != 0:
-            atdt_I[i,j] = mt_I[i, j].inverse() @ ft_I[i,j]
-            at_I[i,j] = mt_I[i, j].inverse() @ at_I[i,j]
-            vt_I[i,j] = mt_I[i, j].inverse() @ vt_I[i,j]
-            Delta_ut_I[i,j] = mt_I[i, j].inverse() @ Delta_ut_I[i,j]
-            ut_I[i,j] = mt_I[i, j].inverse() @ ut_I[i,j]
-
-            if isPenaltyBC_elseBruteforceBC == False:
-                # if i < nodeNum: 
-                    # at_I[i, j][0] = 0
-                    # atdt_I[i, j][0] = 0
-                    # if vt_I[i, j][0] < 0: vt_I[i, j][0] = 0
-                # if i > num_g - nodeNum - 1: 
-                    # at_I[i, j][0] = 0
-                    # atdt_I[i, j][0] = 0
-                    # if vt_I[i, j][0] > 0: vt_I[i, j][0] = 0
-                # if j < nodeNum:
-                    # at_I[i, j][1] = 0
-                    # atdt_I[i, j][1] = 0
-                    # if vt_I[i, j][1] < 0: vt_I[i, j][1] = 0
-                # if j > num_g - nodeNum - 1: 
-                    # at_I[i, j][1] = 0
-                    # atdt_I[i, j][1] = 0
-                    # if vt_I[i, j][1] > 0: vt_I[i, j][1] = 0
-
-                if isCSL_elseMPM:
-                    vtdt_I[i,j] = vt_I[i,j] + (1-gammaNewmark) * at_I[i,j] * dt + gammaNewmark * atdt_I[i,j] * dt
-                    Delta_utdt_I[i,j] = vt_I[i,j]*dt + (0.5 - betaNewmark) * at_I[i,j] * dt**2 + betaNewmark * atdt_I[i,j] * dt**2 
-                    utdt_I[i,j] = ut_I[i,j] + vt_I[i,j]*dt + (0.5 - betaNewmark) * at_I[i,j] * dt**2 + betaNewmark * atdt_I[i,j] * dt**2 
-                    if i < nodeNum:
-                        # atdt_I[i, j][0] = 0
-                        if vtdt_I[i, j][0] < 0: vtdt_I[i, j][0] = 0
-                        if Delta_utdt_I[i, j][0] < 0: Delta_utdt_I[i, j][0] = 0
-                        if utdt_I[i, j][0] < 0: utdt_I[i, j][0] = ut_I[i,j][0]
-                    if i > num_g - nodeNum - 1:
-                        # atdt_I[i, j][0] = 0
-                        if vtdt_I[i, j][0] > 0: vtdt_I[i, j][0] = 0
-                        if Delta_utdt_I[i, j][0] > 0: Delta_utdt_I[i, j][0] = 0
-                        if utdt_I[i, j][0] > 0: utdt_I[i, j][0] = ut_I[i,j][0]
-                    if j < nodeNum:
-                        # atdt_I[i, j][1] = 0
-                        if vtdt_I[i, j][1] < 0: vtdt_I[i, j][1] = 0
-                        if Delta_utdt_I[i, j][1] < 0: Delta_utdt_I[i, j][1] = 0
-                        if utdt_I[i, j][1] < 0: utdt_I[i, j][1] = ut_I[i,j][1]
-                    if j > num_g - nodeNum - 1:
-                        # atdt_I[i, j][1] = 0
-                        if vtdt_I[i, j][1] > 0: vtdt_I[i, j][1] = 0
-                        if Delta_utdt_I[i, j][1] > 0: Delta_utdt_I[i, j][1] = 0
-                        if utdt_I[i, j][1] > 0: utdt_I[i, j][1] = ut_I[i,j][1]
-                        
-                else:
-                    vtdt_I[i,j] = vt_I[i,j] + atdt_I[i,j] * dt
-                    if i < nodeNum and vtdt_I[i, j][0] < 0: 
-                        vtdt_I[i, j][0] = 0
-                    if i > num_g - nodeNum - 1 and vtdt_I[i, j][0] > 0: 
-                        vtdt_I[i, j][0] = 0
-                    if j < nodeNum and vtdt_I[i, j][1] < 0: 
-                        vtdt_I[i, j][1] = 0
-                    if j > num_g - nodeNum - 1 and vtdt_I[i, j][1] > 0: 
-                        vtdt_I[i, j][1] = 0
+        Psi_I, dPsi_I = getRK(xtdt_p[p], base, a)
+        if ti.static(isCacheRK or isGatherP2G): # particles do not move until G2P, so store the shape functions for it (and the gather)
+            base_p[p] = base
+            Psi_p[p] = Psi_I
+            dPsi_p[p] = dPsi_I
+
+        for s in ti.static(range(numStencil)): # for I \in 3 by 3 (by 3) grid
+            B_I = shapeGradient(dPsi_I, s) # Assemble a phi gradient vector
+            if ti.static(not isGatherP2G): # scatter with atomics
+                offset = ti.Vector(ti.static(stencil[s])) # Vector of grid node positions relative to "base" 
+                dpos = offset.cast(ti.f64)*dx - fx # A vector from the current grid node to the current particle
+                vt_I_APIC = Lt_p[p] @ dpos # define the contribution of the velocity gradient to the particle momentum 
+                volumet_I[base + offset] += Psi_I[s] * volumet_p[p]
+                mt_I[base + offset] += massEntry(Psi_I[s] * mt_p[p] * ti.Matrix.identity(ti.f64, dim))
+                vt_I[base + offset] += Psi_I[s] * mt_p[p] * (vtdt_p[p] + isAPIC_elsePIC * vt_I_APIC) # obtain $(mv)^t_I$
+                at_I[base + offset] += Psi_I[s] * mt_p[p] * atdt_p[p]
+                ut_I[base + offset] += Psi_I[s] * mt_p[p] * utdt_p[p]
+                Delta_ut_I[base + offset] += Psi_I[s] * mt_p[p] * Delta_utdt_p[p]
+                ft_I[base + offset] +=  volumet_p[p] * Psi_I[s] * caseValue(fb[None], fb_b, p) - volumet_p[p] * ( stressP2G(p) @ B_I )
+                ptdt_I[base + offset] += Psi_I[s]*volumet_p[p]*ptdt_p[p] - dt*caseValue(kappa, kappa_b, p)*volumet_p[p]*Psi_I[s]*divvt_p[p]
+                pt_I[base + offset] += Psi_I[s]*volumet_p[p]*ptdt_p[p]
+
+        if ti.static(consistencyChecks == "always"):
+            writeConsistency(p, base, Psi_I, dPsi_I)
+
+    if ti.static(isGatherP2G):
+        gatherP2G(dt)
+
+@ti.func
+def integrateNode(I, dt):
+    # Velocities and displacements of node I from its accelerations (Newmark for CSL), with the bruteforce wall conditions
+    ICase = I # index within the case's grid (bruteforce BC)
+    if ti.static(ensembleSize > 1):
+        ICase[0] = I[0] % num_g
+    if isPenaltyBC_elseBruteforceBC == False:
+        # if i < nodeNum: 
+            # at_I[i, j][0] = 0
+            # atdt_I[i, j][0] = 0
+            # if vt_I[i, j][0] < 0: vt_I[i, j][0] = 0
+        # if i > num_g - nodeNum - 1: 
+            # at_I[i, j][0] = 0
+            # atdt_I[i, j][0] = 0
+            # if vt_I[i, j][0] > 0: vt_I[i, j][0] = 0
+        # if j < nodeNum:
+            # at_I[i, j][1] = 0
+            # atdt_I[i, j][1] = 0
+            # if vt_I[i, j][1] < 0: vt_I[i, j][1] = 0
+        # if j > num_g - nodeNum - 1: 
+            # at_I[i, j][1] = 0
+            # atdt_I[i, j][1] = 0
+            # if vt_I[i, j][1] > 0: vt_I[i, j][1] = 0
+
+        if isCSL_elseMPM:
+            vtdt_I[I] = vt_I[I] + (1-gammaNewmark) * at_I[I] * dt + gammaNewmark * atdt_I[I] * dt
+            Delta_utdt_I[I] = vt_I[I]*dt + (0.5 - betaNewmark) * at_I[I] * dt**2 + betaNewmark * atdt_I[I] * dt**2 
+            utdt_I[I] = ut_I[I] + vt_I[I]*dt + (0.5 - betaNewmark) * at_I[I] * dt**2 + betaNewmark * atdt_I[I] * dt**2 
+            for d in ti.static(range(dim)): # walls normal to x_d
+                if ICase[d] < nodeNum:
+                    # atdt_I[I][d] = 0
+                    if vtdt_I[I][d] < 0: vtdt_I[I][d] = 0
+                    if Delta_utdt_I[I][d] < 0: Delta_utdt_I[I][d] = 0
+                    if utdt_I[I][d] < 0: utdt_I[I][d] = ut_I[I][d]
+                if ICase[d] > num_g - nodeNum - 1:
+                    # atdt_I[I][d] = 0
+                    if vtdt_I[I][d] > 0: vtdt_I[I][d] = 0
+                    if Delta_utdt_I[I][d] > 0: Delta_utdt_I[I][d] = 0
+                    if utdt_I[I][d] > 0: utdt_I[I][d] = ut_I[I][d]
 
+        else:
+            vtdt_I[I] = vt_I[I] + atdt_I[I] * dt
+            for d in ti.static(range(dim)):
+                if ICase[d] < nodeNum and vtdt_I[I][d] < 0: 
+                    vtdt_I[I][d] = 0
+                if ICase[d] > num_g - nodeNum - 1 and vtdt_I[I][d] > 0: 
+                    vtdt_I[I][d] = 0
+
+@ti.func
+def updateNode(I, dt):
+    if volumet_I[I] != 0:
+        ptdt_I[I] /= (volumet_I[I] + epsilon) # pressure-volume parameter to pressure
+        pt_I[I] /= (volumet_I[I] + epsilon)
+    mDiag = massDiagonal(mt_I[I])
+    if (mDiag != 0).all():# and volumet_I[I] != 0:
+        if ti.static(isDiagonalMass):
+            mInv = 1.0 / mDiag # inverse of the diagonal mass, elementwise
+            atdt_I[I] = mInv * ft_I[I]
+            at_I[I] = mInv * at_I[I]
+            vt_I[I] = mInv * vt_I[I]
+            Delta_ut_I[I] = mInv * Delta_ut_I[I]
+            ut_I[I] = mInv * ut_I[I]
+        else:
+            M_inv = mt_I[I].inverse()
+            atdt_I[I] = M_inv @ ft_I[I]
+            at_I[I] = M_inv @ at_I[I]
+            vt_I[I] = M_inv @ vt_I[I]
+            Delta_ut_I[I] = M_inv @ Delta_ut_I[I]
+            ut_I[I] = M_inv @ ut_I[I]
+
+        integrateNode(I, dt)
+
+@ti.func
+def updateGrid(dt):
+    if ti.static(numRanks > 1 and not isSparseGrid): # only the columns the particles of this rank reach
+        for i, j in ti.ndrange((rankColumns[0], rankColumns[1]), num_g):
+            updateNode(ti.Vector([i, j]), dt)
+    else:
+        for I in ti.grouped(mt_I):
+            updateNode(I, dt)
+
+@ti.func
+def gridToParticle(dt, eta_v, eta_u, eta_p):
     for p in xtdt_p: 
+        if not isActive(p):
+            continue
+        eta_v_p, eta_u_p, eta_p_p = caseValue(eta_v, eta_v_b, p), caseValue(eta_u, eta_u_b, p), caseValue(eta_p, eta_p_b, p)
         base = (xtdt_p[p] * inv_dx - shift).cast(int) #每个 particle 所属的 3x3 support 的左下角点位置
+        if ti.static(isCacheRK):
+            base = base_p[p] # particles have not moved since P2G
         fx = ( xtdt_p[p] * inv_dx - base.cast(ti.f64) ) * dx # 向量，由 base 指向 particle
 
-        vtdt_p_APIC = ti.Vector.zero(ti.f64, 2) # Initialize an APIC velocity vector
-        vtdt_p_FLIP = ti.Vector.zero(ti.f64, 2) # Initialize a FLIP velocity vector
-        new_L = ti.Matrix.zero(ti.f64, 2, 2) # Initialize a velocity gradient matrix
+        vtdt_p_APIC = ti.Vector.zero(ti.f64, dim) # Initialize an APIC velocity vector
+        vtdt_p_FLIP = ti.Vector.zero(ti.f64, dim) # Initialize a FLIP velocity vector
+        new_L = ti.Matrix.zero(ti.f64, dim, dim) # Initialize a velocity gradient matrix
         new_divvt_p = ti.cast(0, ti.f64)
         new_ptdt_p = ti.cast(0, ti.f64)
         new_Delta_ptdt_p = ti.cast(0, ti.f64)
-        new_atdt_p = ti.Vector.zero(float, 2) # Initialize an APIC velocity vector
-        new_at_p = ti.Vector.zero(float, 2)
-        new_utdt_p = ti.Vector.zero(float, 2)
-        Delta_utdt_p_APIC = ti.Vector.zero(float, 2) 
-        Delta_utdt_p_FLIP = ti.Vector.zero(float, 2) 
-        Delta_Delta_utdt_p_FLIP = ti.Vector.zero(float, 2) 
-        Psi_I, Psi_Icommax, Psi_Icommay = getRK(xtdt_p[p], base, a)
-
-        for i, j in ti.static(ti.ndrange(nodeNum, nodeNum)): 
-            B_I = ti.Vector([Psi_Icommax[i,j], Psi_Icommay[i,j]]) # 2 by 1 vector, assemble a phi gradient vector
-            offset = ti.Vector([i, j])
+        new_atdt_p = ti.Vector.zero(float, dim) # Initialize an APIC velocity vector
+        new_at_p = ti.Vector.zero(float, dim)
+        new_utdt_p = ti.Vector.zero(float, dim)
+        Delta_utdt_p_APIC = ti.Vector.zero(float, dim) 
+        Delta_utdt_p_FLIP = ti.Vector.zero(float, dim) 
+        Delta_Delta_utdt_p_FLIP = ti.Vector.zero(float, dim) 
+        Psi_I = ti.Vector.zero(ti.f64, numStencil)
+        dPsi_I = ti.Matrix.zero(ti.f64, numStencil, dim)
+        if ti.static(isCacheRK):
+            Psi_I, dPsi_I = Psi_p[p], dPsi_p[p] # shape functions stored in P2G
+        else:
+            Psi_I, dPsi_I = getRK(xtdt_p[p], base, a)
+
+        for s in ti.static(range(numStencil)): 
+            B_I = shapeGradient(dPsi_I, s) # dim by 1 vector, assemble a phi gradient vector
+            offset = ti.Vector(ti.static(stencil[s]))
             new_L += vtdt_I[base + offset].outer_product(B_I) # define the velocity gradient
             new_divvt_p += vtdt_I[base + offset].dot(B_I)
 
             # if isCSLFLIPscheme2 == False:
-            Delta_utdt_p_APIC += Psi_I[i,j] * (utdt_I[base + offset] - ut_I[base + offset])
-            Delta_Delta_utdt_p_FLIP += Psi_I[i,j] * (Delta_utdt_I[base + offset] - Delta_ut_I[base + offset])
+            Delta_utdt_p_APIC += Psi_I[s] * (utdt_I[base + offset] - ut_I[base + offset])
+            Delta_Delta_utdt_p_FLIP += Psi_I[s] * (Delta_utdt_I[base + offset] - Delta_ut_I[base + offset])
             
-            vtdt_p_APIC += Psi_I[i,j] * (vtdt_I[base + offset]) # - 0.5 * at_I[base + offset] * dt**2 # APIC calculation of velocity
-            vtdt_p_FLIP += Psi_I[i,j] * (vtdt_I[base + offset]  - vt_I[base + offset]) # FLIP calculation of velocity
-            new_ptdt_p += Psi_I[i,j] * ptdt_I[base + offset]
-            new_Delta_ptdt_p += Psi_I[i,j] * (ptdt_I[base + offset] - pt_I[base + offset])
-            new_atdt_p += Psi_I[i,j] * atdt_I[base + offset]
-            new_at_p += Psi_I[i,j] * at_I[base + offset]
-            new_utdt_p += Psi_I[i,j] * utdt_I[base + offset]
+            vtdt_p_APIC += Psi_I[s] * (vtdt_I[base + offset]) # - 0.5 * at_I[base + offset] * dt**2 # APIC calculation of velocity
+            vtdt_p_FLIP += Psi_I[s] * (vtdt_I[base + offset]  - vt_I[base + offset]) # FLIP calculation of velocity
+            new_ptdt_p += Psi_I[s] * ptdt_I[base + offset]
+            new_Delta_ptdt_p += Psi_I[s] * (ptdt_I[base + offset] - pt_I[base + offset])
+            new_atdt_p += Psi_I[s] * atdt_I[base + offset]
+            new_at_p += Psi_I[s] * at_I[base + offset]
+            new_utdt_p += Psi_I[s] * utdt_I[base + offset]
 
         
 
@@ -436,7 +831,7 @@ def substep():
             atdt_p[p] = new_atdt_p
             utdt_p[p] = new_utdt_p
             Delta_utdt_p_FLIP = Delta_utdt_p[p] + Delta_Delta_utdt_p_FLIP
-            Delta_utdt_p[p] =  float(eta_u)*Delta_utdt_p_FLIP + float(1-eta_u)*Delta_utdt_p_APIC
+            Delta_utdt_p[p] =  float(eta_u_p)*Delta_utdt_p_FLIP + float(1-eta_u_p)*Delta_utdt_p_APIC
             # if isCSLFLIPscheme2:
             #     Delta_utdt_p = vtdt_p[p]*dt + (0.5-betaNewmark)*at_p[p]*dt**2 + betaNewmark*atdt_p[p]*dt**2
             #     # Delta_utdt_p = vtdt_p[p]*dt + betaNewmark*atdt_p[p]*dt**2
@@ -447,23 +842,28 @@ def substep():
             xtdt_p[p] += Delta_utdt_p[p] #　Delta_utdt_p[p]
             # vtdt_p[p] += dt * atdt_p[p]
             vtdt_p[p] += vtdt_p_FLIP # dt * atdt_p[p] # vtdt_p_FLIP
-            vtdt_p[p] = float(eta_v)*vtdt_p[p] + float(1-eta_v)*vtdt_p_APIC
+            vtdt_p[p] = float(eta_v_p)*vtdt_p[p] + float(1-eta_v_p)*vtdt_p_APIC
             # vtdt_p[p] = vtdt_p_APIC
             # xtdt_p[p] += dt * vtdt_p[p]
         else:
             vtdt_p_FLIP += vtdt_p[p]
-            vtdt_p[p] = float(eta_v)*vtdt_p_FLIP + float(1-eta_v)*vtdt_p_APIC # Define the particle velocity (FLIP blend)
+            vtdt_p[p] = float(eta_v_p)*vtdt_p_FLIP + float(1-eta_v_p)*vtdt_p_APIC # Define the particle velocity (FLIP blend)
             xtdt_p[p] += dt * vtdt_p[p]
 
         Lt_p[p] = new_L
-        Ft_p[p] = (ti.Matrix.identity(ti.f64, 2) + dt * Lt_p[p]) @ Ft_p[p] # Deformation gradient update
-        U_F, sig_F, V_F = ti.svd(Ft_p[p]) # Singular value decomposition
+        Ft_p[p] = (ti.Matrix.identity(ti.f64, dim) + dt * Lt_p[p]) @ Ft_p[p] # Deformation gradient update
         J = ti.cast(1.0, ti.f64)
-        for d in ti.static(range(dim)):
-            J *= sig_F[d, d]
+        if ti.static(volumeUpdate == "det"):
+            J = Ft_p[p].determinant()
+        elif ti.static(volumeUpdate == "incremental"): # J of the last substep times det(I + dt*L)
+            J = ti.cast(detF[p], ti.f64) * (ti.Matrix.identity(ti.f64, dim) + dt * Lt_p[p]).determinant()
+        else:
+            U_F, sig_F, V_F = ti.svd(Ft_p[p]) # Singular value decomposition
+            for d in ti.static(range(dim)):
+                J *= sig_F[d, d]
         detF[p] = J
-        volumet_p[p] = volume0_p * detF[p] # Update particle volumes using F
-        rho_p[p] = rho / (detF[p] + epsilon)
+        volumet_p[p] = caseValue(volume0_p, volume0_b, p) * detF[p] # Update particle volumes using F
+        rho_p[p] = caseValue(rho, rho_b, p) / (detF[p] + epsilon)
         mt_p[p] = volumet_p[p] * rho_p[p]
         
         if isInterTimeStepDivv:
@@ -471,21 +871,68 @@ def substep():
         else:
             divvt_p[p] = new_divvt_p
 
+        if ti.static(isFBar): # sums of the particle's cell, read back in stabilizeVolume once every particle has added to them
+            c = (xtdt_p[p] * inv_dx).cast(int)
+            volume0_0[c] += caseValue(volume0_p, volume0_b, p)
+            volumet_0[c] += volumet_p[p]
+            cell[c] += volumet_p[p] * divvt_p[p]
+
         pt_p[p] = ptdt_p[p]
         if isMixedFormulation_elsePointwise:
-            ptdt_p[p] = float(eta_p)*(ptdt_p[p] + new_Delta_ptdt_p) + float(1-eta_p)*new_ptdt_p
-        else:
-            ptdt_p[p] -= dt*kappa*divvt_p[p]
+            ptdt_p[p] = float(eta_p_p)*(ptdt_p[p] + new_Delta_ptdt_p) + float(1-eta_p_p)*new_ptdt_p
+        elif ti.static(not isFBar): # F-bar: in stabilizeVolume, with the cell's div(v)
+            ptdt_p[p] -= dt*caseValue(kappa, kappa_b, p)*divvt_p[p]
             # ptdt_p[p] = n_const*1540**2/rho*((rho_p[p]/rho)**n_const - 1)
 
+@ti.func
+def stabilizeVolume(p, dt):
+    # F-bar: detF of particle p becomes the volume-weighted mean J of the particles in its cell (sum V_p / sum V_p^0) and
+    # div(v) their volume-weighted mean, so volume, density and the pressure update are constant over a cell
+    c = (xtdt_p[p] * inv_dx).cast(int)
+    detF[p] = volumet_0[c] / volume0_0[c]
+    volumet_p[p] = caseValue(volume0_p, volume0_b, p) * detF[p]
+    rho_p[p] = caseValue(rho, rho_b, p) / (detF[p] + epsilon)
+    mt_p[p] = volumet_p[p] * rho_p[p]
+    divvt_p[p] = cell[c] / volumet_0[c]
+    if ti.static(not isMixedFormulation_elsePointwise):
+        ptdt_p[p] -= dt*caseValue(kappa, kappa_b, p)*divvt_p[p]
+
+@ti.func
+def updateStress(dt, ifAV):
     for p in xtdt_p: 
+        if not isActive(p):
+            continue
+        if ti.static(isFBar): # in the stress pass, which follows G2P anyway
+            stabilizeVolume(p, dt)
         vNRLAV = ti.cast(0, ti.f64)
         if ifAV == 1:
             if divvt_p[p] <0:
-                vNRLAV = -rho*c_L*dx*c_artificial*divvt_p[p] + rho*c_Q*dx**2*divvt_p[p]**2
+                vNRLAV = -caseValue(rho, rho_b, p)*c_L*dx*caseValue(c_artificial, c_artificial_b, p)*divvt_p[p] + caseValue(rho, rho_b, p)*c_Q*dx**2*divvt_p[p]**2
             else:
                 vNRLAV = 0
-        sigma[p] = - (ptdt_p[p] + ifAV * vNRLAV) * ti.Matrix.identity(ti.f64, 2) + visc * (Lt_p[p] + Lt_p[p].transpose())
+        sigma[p] = - (ptdt_p[p] + ifAV * vNRLAV) * ti.Matrix.identity(ti.f64, dim) + caseValue(visc, visc_b, p) * (Lt_p[p] + Lt_p[p].transpose())
+
+@ti.kernel
+def substep(dt: ti.f64, eta_v: ti.f64, eta_u: ti.f64, eta_p: ti.f64, ifAV: ti.i32): # runtime parameters shadow the globals of the same name, so changing them needs no recompile
+    if ti.static(isGatherP2G):
+        sortParticles(sortInterval)
+    clearGrid()
+    particleToGrid(dt)
+    updateGrid(dt)
+    gridToParticle(dt, eta_v, eta_u, eta_p)
+    updateStress(dt, ifAV)
+
+# A decomposed run (decomposition.py) splits substep() where the grid sums of the slabs are exchanged
+@ti.kernel
+def substepP2G(dt: ti.f64):
+    clearGrid()
+    particleToGrid(dt)
+
+@ti.kernel
+def substepG2P(dt: ti.f64, eta_v: ti.f64, eta_u: ti.f64, eta_p: ti.f64, ifAV: ti.i32):
+    updateGrid(dt)
+    gridToParticle(dt, eta_v, eta_u, eta_p)
+    updateStress(dt, ifAV)
 
     # if isDivvBar:
     #     for p in xtdt_p:
@@ -506,6 +953,244 @@ def substep():
     #             offset = ti.Vector([i, j])
     #             divvt_p[p] += Psi_I[i,j] * divvt_0[base + offset]
 
+# --------------------Semi-implicit pressure (isImplicitPressure)
+# The nodal pressure p of the mixed formulation is taken at the end of the substep: with the pressure-free accelerations a*
+# of P2G (stressP2G) and the nodal forces G p = sum_p V_p p(x_p) grad Psi_I(x_p),
+#   v = v* + gamma dt M^-1 P G p,   V p = V p_old - dt kappa G^T v,   (G^T v)_J = sum_p V_p Psi_J(x_p) div v(x_p),
+# where v* is the grid velocity of a*, P removes the wall-normal components at the bruteforce-BC nodes and V, M are the
+# lumped nodal volume and mass. Hence the SPD system (V / kappa + gamma dt^2 G^T P M^-1 P G) p = V p_old / kappa - dt G^T P v*,
+# with no sound-speed limit on dt. Nodes without volume keep p = 0 (the free surface).
+pressureGamma = gammaNewmark if isCSL_elseMPM else 1.0 # weight of the end-of-step acceleration in the grid velocity
+
+@ti.func
+def wallProjection(I, v):
+    # P v: v without the components normal to the walls at the nodes of the bruteforce BC (slip walls of the pressure solve)
+    w = v
+    for d in ti.static(range(dim)):
+        if I[d] < nodeNum or I[d] > num_g - nodeNum - 1:
+            w[d] = 0
+    return w
+
+@ti.func
+def solveMass(m, f):
+    # M^-1 f for a grid mass m stored by massEntry
+    if ti.static(isDiagonalMass):
+        return f / m
+    else:
+        return m.inverse() @ f
+
+@ti.func
+def particleShapeFunctions(p):
+    # "base" and RK shape functions of particle p at its current position, as P2G computed them
+    base = (xtdt_p[p] * inv_dx - shift).cast(int)
+    Psi_I = ti.Vector.zero(ti.f64, numStencil)
+    dPsi_I = ti.Matrix.zero(ti.f64, numStencil, dim)
+    if ti.static(isCacheRK):
+        base = base_p[p]
+        Psi_I, dPsi_I = Psi_p[p], dPsi_p[p]
+    else:
+        Psi_I, dPsi_I = getRK(xtdt_p[p], base, a)
+    return base, Psi_I, dPsi_I
+
+@ti.func
+def scatterPressureForce(x: ti.template()):
+    # cgForce += G x: forces of the nodal pressures x, interpolated to the particles
+    for p in xtdt_p:
+        if not isActive(p):
+            continue
+        base, Psi_I, dPsi_I = particleShapeFunctions(p)
+        pressure = ti.cast(0, ti.f64)
+        for s in ti.static(range(numStencil)):
+            pressure += Psi_I[s] * x[base + ti.Vector(ti.static(stencil[s]))]
+        for s in ti.static(range(numStencil)):
+            cgForce[base + ti.Vector(ti.static(stencil[s]))] += volumet_p[p] * pressure * shapeGradient(dPsi_I, s)
+
+@ti.func
+def gatherDivergence(w: ti.template(), y: ti.template()):
+    # y += G^T w: volume-weighted divergence of the nodal velocities w at the particles, projected to the nodes
+    for p in xtdt_p:
+        if not isActive(p):
+            continue
+        base, Psi_I, dPsi_I = particleShapeFunctions(p)
+        divergence = ti.cast(0, ti.f64)
+        for s in ti.static(range(numStencil)):
+            divergence += w[base + ti.Vector(ti.static(stencil[s]))].dot(shapeGradient(dPsi_I, s))
+        for s in ti.static(range(numStencil)):
+            y[base + ti.Vector(ti.static(stencil[s]))] += Psi_I[s] * volumet_p[p] * divergence
+
+@ti.func
+def applyPressureOperator(x: ti.template(), y: ti.template(), dt):
+    # y = (V / kappa + gamma dt^2 G^T P M^-1 P G) x on the nodes with a pressure unknown (matrix-free: two particle passes)
+    for I in ti.grouped(cgForce):
+        cgForce[I] = ti.Vector.zero(ti.f64, dim)
+        y[I] = 0
+    scatterPressureForce(x)
+    for I in ti.grouped(cgForce):
+        if (massDiagonal(mt_I[I]) != 0).all():
+            cgForce[I] = pressureGamma * dt**2 * wallProjection(I, solveMass(mt_I[I], wallProjection(I, cgForce[I])))
+        else:
+            cgForce[I] = ti.Vector.zero(ti.f64, dim)
+    gatherDivergence(cgForce, y)
+    for I in ti.grouped(y):
+        if cgDiagonal[I] > 0:
+            y[I] += volumet_I[I] * x[I] / kappa
+        else:
+            y[I] = 0
+
+@ti.kernel
+def substepPredict(dt: ti.f64):
+    # P2G and grid update with the pressure-free accelerations, then the right-hand side (in cgResidual), preconditioner
+    # and residual of the pressure solve, starting from the pressure of the previous substep
+    if ti.static(isGatherP2G):
+        sortParticles(sortInterval)
+    clearGrid()
+    particleToGrid(dt)
+    updateGrid(dt)
+    for I in ti.grouped(cgForce):
+        cgForce[I] = wallProjection(I, vtdt_I[I])
+        cgResidual[I] = 0
+        cgDiagonal[I] = 0
+    gatherDivergence(cgForce, cgResidual)
+    for p in xtdt_p: # Jacobi diagonal of the particle Laplacian sum_p V_p / rho_p |grad Psi_J|^2, which G^T M^-1 G approximates
+        if not isActive(p):
+            continue
+        base, _, dPsi_I = particleShapeFunctions(p)
+        for s in ti.static(range(numStencil)):
+            cgDiagonal[base + ti.Vector(ti.static(stencil[s]))] += pressureGamma * dt**2 * volumet_p[p]**2 / mt_p[p] * shapeGradient(dPsi_I, s).norm_sqr()
+    cgBB[None] = 0
+    for I in ti.grouped(cgResidual):
+        if volumet_I[I] > 0 and (massDiagonal(mt_I[I]) != 0).all():
+            cgDiagonal[I] += volumet_I[I] / kappa
+            cgResidual[I] = volumet_I[I] * pt_I[I] / kappa - dt * cgResidual[I]
+            cgPressure[I] = pt_I[I]
+            cgBB[None] += cgResidual[I]**2
+        else:
+            cgDiagonal[I] = 0
+            cgResidual[I] = 0
+            cgPressure[I] = 0
+    applyPressureOperator(cgPressure, cgProduct, dt)
+    cgRZ[None] = 0
+    cgRR[None] = 0
+    for I in ti.grouped(cgResidual):
+        if cgDiagonal[I] > 0:
+            cgResidual[I] -= cgProduct[I]
+            cgDirection[I] = cgResidual[I] / cgDiagonal[I]
+            cgRZ[None] += cgResidual[I] * cgDirection[I]
+            cgRR[None] += cgResidual[I]**2
+        else:
+            cgDirection[I] = 0
+
+@ti.kernel
+def iterateCG(dt: ti.f64):
+    # One Jacobi-preconditioned CG iteration on cgPressure
+    applyPressureOperator(cgDirection, cgProduct, dt)
+    cgAlpha[None] = 0
+    for I in ti.grouped(cgDirection):
+        cgAlpha[None] += cgDirection[I] * cgProduct[I]
+    cgAlpha[None] = cgRZ[None] / cgAlpha[None]
+    rz = cgRZ[None]
+    cgRZ[None] = 0
+    cgRR[None] = 0
+    for I in ti.grouped(cgResidual):
+        if cgDiagonal[I] > 0:
+            cgPressure[I] += cgAlpha[None] * cgDirection[I]
+            cgResidual[I] -= cgAlpha[None] * cgProduct[I]
+            cgRZ[None] += cgResidual[I]**2 / cgDiagonal[I]
+            cgRR[None] += cgResidual[I]**2
+    cgBeta = cgRZ[None] / rz
+    for I in ti.grouped(cgDirection):
+        if cgDiagonal[I] > 0:
+            cgDirection[I] = cgResidual[I] / cgDiagonal[I] + cgBeta * cgDirection[I]
+
+@ti.kernel
+def substepCorrect(dt: ti.f64, eta_v: ti.f64, eta_u: ti.f64, eta_p: ti.f64, ifAV: ti.i32):
+    # Grid accelerations and velocities with the solved pressure, then G2P and stress as in substep()
+    for I in ti.grouped(cgForce):
+        cgForce[I] = ti.Vector.zero(ti.f64, dim)
+    scatterPressureForce(cgPressure)
+    for I in ti.grouped(mt_I):
+        ptdt_I[I] = cgPressure[I]
+        if (massDiagonal(mt_I[I]) != 0).all():
+            atdt_I[I] += wallProjection(I, solveMass(mt_I[I], wallProjection(I, cgForce[I])))
+            integrateNode(I, dt)
+    gridToParticle(dt, eta_v, eta_u, eta_p)
+    updateStress(dt, ifAV)
+
+pressureSolveHistory = [] # rows of [dt, CG iterations, relative residual] of every semi-implicit substep
+
+def solvePressure(dt):
+    # CG iterations until |r| <= cgTolerance |b| or cgMaxIterations; the residual is read back after every iteration
+    bb = cgBB[None]
+    iterations, residual = 0, (np.sqrt(cgRR[None] / bb) if bb > 0 else 0.0)
+    while residual > cgTolerance and iterations < cgMaxIterations:
+        iterateCG(dt)
+        iterations += 1
+        residual = np.sqrt(cgRR[None] / bb)
+    pressureSolveHistory.append([dt, iterations, residual])
+
+def substepSemiImplicit(dt, eta_v, eta_u, eta_p, ifAV):
+    # substep() with the pressure solved on the grid; launched from Python, which drives the CG iterations
+    substepPredict(dt)
+    solvePressure(dt)
+    substepCorrect(dt, eta_v, eta_u, eta_p, ifAV)
+
+if isImplicitPressure:
+    substep = substepSemiImplicit
+
+# substep() phase by phase, for the profiler (isProfiled); the same offloaded loops in the same order as the single kernel
+@ti.kernel
+def sortPhase():
+    sortParticles(sortInterval)
+
+@ti.kernel
+def clearPhase():
+    clearGrid()
+
+@ti.kernel
+def particleToGridPhase(dt: ti.f64):
+    particleToGrid(dt)
+
+@ti.kernel
+def updateGridPhase(dt: ti.f64):
+    updateGrid(dt)
+
+@ti.kernel
+def gridToParticlePhase(dt: ti.f64, eta_v: ti.f64, eta_u: ti.f64, eta_p: ti.f64):
+    gridToParticle(dt, eta_v, eta_u, eta_p)
+
+@ti.kernel
+def updateStressPhase(dt: ti.f64, ifAV: ti.i32):
+    updateStress(dt, ifAV)
+
+profiler = PhaseProfiler()
+
+def substepProfiled(dt, eta_v, eta_u, eta_p, ifAV):
+    # substep() with every phase timed; the penalty EBC is assembled once (assemblePenaltyBC), its per-substep copy is part of "clear"
+    if isImplicitPressure: # its clear, P2G and grid update are one kernel, as is its correction, G2P and stress
+        with profiler.phase("predict"):
+            substepPredict(dt)
+        with profiler.phase("pressure solve"):
+            solvePressure(dt)
+        with profiler.phase("correct"):
+            substepCorrect(dt, eta_v, eta_u, eta_p, ifAV)
+        return
+    if isGatherP2G:
+        with profiler.phase("sort"):
+            sortPhase()
+    with profiler.phase("clear"):
+        clearPhase()
+    with profiler.phase("P2G"):
+        particleToGridPhase(dt)
+    with profiler.phase("grid update"):
+        updateGridPhase(dt)
+    with profiler.phase("G2P"):
+        gridToParticlePhase(dt, eta_v, eta_u, eta_p)
+    with profiler.phase("stress"):
+        updateStressPhase(dt, ifAV)
+
+if isProfiled:
+    substep = substepProfiled
+
 x_pos1 = ti.field(dtype=ti.f64, shape=(np_x, np_y))
 y_pos1 = ti.field(dtype=ti.f64, shape=(np_x, np_y))
 
@@ -515,15 +1200,28 @@ def initialize_Cubes():
         x_pos1[a,b] = (a/(np_x - 1))*W_fluid + 2*dx + (len_domain-W_fluid)
         y_pos1[a,b] = (b/(np_y - 1))*H_fluid + 2*dx
         
-    for i in range(num_p):
+    for slot in range(numInitialParticles):
+        i = slot + firstParticle
         col = i - np_x * ( i // np_x )
         row = i // np_x
-        xtdt_p[i] = [x_pos1[col,row], y_pos1[col,row]] # xtdt_p[i] = [ ti.random() * Liquid_Width + 2 * dx, ti.random() * Liquid_Height + 2 * dx]       # Random distribution
-        vtdt_p[i] = [0, 0] # vtdt_p[i] = ti.Matrix([[ti.cos(ti.math.pi), -ti.sin(ti.math.pi)], [ti.sin(ti.math.pi), ti.cos(ti.math.pi)]]) @ xt_p[i] / dt
-        mt_p[i] = volume0_p * rho
-        material[i] = 0
-        volumet_p[i] = volume0_p
-        Ft_p[i] = ti.Matrix([[1.0, 0.0], [0.0, 1.0]])
+        if ti.static(ensembleSize > 1): # fluid of the case's size in the case's grid tile
+            b = i // num_p
+            row -= np_y * b
+            xtdt_p[slot] = [(col/(np_x - 1))*W_fluid_b[b] + 2*dx + (len_domain-W_fluid_b[b]) + b*num_g*dx, (row/(np_y - 1))*H_fluid_b[b] + 2*dx]
+        elif ti.static(dim == 3): # layer by layer of np_x * np_y particles, against the far wall in z
+            layer = i // (np_x * np_y)
+            row -= np_y * layer
+            xtdt_p[slot] = [x_pos1[col,row], y_pos1[col,row], (layer/(np_z - 1))*D_fluid + 2*dx + (len_domain-D_fluid)]
+        else:
+            xtdt_p[slot] = [x_pos1[col,row], y_pos1[col,row]] # xtdt_p[i] = [ ti.random() * Liquid_Width + 2 * dx, ti.random() * Liquid_Height + 2 * dx]       # Random distribution
+        vtdt_p[slot] = ti.Vector.zero(ti.f64, dim) # vtdt_p[i] = ti.Matrix([[ti.cos(ti.math.pi), -ti.sin(ti.math.pi)], [ti.sin(ti.math.pi), ti.cos(ti.math.pi)]]) @ xt_p[i] / dt
+        mt_p[slot] = caseValue(volume0_p, volume0_b, i) * caseValue(rho, rho_b, i)
+        material[slot] = 0
+        volumet_p[slot] = caseValue(volume0_p, volume0_b, i)
+        Ft_p[slot] = ti.Matrix.identity(ti.f64, dim)
+        detF[slot] = 1.0
+    for slot in range(numInitialParticles, particleCapacity): # empty slots of a decomposed run
+        material[slot] = -1
     
     for i in x_L_left:
         x_L_left[i] = [2 * dx, (2.5 + i) * dx]
@@ -532,14 +1230,11 @@ def initialize_Cubes():
         x_L_top[i] = [(2.5 + i) * dx, len_domain + 2 * dx]
         
 # ------------------------------------
+setEnsembleParameters(ensembleParameters)
 initialize_Cubes()
-
-# GUI setup
-gui = ti.GUI("Window Title", res=512, show_gui=False, background_color=0xFFFFFF)
-
-# Ensure output directories exist
-os.makedirs(filepath, exist_ok=True)
-os.makedirs(vtkpath, exist_ok=True)
+rankColumns.from_numpy(np.array([0, ensembleSize * num_g], dtype=np.int32)) # the whole grid until decomposition.py sets the slab
+if isPenaltyBC_elseBruteforceBC:
+    assemblePenaltyBC()
 
 # Define the progress bar function
 def progressBar(progress, total, color=colorama.Fore.YELLOW):
@@ -552,125 +1247,312 @@ def progressBar(progress, total, color=colorama.Fore.YELLOW):
         print(colorama.Fore.GREEN + f"\r|{bar}| {percentage:.2f}%" + " | It's done! | Current time: " + str(progress), end="\r")
         print(colorama.Fore.RED)
 
-# Initialize simulation variables
-# pressureCheck = []
-count = 0
-# pressureCount = 0
+substepArgs = [('dt', ti.f64), ('eta_v', ti.f64), ('eta_u', ti.f64), ('eta_p', ti.f64), ('ifAV', ti.i32)] # runtime scalar arguments of substep()
 
-T_values = []
-L_values = []
-H_values = []
+def getSubstepArgs(dt):
+    # Current values of substep()'s runtime parameters, with timestep dt
+    return dt, eta_v, eta_u, eta_p, ifAV
 
-# Run simulation loop
-while timeTotal < simTime:
-    # pressureCount = 0
-    num_substeps = int(1e-2 // dt)
-    
-    # Combine data operations where possible
-    xtdt_p_np = xtdt_p.to_numpy()
-    vtdt_p_np = vtdt_p.to_numpy()
-    sigma_np = sigma.to_numpy()
-    PartitionOfUnity_np = PartitionOfUnity.to_numpy()
-    Cons_np = Cons.to_numpy()
-    Cons_dx_np = Cons_dx.to_numpy()
-    Cons_dy_np = Cons_dy.to_numpy()
-    atdt_p_np = atdt_p.to_numpy()
-    detF_np = detF.to_numpy()
-    material_np = material.to_numpy()
-    
-    for s in range(num_substeps):  # Sub-steps
-        substep()
-        count += 1
-        timeTotal += dt
+maxSpeed = ti.field(dtype=ti.f64, shape=())
 
-    l_T = np.max(xtdt_p_np[:, 0]) - np.min(xtdt_p_np[:, 0])
-    h_T = np.max(xtdt_p_np[:, 1]) - np.min(xtdt_p_np[:, 1])
-    
+@ti.kernel
+def getCFLTimeStep() -> ti.f64:
+    maxSpeed[None] = 0
+    for p in vtdt_p:
+        if isActive(p):
+            ti.atomic_max(maxSpeed[None], vtdt_p[p].norm())
+    speed = maxSpeed[None] # convective speed
+    if ti.static(not isImplicitPressure): # + acoustic speed of the explicit pressure
+        speed += ti.sqrt(kappa / rho)
+    return CFL * dx / speed
+
+diagnosticNames = ["xMin", "xMax", "yMin", "yMax", "Kinetic Energy", "Potential Energy", "Mass", "Volume", "Max Speed"]
+diagnostics = ti.field(dtype=ti.f64, shape=(ensembleSize, len(diagnosticNames))) # per ensemble case
+diagnosticsHistory = [] # rows of [timeTotal] + diagnostics (of case 0 in an ensemble)
+
+@ti.kernel
+def computeDiagnostics():
+    # Parallel reductions over the particles; only these few scalars leave the device
+    for b in range(ensembleSize):
+        for k in ti.static(range(len(diagnosticNames))):
+            diagnostics[b, k] = 1e30 if ti.static(k in (0, 2)) else (-1e30 if ti.static(k in (1, 3)) else 0.0)
+    for p in xtdt_p:
+        if not isActive(p):
+            continue
+        b = p // num_p
+        ti.atomic_min(diagnostics[b, 0], xtdt_p[p][0])
+        ti.atomic_max(diagnostics[b, 1], xtdt_p[p][0])
+        ti.atomic_min(diagnostics[b, 2], xtdt_p[p][1])
+        ti.atomic_max(diagnostics[b, 3], xtdt_p[p][1])
+        speed = vtdt_p[p].norm()
+        diagnostics[b, 4] += 0.5 * mt_p[p] * speed**2
+        diagnostics[b, 5] += mt_p[p] * (-a_g) * (xtdt_p[p][1] - 2 * dx) # above the tank floor
+        diagnostics[b, 6] += mt_p[p]
+        diagnostics[b, 7] += volumet_p[p]
+        ti.atomic_max(diagnostics[b, 8], speed)
+
+def recordDiagnostics(timeTotal):
+    # Diagnostics at timeTotal, reused if already taken at this time
+    if not diagnosticsHistory or diagnosticsHistory[-1][0] != timeTotal:
+        computeDiagnostics()
+        diagnosticsHistory.append([timeTotal] + diagnostics.to_numpy()[0].tolist())
+    return dict(zip(diagnosticNames, diagnosticsHistory[-1][1:]))
+
+def getWaterColumn(timeTotal, diag, W_fluid=W_fluid, H_fluid=H_fluid):
+    # Dimensionless time T, surge front L(T) and column height H(T) from the diagnostics
     T = timeTotal * np.sqrt(H_fluid * (-a_g) / (W_fluid**2))
-    L = l_T / W_fluid
-    H = h_T / H_fluid
-    
-    T_values.append(T)
-    L_values.append(L)
-    H_values.append(H)
-
-    # Collect data
-    # ptdt_array = ptdt_I.to_numpy()
-    # mid_x = (ptdt_array.shape[0] - 1) // 2
-    # mid_y = (ptdt_array.shape[1] - 1) // 2
-    # pressureCheck.append(ptdt_array[mid_x, mid_y])
-    print('Current Time: ', timeTotal)
-    
-    # Prepare data for VTK and visualization
-    xCoordinate = np.ascontiguousarray(xtdt_p_np[:, 0])
-    yCoordinate = np.ascontiguousarray(xtdt_p_np[:, 1])
-    zCoordinate = np.ascontiguousarray(np.zeros(num_p))
-    v_x = np.ascontiguousarray(vtdt_p_np[:, 0])
-    v_y = np.ascontiguousarray(vtdt_p_np[:, 1])
-    v_z = np.ascontiguousarray(np.zeros(num_p))
-    pressure = np.ascontiguousarray(-(sigma_np[:, 0, 0] + sigma_np[:, 1, 1]) / 3)
-
-    sigma_11 = np.ascontiguousarray(sigma_np[:, 0, 0])
-    sigma_22 = np.ascontiguousarray(sigma_np[:, 1, 1])
-    sigma_12 = np.ascontiguousarray(sigma_np[:, 0, 1])
-
-    PoU = np.ascontiguousarray(PartitionOfUnity_np[:] - 1.0)
-    Consistency = np.ascontiguousarray(Cons_np[:])
-    Consistency_Gradx = np.ascontiguousarray(Cons_dx_np[:])
-    Consistency_Grady = np.ascontiguousarray(Cons_dy_np[:])
-    accDisplay_y = np.ascontiguousarray(atdt_p_np[:, 1])
-
-    # Calculate vp_mag_step
-    vp_mag_step = np.ascontiguousarray(np.sqrt(v_x**2 + v_y**2 + v_z**2))
-
-    # Save data to VTK less frequently
-    if count % (num_substeps) == 0:  # Save every 100th frame (adjust as needed)
-        pointsToVTK(
-            f'./{vtkpath}/points{gui.frame:06d}',
-            xCoordinate, yCoordinate, zCoordinate,
-            data={
-                "ID": np.ascontiguousarray(material_np),
-                "simgaxx": sigma_11,
-                "simgayy": sigma_22,
-                "simgaxy": sigma_12,
-                "v_x": v_x,
-                "v_y": v_y,
-                "v_z": v_z,
-                "Pressure": pressure,
-                "Partition of Unity": PoU,
-                "Consistency": Consistency,
-                "Gradx Consistency": Consistency_Gradx,
-                "Grady Consistency": Consistency_Grady,
-                "Deformation": np.ascontiguousarray(detF_np),
-                "Velocity Mag": vp_mag_step,
-                "Acceleration Y": accDisplay_y
-            }
-        )
-
-    # Render GUI less frequently
+    L = (diag["xMax"] - diag["xMin"]) / W_fluid
+    H = (diag["yMax"] - diag["yMin"]) / H_fluid
+    return T, L, H
+
+def isDiagnosticsSubstep(count):
+    return diagnosticsInterval > 0 and count % diagnosticsInterval == 0
+
+def advanceFixed(timeTotal, count, num_substeps):
+    # num_substeps of dt, pausing every diagnosticsInterval-th substep (counted over the whole run) for the diagnostics
+    while num_substeps > 0:
+        n = num_substeps if diagnosticsInterval <= 0 else min(num_substeps, diagnosticsInterval - count % diagnosticsInterval)
+        substepLauncher.advance(n, *getSubstepArgs(dt))
+        for s in range(n):
+            timeTotal += dt
+        count += n
+        num_substeps -= n
+        if isDiagnosticsSubstep(count):
+            recordDiagnostics(timeTotal)
+    return timeTotal, count
+
+def advanceAdaptive(timeTotal, count, frameEndTime):
+    # Substeps of CFL-limited dt from timeTotal up to exactly frameEndTime
+    dtHistory = []
+    while timeTotal < frameEndTime:
+        dt_n = min(max(getCFLTimeStep(), dtMin), dtMax)
+        remaining = frameEndTime - timeTotal
+        if remaining <= dt_n:
+            dt_n = remaining
+        elif remaining < 2 * dt_n:
+            dt_n = 0.5 * remaining # avoid a sliver step at the end of the frame
+        substep(*getSubstepArgs(dt_n))
+        timeTotal = frameEndTime if dt_n == remaining else timeTotal + dt_n
+        dtHistory.append(dt_n)
+        count += 1
+        if isDiagnosticsSubstep(count):
+            recordDiagnostics(timeTotal)
+    return timeTotal, count, dtHistory
+
+substepLauncher = SubstepLauncher(substep, substepsPerLaunch, scalarArgs=substepArgs)
+
+# Exportable quantities: name -> (fields copied to the host, data computed from their host copies h)
+particleOutputs = {
+    "ID": (["material"], lambda h: h["material"]),
+    "simgaxx": (["sigma"], lambda h: h["sigma"][:, 0, 0]),
+    "simgayy": (["sigma"], lambda h: h["sigma"][:, 1, 1]),
+    "simgaxy": (["sigma"], lambda h: h["sigma"][:, 0, 1]),
+    "v_x": (["vtdt_p"], lambda h: h["vtdt_p"][:, 0]),
+    "v_y": (["vtdt_p"], lambda h: h["vtdt_p"][:, 1]),
+    "v_z": (["vtdt_p"], lambda h: h["vtdt_p"][:, 2] if dim == 3 else np.zeros(len(h["vtdt_p"]))),
+    "Pressure": (["sigma"], lambda h: -np.trace(h["sigma"], axis1=1, axis2=2) / 3),
+    "Partition of Unity": (["PartitionOfUnity"], lambda h: h["PartitionOfUnity"] - 1.0),
+    "Consistency": (["Cons"], lambda h: h["Cons"]),
+    "Gradx Consistency": (["Cons_dx"], lambda h: h["Cons_dx"]),
+    "Grady Consistency": (["Cons_dy"], lambda h: h["Cons_dy"]),
+    "Deformation": (["detF"], lambda h: h["detF"]),
+    "Velocity Mag": (["vtdt_p"], lambda h: np.linalg.norm(h["vtdt_p"], axis=1)),
+    "Acceleration Y": (["atdt_p"], lambda h: h["atdt_p"][:, 1]),
+    "Point Pressure": (["ptdt_p"], lambda h: h["ptdt_p"]),
+    "Density": (["rho_p"], lambda h: h["rho_p"]),
+    "Divergence": (["divvt_p"], lambda h: h["divvt_p"]),
+    "Free Surface": (["freeSurface_p"], lambda h: h["freeSurface_p"]),
+    "Smoothed Density": (["rhoSmoothed_p"], lambda h: h["rhoSmoothed_p"]),
+}
+if dim == 3: # the z gradient check, written next to the x and y ones
+    particleOutputs["Gradz Consistency"] = (["Cons_dz"], lambda h: h["Cons_dz"])
+    if "Grady Consistency" in particleOutput:
+        particleOutput.insert(particleOutput.index("Grady Consistency") + 1, "Gradz Consistency")
+def gridVector(a):
+    # x, y, z components of a grid vector field for VTK (z = 0 in 2D)
+    return tuple(a[..., d] for d in range(dim)) + (np.zeros_like(a[..., 0]),) * (3 - dim)
+
+gridOutputs = {
+    "Pressure": (["ptdt_I"], lambda h: h["ptdt_I"]),
+    "Velocity": (["vtdt_I"], lambda h: gridVector(h["vtdt_I"])),
+    "Acceleration": (["atdt_I"], lambda h: gridVector(h["atdt_I"])),
+    "Mass": (["mt_I"], lambda h: h["mt_I"].reshape(h["mt_I"].shape[:dim] + (-1,))[..., 0]), # [0, 0] of the full or diagonal mass
+    "Volume": (["volumet_I"], lambda h: h["volumet_I"]),
+}
+
+# Particle state carried from one substep to the next (grid fields are rebuilt every substep)
+checkpointFields = ["xtdt_p", "vtdt_p", "Lt_p", "Ft_p", "sigma", "atdt_p", "utdt_p", "Delta_utdt_p", "ptdt_p", "pt_p",
+                    "divvt_p", "volumet_p", "mt_p", "material", "detF", "rho_p"]
+
+consistencyFields = ["PartitionOfUnity", "Cons", "Cons_dx", "Cons_dy"] + (["Cons_dz"] if dim == 3 else []) # written by writeConsistency()
+neighbourhoodFields = ["freeSurface_p", "rhoSmoothed_p"] # written by updateNeighbourhoods()
+
+def getOutputFields():
+    # Fields to copy to the host on output frames: positions (points, PNG) and those of the selected quantities
+    names = ["xtdt_p"]
+    names += [name for q in particleOutput for name in particleOutputs[q][0]]
+    names += [name for q in gridOutput for name in gridOutputs[q][0]]
+    return list(dict.fromkeys(names))
+
+def writeFrame(snapshot, gui):
+    # VTK point (and grid) data and PNG of one frame, or the frame appended to frameSeries; called on the FrameWriter thread
+    xtdt_p_np = snapshot["xtdt_p"]
+    if frameFormat == "series":
+        frameSeries.append(gui.frame, {"position": xtdt_p_np, **{q: particleOutputs[q][1](snapshot) for q in particleOutput}},
+                           {q: gridOutputs[q][1](snapshot) for q in gridOutput}, snapshot["scalars"])
+        gui.frame += 1 # as gui.show() does
+        return
+
+    pointsToVTK(
+        f'./{vtkpath}/points{gui.frame:06d}',
+        np.ascontiguousarray(xtdt_p_np[:, 0]), np.ascontiguousarray(xtdt_p_np[:, 1]), np.ascontiguousarray(xtdt_p_np[:, 2]) if dim == 3 else np.zeros(len(xtdt_p_np)),
+        data={q: np.ascontiguousarray(particleOutputs[q][1](snapshot)) for q in particleOutput}
+    )
+    if gridOutput:
+        def toImage(a): # (num_g, num_g) -> (num_g, num_g, 1); 3D grids as they are
+            return np.ascontiguousarray(a[..., None] if dim == 2 else a)
+        gridData = {}
+        for q in gridOutput:
+            data = gridOutputs[q][1](snapshot)
+            gridData[q] = tuple(toImage(c) for c in data) if isinstance(data, tuple) else toImage(data)
+        imageToVTK(f'./{vtkpath}/grid{gui.frame:06d}', origin=(0.0, 0.0, 0.0), spacing=(dx, dx, dx), pointData=gridData)
+
+    # Render GUI
     # if count % (num_substeps) == 0:  # Render every 100th frame (adjust as needed)
     #     colors = np.array([0x000000] * len(material_np), dtype=np.uint32)  # Set all particles to black
     #     gui.circles(xtdt_p_np, radius=0.8, color=colors)
     #     gui.show(filepath + f'/{gui.frame:06d}.png')
-    if count % (num_substeps) == 0:  # Render every 100th frame (adjust as needed)
-        colors = np.array([0x000000] * len(material_np), dtype=np.uint32)
-        
-        # Scale coordinates to fit the 1 by 1 window
-        scaled_xtdt_p_np = xtdt_p_np / 0.5  # Scaling the coordinates
-        
-        gui.circles(scaled_xtdt_p_np, radius=0.8, color=colors)
-        gui.show(filepath + f'/{gui.frame:06d}.png')
-
-# Save runtime
-time1 = time.time()
-print('Run Time:', time1 - time0)
-
-# Save T, L(T), and H(T) to CSV using pandas
-data = {
-    "T": T_values,
-    "L(T)": L_values,
-    "H(T)": H_values
-}
-df = pd.DataFrame(data)
-csv_name = f"water_column_{vtkpath}_data.csv"
-df.to_csv(csv_name, index=False)
\ No newline at end of file
+    colors = np.array([0x000000] * len(xtdt_p_np), dtype=np.uint32)
+
+    # Scale coordinates to fit the 1 by 1 window
+    scaled_xtdt_p_np = xtdt_p_np[:, :2] / 0.5  # Scaling the coordinates (x-y projection in 3D)
+
+    gui.circles(scaled_xtdt_p_np, radius=0.8, color=colors)
+    gui.show(filepath + f'/{gui.frame:06d}.png')
+
+
+if __name__ == "__main__":
+    if consistencyChecks == "off": # the checks are never computed, so do not write their fields
+        particleOutput = [q for q in particleOutput if not set(particleOutputs[q][0]) & set(consistencyFields)]
+
+    budget = memoryBudget()
+    print(f'{dim}D, {budget["particles"]} particles, {budget["nodes"]} grid nodes: {sum(budget["bytes"].values()) / 2**20:.1f} MiB of fields'
+          f' ({budget["bytesPerParticle"]:.0f} B/particle, {budget["bytesPerNode"]:.0f} B/node)')
+
+    # GUI setup
+    gui = ti.GUI("Window Title", res=512, show_gui=False, background_color=0xFFFFFF)
+
+    # Ensure output directories exist
+    os.makedirs(filepath, exist_ok=True)
+    os.makedirs(vtkpath, exist_ok=True)
+    frameWriter = FrameWriter({name: globals()[name] for name in getOutputFields()}, lambda snapshot: writeFrame(snapshot, gui), numBuffers=numOutputBuffers)
+
+    # Initialize simulation variables
+    # pressureCheck = []
+    count = 0
+    frame = 0
+    # pressureCount = 0
+
+    T_values = []
+    L_values = []
+    H_values = []
+
+    def recordFrame():
+        # L(T), H(T) from the on-device diagnostics; output fields are copied to the host only on output frames
+        T, L, H = getWaterColumn(timeTotal, recordDiagnostics(timeTotal))
+
+        T_values.append(T)
+        L_values.append(L)
+        H_values.append(H)
+
+        if frame % framesPerOutput == 0: # Save and render every framesPerOutput-th frame (adjust as needed)
+            if consistencyChecks == "output":
+                computeConsistency()
+            if set(neighbourhoodFields) & set(frameWriter.fields):
+                updateNeighbourhoods()
+            snapshot = frameWriter.snapshot()
+            snapshot["scalars"] = {"time": timeTotal, "T": T, "L(T)": L, "H(T)": H}
+            frameWriter.submit(snapshot)
+
+    def saveCheckpoint():
+        # After the frame's output is on disk, so a resumed run never skips a VTK/PNG frame
+        frameWriter.flush()
+        state = {"timeTotal": timeTotal, "count": count, "frame": frame,
+                 "T_values": T_values, "L_values": L_values, "H_values": H_values,
+                 "diagnosticsHistory": np.array(diagnosticsHistory).reshape(-1, len(diagnosticNames) + 1),
+                 "pressureSolveHistory": np.array(pressureSolveHistory).reshape(-1, 3),
+                 "profileRows": json.dumps(profiler.rows)} # rows of dicts, stored as JSON text
+        save_checkpoint(checkpointPath, count, {name: globals()[name] for name in checkpointFields}, state, keep=checkpointsKept)
+
+    if isResume:
+        state = load_checkpoint(checkpointPath, {name: globals()[name] for name in checkpointFields})
+        timeTotal, count, frame = state["timeTotal"], state["count"], state["frame"]
+        T_values, L_values, H_values = list(state["T_values"]), list(state["L_values"]), list(state["H_values"])
+        diagnosticsHistory[:] = state["diagnosticsHistory"].tolist()
+        pressureSolveHistory[:] = state["pressureSolveHistory"].tolist()
+        profiler.rows = json.loads(state["profileRows"])
+        gui.frame = frame // framesPerOutput + 1 # continue the VTK/PNG numbering
+    if frameFormat == "series": # a resumed run drops the frames written after its checkpoint
+        frameSeries = TimeSeriesWriter(f'./{vtkpath}/frames', seriesCompression, seriesDowncast, attributes={"dx": dx, "dim": dim}, startFrame=gui.frame)
+    if not isResume:
+        recordFrame() # initial state
+
+    # Run simulation loop
+    while timeTotal < simTime:
+        # pressureCount = 0
+        num_substeps = int(frameRate // dt)
+
+        if isAdaptiveTimeStep:
+            timeTotal, count, dtHistory = advanceAdaptive(timeTotal, count, (frame + 1) * frameRate) # frames land exactly on multiples of frameRate
+            num_substeps = len(dtHistory)
+        else:
+            timeTotal, count = advanceFixed(timeTotal, count, num_substeps)  # Sub-steps
+        frame += 1
+
+        # Collect data
+        # ptdt_array = ptdt_I.to_numpy()
+        # mid_x = (ptdt_array.shape[0] - 1) // 2
+        # mid_y = (ptdt_array.shape[1] - 1) // 2
+        # pressureCheck.append(ptdt_array[mid_x, mid_y])
+        if isAdaptiveTimeStep:
+            print('Current Time: ', timeTotal, '| substeps:', num_substeps, f'| dt: min {min(dtHistory):.3e}, mean {(frameRate / num_substeps):.3e}, max {max(dtHistory):.3e}')
+        else:
+            print('Current Time: ', timeTotal)
+        if isProfiled:
+            print(profiler.endFrame(frame)[1])
+        if isImplicitPressure:
+            solves = np.array(pressureSolveHistory[-num_substeps:])
+            print(f'CG iterations: mean {solves[:, 1].mean():.1f}, max {solves[:, 1].max():.0f} | relative residual: max {solves[:, 2].max():.1e}')
+
+        recordFrame()
+        if checkpointInterval > 0 and frame % checkpointInterval == 0:
+            saveCheckpoint()
+
+    frameWriter.close()
+    if frameFormat == "series":
+        frameSeries.close()
+
+    # Save runtime
+    time1 = time.time()
+    print('Run Time:', time1 - time0)
+
+    # Save T, L(T), and H(T) to CSV using pandas
+    data = {
+        "T": T_values,
+        "L(T)": L_values,
+        "H(T)": H_values
+    }
+    df = pd.DataFrame(data)
+    csv_name = f"water_column_{vtkpath}_data.csv"
+    df.to_csv(csv_name, index=False)
+
+    # Diagnostics time series (every diagnosticsInterval substeps and at every frame)
+    df = pd.DataFrame(diagnosticsHistory, columns=["Time"] + diagnosticNames)
+    df.to_csv(f"diagnostics_{vtkpath}_data.csv", index=False)
+
+    if isImplicitPressure: # CG iterations and final relative residual of the pressure solve of every substep
+        df = pd.DataFrame(pressureSolveHistory, columns=["dt", "CG Iterations", "Relative Residual"])
+        df.to_csv(f"pressure_solve_{vtkpath}_data.csv", index_label="Substep")
+
+    if isProfiled: # min/mean/p99 of every substep phase per frame
+        profiler.write(f"profile_{vtkpath}_data")
@@ -0,0 +1,77 @@
+"""Memory and throughput of the 3D dam-break, projected to millions of particles.
+
+    python benchmarks/bench_3d.py --np-x 9 13 17 --substeps 20 --project 1e6 4e6
+
+Every particle count (np_x x 2*np_x x np_x particles) runs in its own process
+with DAMBREAK_DIM=3 (the field shapes are fixed at import). Reports the field
+memory of memoryBudget() by group, the peak resident memory of the process,
+substeps/s and particle-updates/s (particles x substeps/s). The substep time
+is fitted as fixed + per-particle cost (the grid clear and update do not
+depend on the particle count) and, with the per-particle memory, projected to
+the --project particle counts on the same grid. Runs on the CPU backend
+unless TI_ARCH is set (e.g. TI_ARCH=cuda, see workers.py).
+"""
+import argparse
+import resource
+import time
+
+import numpy as np
+
+import workers
+
+
+def runWorker(numSubsteps):
+    import taichi as ti
+    damBreak = workers.importDamBreak()
+
+    damBreak.substepLauncher.advance(1, *damBreak.getSubstepArgs(damBreak.dt))  # compile outside the timing
+    ti.sync()
+    t0 = time.perf_counter()
+    damBreak.substepLauncher.advance(numSubsteps, *damBreak.getSubstepArgs(damBreak.dt))
+    ti.sync()
+    elapsed = time.perf_counter() - t0
+    x = damBreak.xtdt_p.to_numpy()
+    workers.report({**damBreak.memoryBudget(), "substepsPerSecond": numSubsteps / elapsed, "isFinite": bool(np.isfinite(x).all()),
+                    "peakRSS": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024})  # ru_maxrss in KiB on Linux
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--np-x", type=int, nargs="+", default=[9, 13, 17])
+    parser.add_argument("--substeps", type=int, default=20)
+    parser.add_argument("--project", type=float, nargs="+", default=[1e6, 4e6], help="particle counts to project to")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        runWorker(args.substeps)
+        return
+
+    results = []
+    print(f"{'particles':>10s} {'grid [MiB]':>11s} {'particles [MiB]':>16s} {'B/particle':>11s} {'peak RSS [MiB]':>15s}"
+          f" {'substeps/s':>11s} {'particle-updates/s':>19s}")
+    for np_x in args.np_x:
+        result = workers.runWorker(__file__, ["--substeps", args.substeps, "--worker"], env={"DAMBREAK_DIM": "3", "DAMBREAK_NP_X": str(np_x)})
+        if not result["isFinite"]:
+            raise RuntimeError(f"np_x = {np_x}: non-finite particle positions")
+        results.append(result)
+        particleBytes = sum(v for name, v in result["bytes"].items() if name != "grid")
+        print(f"{result['particles']:10d} {result['bytes']['grid'] / 2**20:11.1f} {particleBytes / 2**20:16.1f} {result['bytesPerParticle']:11.0f}"
+              f" {result['peakRSS'] / 2**20:15.1f} {result['substepsPerSecond']:11.2f} {result['particles'] * result['substepsPerSecond']:19.3e}")
+
+    particles = np.array([r["particles"] for r in results], dtype=float)
+    seconds = np.array([1 / r["substepsPerSecond"] for r in results])
+    if len(results) > 1:
+        perParticle, fixed = np.polyfit(particles, seconds, 1)
+    else:
+        perParticle, fixed = seconds[0] / particles[0], 0.0
+    perParticle = max(perParticle, 0.0)
+    gridBytes, bytesPerParticle = results[-1]["bytes"]["grid"], results[-1]["bytesPerParticle"]
+    print(f"\nsubstep = {fixed * 1e3:.2f} ms + {perParticle * 1e9:.1f} ns/particle (fit over {len(results)} runs)")
+    print(f"{'particles':>10s} {'fields [GiB]':>13s} {'substeps/s':>11s} {'particle-updates/s':>19s}")
+    for count in args.project:
+        substep = fixed + perParticle * count
+        print(f"{count:10.3g} {(gridBytes + bytesPerParticle * count) / 2**30:13.2f} {1 / substep:11.2f} {count / substep:19.3e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Strong and weak scaling of the slab domain decomposition (decomposition.py).
+
+    python benchmarks/bench_decomposition.py --ranks 1 2 4 --np-x 65 --substeps 200
+
+Strong scaling runs the same dam-break (np_x x 2*np_x particles) on every
+rank count; weak scaling grows np_x with sqrt(ranks), so that every rank
+keeps about np_x x 2*np_x particles. Each rank gets the cores / ranks CPU
+threads (--threads to fix them), so 1 rank uses the whole machine. The first
+substep compiles and is not timed. The cuts are rebalanced every
+--frame-interval substeps, starting from substep 0. Reports substeps/s,
+particle-updates/s, the speedup and parallel efficiency over 1 rank, the
+share of time spent in the halo exchange and migration (waiting included),
+and the particles of the busiest rank relative to an even share. The final
+particle positions of the strong-scaling runs are compared with those of 1
+rank by particle id. Runs on the CPU backend unless TI_ARCH is set (see workers.py).
+"""
+import argparse
+import math
+import os
+
+import numpy as np
+
+import workers
+import decomposition
+
+
+def runCase(numRanks, np_x, args):
+    os.environ["DAMBREAK_NP_X"] = str(np_x) # inherited by the rank processes
+    results = decomposition.run(numRanks, args.substeps, args.frame_interval, args.threads, isStateReturned=True)
+    seconds = max(r["seconds"] for r in results)
+    particles = sum(r["particles"] for r in results)
+    return {"particles": particles, "substepsPerSecond": results[0]["timedSubsteps"] / seconds,
+            "exchangeShare": max(r["exchangeSeconds"] for r in results) / seconds,
+            "imbalance": max(r["particles"] for r in results) * numRanks / particles,
+            "peakRSS": sum(r["peakRSS"] for r in results), "state": results[0]["state"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ranks", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--np-x", type=int, default=65)
+    parser.add_argument("--substeps", type=int, default=200)
+    parser.add_argument("--frame-interval", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=None, help="CPU threads per rank (default: the cores split evenly)")
+    args = parser.parse_args()
+
+    ranks = sorted(set([1] + args.ranks))
+    header = (f"{'ranks':>5s} {'particles':>10s} {'substeps/s':>11s} {'particle-updates/s':>19s} {'speedup':>8s} {'efficiency':>11s}"
+              f" {'exchange':>9s} {'imbalance':>10s} {'RSS [MiB]':>10s}")
+    for mode in ("strong", "weak"):
+        print(f"\n{mode} scaling, {os.cpu_count()} cores")
+        print(header + (f" {'max |dx| vs 1':>14s}" if mode == "strong" else ""))
+        single = None
+        for numRanks in ranks:
+            np_x = args.np_x if mode == "strong" else round(args.np_x * math.sqrt(numRanks))
+            case = runCase(numRanks, np_x, args)
+            single = single or case
+            rate = case["substepsPerSecond"] * case["particles"] # particle updates per second
+            speedup = rate / (single["substepsPerSecond"] * single["particles"])
+            line = (f"{numRanks:5d} {case['particles']:10d} {case['substepsPerSecond']:11.1f} {rate:19.3e} {speedup:8.2f}"
+                    f" {speedup / numRanks:11.2f} {100 * case['exchangeShare']:8.0f}% {case['imbalance']:10.2f} {case['peakRSS'] / 2**20:10.0f}")
+            if mode == "strong":
+                line += f" {np.max(np.abs(case['state']['xtdt_p'] - single['state']['xtdt_p'])):14.3e}"
+            print(line, flush=True)
+
+
+if __name__ == "__main__":
+    main()
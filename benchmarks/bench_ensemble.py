@@ -0,0 +1,72 @@
+"""Throughput of B dam-breaks in one ensemble vs. B sequential single runs.
+
+    python benchmarks/bench_ensemble.py --sizes 1 2 4 8 --substeps 200
+
+Every ensemble size runs in its own process (DAMBREAK_ENSEMBLE_SIZE fixes the
+field shapes at import). Case 0 keeps the parameters of the script, the other
+cases vary eta_v, visc, kappa and the fluid width. B sequential runs take B
+times as long as the single run, so their throughput in cases x substeps/s is
+that of B = 1. Case 0 of every ensemble is checked against the single run.
+Runs on the CPU backend unless TI_ARCH is set (e.g. TI_ARCH=cuda, see workers.py).
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import workers
+
+
+def runWorker(numSubsteps, statePath):
+    import taichi as ti
+    damBreak = workers.importDamBreak()
+
+    B = damBreak.ensembleSize
+    variation = np.linspace(0, 1, B)
+    damBreak.setEnsembleParameters({
+        "eta_v": 0.5 * variation,
+        "visc": damBreak.visc * (1 + variation),
+        "kappa": damBreak.kappa * (1 + 0.5 * variation),
+        "W_fluid": damBreak.W_fluid * (1 - 0.2 * variation),
+    })
+    damBreak.initialize_Cubes()
+    damBreak.substepLauncher.advance(1, *damBreak.getSubstepArgs(damBreak.dt))  # compile outside the timing
+    ti.sync()
+    t0 = time.perf_counter()
+    damBreak.substepLauncher.advance(numSubsteps, *damBreak.getSubstepArgs(damBreak.dt))
+    ti.sync()
+    elapsed = time.perf_counter() - t0
+    np.save(statePath, damBreak.xtdt_p.to_numpy()[:damBreak.num_p])
+    workers.report({"cases": B, "seconds": elapsed, "caseSubstepsPerSecond": B * numSubsteps / elapsed})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--substeps", type=int, default=200)
+    parser.add_argument("--worker", metavar="STATE.npy", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        runWorker(args.substeps, args.worker)
+        return
+
+    sizes = sorted(set([1] + args.sizes))
+    results, states = {}, {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for B in sizes:
+            statePath = os.path.join(tmp, f"case0_B{B}.npy")
+            results[B] = workers.runWorker(__file__, ["--substeps", args.substeps, "--worker", statePath], env={"DAMBREAK_ENSEMBLE_SIZE": str(B)})
+            states[B] = np.load(statePath)
+
+    single = results[1]["caseSubstepsPerSecond"]
+    print(f"{'B':>4s} {'ensemble [cases x substeps/s]':>30s} {'B sequential':>14s} {'speedup':>8s} {'case 0 max |dx|':>16s}")
+    for B in sizes:
+        rate = results[B]["caseSubstepsPerSecond"]
+        error = np.max(np.abs(states[B] - states[1]))
+        print(f"{B:4d} {rate:30.1f} {single:14.1f} {rate / single:8.2f} {error:16.3e}")
+
+
+if __name__ == "__main__":
+    main()
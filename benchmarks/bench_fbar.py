@@ -0,0 +1,75 @@
+"""Per-substep cost and pressure smoothing of the F-bar stabilization (isFBar).
+
+    python benchmarks/bench_fbar.py --substeps 500 --repeats 3
+
+Runs the dam-break with isFBar off and on, for the mixed and the pointwise
+pressure (isMixedFormulation_elsePointwise), each setting in its own process
+since both are compiled into substep(). The first substep compiles and is not
+timed; the best of --repeats timings of --substeps substeps is reported as
+ms/substep, with the F-bar overhead relative to the same formulation without
+it. The pressure noise is the RMS difference between the particle pressures
+and the mean pressure of their grid cell, relative to the hydrostatic
+pressure rho*|g|*H_fluid at the tank floor. Runs on the CPU backend unless
+TI_ARCH is set (see workers.py).
+"""
+import argparse
+import time
+
+import numpy as np
+
+import workers
+
+
+def pressureNoise(damBreak):
+    x, p = damBreak.xtdt_p.to_numpy(), damBreak.ptdt_p.to_numpy()
+    cells = np.floor(x * damBreak.inv_dx).astype(np.int64)
+    _, cellOf = np.unique(cells, axis=0, return_inverse=True)
+    cellOf = cellOf.ravel()
+    cellMean = np.bincount(cellOf, weights=p) / np.bincount(cellOf)
+    return np.sqrt(np.mean((p - cellMean[cellOf])**2)) / (damBreak.rho * -damBreak.a_g * damBreak.H_fluid)
+
+
+def runWorker(numSubsteps, repeats):
+    import taichi as ti
+    damBreak = workers.importDamBreak()
+    args = damBreak.getSubstepArgs(damBreak.dt)
+    damBreak.substep(*args)
+    ti.sync()
+    seconds = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for _ in range(numSubsteps):
+            damBreak.substep(*args)
+        ti.sync()
+        seconds.append((time.perf_counter() - t0) / numSubsteps)
+    x = damBreak.xtdt_p.to_numpy()
+    workers.report({"substepSeconds": min(seconds), "pressureNoise": pressureNoise(damBreak), "isFinite": bool(np.isfinite(x).all()),
+                    "particles": len(x), "substeps": 1 + repeats * numSubsteps})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--substeps", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        runWorker(args.substeps, args.repeats)
+        return
+
+    print(f"{'pressure':>9s} {'isFBar':>7s} {'ms/substep':>11s} {'overhead':>9s} {'pressure noise':>15s}")
+    for isMixed in (True, False):
+        reference = None
+        for isFBar in (False, True):
+            settings = {"isMixedFormulation_elsePointwise": isMixed, "isFBar": isFBar}
+            result = workers.runWorker(__file__, ["--substeps", args.substeps, "--repeats", args.repeats, "--worker"], settings)
+            if not result["isFinite"]:
+                raise RuntimeError(f"{settings}: non-finite particle positions")
+            reference = reference or result
+            overhead = result["substepSeconds"] / reference["substepSeconds"] - 1
+            print(f"{'mixed' if isMixed else 'pointwise':>9s} {str(isFBar):>7s} {1e3 * result['substepSeconds']:11.3f}"
+                  f" {100 * overhead:8.1f}% {result['pressureNoise']:15.3e}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Cost of writing output frames as VTK files vs. the timeseries.py container.
+
+    python benchmarks/bench_frameOutput.py --substeps 200 --frames 10
+
+Advances the dam-break by --substeps, takes the host copy of the output
+fields as the solver does on an output frame (particleOutput and
+--grid-output quantities), and writes it --frames times in every format:
+the VTK point (and image) files of frameFormat = "vtk" (without the PNG),
+and a container with compression None/"zlib", storing float64 or float32.
+Reports ms/frame, bytes/frame, the time to read one quantity of a random
+frame back, and the round-trip error of the container (0 for float64, the
+largest relative error for float32). Runs on the CPU backend unless TI_ARCH
+is set (see workers.py).
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import taichi as ti
+from pyevtk.hl import pointsToVTK, imageToVTK
+
+import workers
+from timeseries import TimeSeriesWriter, TimeSeriesReader
+
+damBreak = workers.importDamBreak()
+
+
+def directorySize(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def writeVTKFrames(snapshot, directory, numFrames):
+    x = snapshot["xtdt_p"]
+    z = np.ascontiguousarray(x[:, 2]) if damBreak.dim == 3 else np.zeros(len(x))
+    for frame in range(numFrames):
+        data = {q: np.ascontiguousarray(damBreak.particleOutputs[q][1](snapshot)) for q in damBreak.particleOutput}
+        pointsToVTK(os.path.join(directory, f"points{frame:06d}"), np.ascontiguousarray(x[:, 0]), np.ascontiguousarray(x[:, 1]), z, data=data)
+        if damBreak.gridOutput:
+            def toImage(a):
+                return np.ascontiguousarray(a[..., None] if a.ndim == 2 else a)
+            gridData = {}
+            for q in damBreak.gridOutput:
+                a = damBreak.gridOutputs[q][1](snapshot)
+                gridData[q] = tuple(toImage(c) for c in a) if isinstance(a, tuple) else toImage(a)
+            imageToVTK(os.path.join(directory, f"grid{frame:06d}"), origin=(0.0, 0.0, 0.0), spacing=(damBreak.dx,) * 3, pointData=gridData)
+
+
+def writeSeriesFrames(snapshot, path, numFrames, compression, downcast):
+    points = {"position": snapshot["xtdt_p"], **{q: damBreak.particleOutputs[q][1](snapshot) for q in damBreak.particleOutput}}
+    grid = {q: damBreak.gridOutputs[q][1](snapshot) for q in damBreak.gridOutput}
+    series = TimeSeriesWriter(path, compression, downcast, attributes={"dx": damBreak.dx, "dim": damBreak.dim})
+    for frame in range(numFrames):
+        series.append(frame, points, grid, {"time": frame * damBreak.frameRate})
+    series.close()
+    return {"points": points, "grid": grid}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--substeps", type=int, default=200)
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument("--grid-output", nargs="*", default=["Pressure", "Velocity"], help="gridOutput quantities")
+    args = parser.parse_args()
+
+    damBreak.gridOutput = args.grid_output
+    damBreak.substepLauncher.advance(args.substeps, *damBreak.getSubstepArgs(damBreak.dt))
+    ti.sync()
+    snapshot = {name: getattr(damBreak, name).to_numpy() for name in damBreak.getOutputFields()}
+    rng = np.random.default_rng(0)
+
+    print(f"{len(snapshot['xtdt_p'])} particles, {len(damBreak.particleOutput)} point and {len(damBreak.gridOutput)} grid quantities, {args.frames} frames")
+    print(f"{'format':>18s} {'ms/frame':>9s} {'KiB/frame':>10s} {'random read [ms]':>17s} {'round-trip error':>17s}")
+    workDirectory = tempfile.mkdtemp()
+    try:
+        directory = os.path.join(workDirectory, "vtk")
+        os.makedirs(directory)
+        t0 = time.perf_counter()
+        writeVTKFrames(snapshot, directory, args.frames)
+        seconds = time.perf_counter() - t0
+        print(f"{'vtk':>18s} {1e3 * seconds / args.frames:9.2f} {directorySize(directory) / args.frames / 2**10:10.0f} {'-':>17s} {'-':>17s}")
+
+        for compression in (None, "zlib"):
+            for downcast in (False, True):
+                path = os.path.join(workDirectory, f"frames_{compression}_{downcast}")
+                t0 = time.perf_counter()
+                arrays = writeSeriesFrames(snapshot, path, args.frames, compression, downcast)
+                seconds = time.perf_counter() - t0
+                size = os.path.getsize(path + ".bin") + os.path.getsize(path + ".idx")
+
+                reader = TimeSeriesReader(path)
+                frames = rng.integers(args.frames, size=20)
+                t0 = time.perf_counter()
+                for frame in frames:
+                    np.asarray(reader.read(int(frame), "Pressure")).sum()
+                readSeconds = (time.perf_counter() - t0) / len(frames)
+
+                error = 0.0
+                for kind, data in arrays.items():
+                    for name, array in data.items():
+                        stored = np.asarray(reader.read(args.frames - 1, name, kind), dtype=np.float64)
+                        array = np.asarray(array, dtype=np.float64)
+                        if downcast:
+                            error = max(error, np.nanmax(np.abs(stored - array) / np.maximum(np.abs(array), 1e-300), initial=0.0))
+                        elif not np.array_equal(stored, array, equal_nan=True):
+                            raise RuntimeError(f"{kind} {name} does not round-trip through the container ({compression})")
+                label = f"series {compression or 'raw'} {'f32' if downcast else 'f64'}"
+                print(f"{label:>18s} {1e3 * seconds / args.frames:9.2f} {size / args.frames / 2**10:10.0f} {1e3 * readSeconds:17.2f} {error:17.2e}")
+    finally:
+        shutil.rmtree(workDirectory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Wall clock of the semi-implicit pressure (isImplicitPressure) against the explicit pressure on the dam-break.
+
+    python benchmarks/bench_implicitPressure.py --sim-time 0.3 --explicit-dt 1e-5 --implicit-dt 1e-4 3e-4 1e-3
+
+Advances the Telikicherla dam-break to --sim-time with the explicit pressure at
+--explicit-dt (the acoustic limit of kappa) and with the semi-implicit pressure
+at every --implicit-dt, each run in its own process since the pressure mode is
+compiled into the kernels. The first substep compiles and is not timed.
+Reports the wall time, ms/substep, the CG iterations (mean, max) and largest
+final relative residual of the pressure solves, L(T) and H(T) at the end, the
+largest particle displacement from the explicit run and the speedup over it.
+Runs on the CPU backend unless TI_ARCH is set (see workers.py).
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import workers
+
+
+def runWorker(dt, simTime, statePath):
+    import taichi as ti
+    damBreak = workers.importDamBreak()
+    substep = damBreak.substep # substepSemiImplicit with isImplicitPressure
+
+    numSubsteps = int(round(simTime / dt))
+    args = damBreak.getSubstepArgs(dt)
+    substep(*args)
+    ti.sync()
+    t0 = time.perf_counter()
+    for _ in range(numSubsteps - 1):
+        substep(*args)
+    ti.sync()
+    seconds = time.perf_counter() - t0
+    x = damBreak.xtdt_p.to_numpy()
+    np.save(statePath, x)
+    T, L, H = damBreak.getWaterColumn(simTime, damBreak.recordDiagnostics(simTime))
+    solves = np.array(damBreak.pressureSolveHistory).reshape(-1, 3)
+    workers.report({"substeps": numSubsteps, "seconds": seconds * numSubsteps / (numSubsteps - 1), "T": T, "L": L, "H": H,
+                    "isFinite": bool(np.isfinite(x).all()),
+                    "iterations": [float(solves[:, 1].mean()), float(solves[:, 1].max())] if len(solves) else None,
+                    "residual": float(solves[:, 2].max()) if len(solves) else None})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sim-time", type=float, default=0.3)
+    parser.add_argument("--explicit-dt", type=float, default=1e-5)
+    parser.add_argument("--implicit-dt", type=float, nargs="+", default=[1e-4, 3e-4, 1e-3])
+    parser.add_argument("--dt", type=float, help=argparse.SUPPRESS)
+    parser.add_argument("--worker", metavar="STATE.npy", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        runWorker(args.dt, args.sim_time, args.worker)
+        return
+
+    print(f"{'pressure':>9s} {'dt':>8s} {'substeps':>9s} {'wall [s]':>9s} {'ms/substep':>11s} {'CG it. mean/max':>16s} {'residual':>9s}"
+          f" {'L(T)':>7s} {'H(T)':>7s} {'max |dx|':>9s} {'speedup':>8s}")
+    reference, xReference = None, None
+    for isImplicit, dt in [(False, args.explicit_dt)] + [(True, dt) for dt in args.implicit_dt]:
+        with tempfile.TemporaryDirectory() as tmp:
+            statePath = os.path.join(tmp, "state.npy")
+            result = workers.runWorker(__file__, ["--sim-time", args.sim_time, "--dt", dt, "--worker", statePath],
+                                       {"isImplicitPressure": isImplicit})
+            x = np.load(statePath)
+        reference = reference or result
+        xReference = x if xReference is None else xReference
+        iterations = f"{result['iterations'][0]:.1f}/{result['iterations'][1]:.0f}" if result["iterations"] else "-"
+        residual = f"{result['residual']:.1e}" if result["residual"] is not None else "-"
+        print(f"{'implicit' if isImplicit else 'explicit':>9s} {dt:8.1e} {result['substeps']:9d} {result['seconds']:9.1f}"
+              f" {1e3 * result['seconds'] / result['substeps']:11.2f} {iterations:>16s} {residual:>9s} {result['L']:7.4f} {result['H']:7.4f}"
+              f" {np.max(np.abs(x - xReference)) if result['isFinite'] else np.inf:9.2e} {reference['seconds'] / result['seconds']:8.2f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Atomic scatter vs. binned gather P2G (isGatherP2G) as the particle count grows.
+
+    python benchmarks/bench_p2g.py --np-x 33 65 130 --substeps 100 --sort-interval 10
+
+Each particle count (np_x x 2*np_x particles in the same tank and grid, so
+more particles per cell) and P2G mode runs in its own process. Both modes
+start from the same initial state, and the final particle state of the
+gather is compared with that of the scatter, whose summation order differs
+only by round-off. Runs on the CPU backend unless TI_ARCH is set
+(e.g. TI_ARCH=cuda, see workers.py).
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import workers
+
+
+def runWorker(numSubsteps, statePath):
+    import taichi as ti
+    damBreak = workers.importDamBreak()
+    damBreak.substepLauncher.advance(1, *damBreak.getSubstepArgs(damBreak.dt))  # compile outside the timing
+    ti.sync()
+    t0 = time.perf_counter()
+    damBreak.substepLauncher.advance(numSubsteps, *damBreak.getSubstepArgs(damBreak.dt))
+    ti.sync()
+    elapsed = time.perf_counter() - t0
+    np.savez(statePath, x=damBreak.xtdt_p.to_numpy(), v=damBreak.vtdt_p.to_numpy(), p=damBreak.ptdt_p.to_numpy())
+    workers.report({"particles": damBreak.num_p, "substepsPerSecond": numSubsteps / elapsed})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--np-x", type=int, nargs="+", default=[33, 65, 130])
+    parser.add_argument("--substeps", type=int, default=100)
+    parser.add_argument("--sort-interval", type=int, default=10)
+    parser.add_argument("--worker", metavar="STATE.npz", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        runWorker(args.substeps, args.worker)
+        return
+
+    print(f"{'particles':>10s} {'scatter [substeps/s]':>21s} {'gather [substeps/s]':>20s} {'ratio':>6s} {'max rel. diff':>14s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for np_x in args.np_x:
+            results, states = {}, {}
+            for mode in ("scatter", "gather"):
+                statePath = os.path.join(tmp, f"{mode}_{np_x}.npz")
+                settings = {"isGatherP2G": mode == "gather", "sortInterval": args.sort_interval}
+                results[mode] = workers.runWorker(__file__, ["--substeps", args.substeps, "--worker", statePath], settings,
+                                                  env={"DAMBREAK_NP_X": str(np_x)})
+                states[mode] = np.load(statePath)
+            error = max(np.max(np.abs(states["gather"][k] - states["scatter"][k])) / (np.max(np.abs(states["scatter"][k])) + 1e-300)
+                        for k in ("x", "v", "p"))
+            scatter, gather = results["scatter"]["substepsPerSecond"], results["gather"]["substepsPerSecond"]
+            print(f"{results['scatter']['particles']:10d} {scatter:21.1f} {gather:20.1f} {gather / scatter:6.2f} {error:14.3e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""P2G and G2P time per particle memory layout (particleLayout).
+
+    python benchmarks/bench_particleLayout.py --layouts soa aos hybrid --substeps 100 --np-x 65 130
+
+Every layout and particle count runs in its own process
+(DAMBREAK_PARTICLE_LAYOUT and DAMBREAK_NP_X fix the field placement at
+import) with isProfiled, so substep() runs phase by phase (clear grid, P2G,
+grid update, G2P, stress update) and the mean time of every phase over the
+timed substeps is reported. The final particle state of every layout is
+checked against SoA.
+Runs on the CPU backend unless TI_ARCH is set (e.g. TI_ARCH=cuda, see workers.py).
+"""
+import argparse
+import os
+import tempfile
+
+import numpy as np
+
+import workers
+
+
+def runWorker(numSubsteps, statePath):
+    damBreak = workers.importDamBreak()
+    args = damBreak.getSubstepArgs(damBreak.dt)
+    damBreak.substep(*args)  # compiles, not recorded by the profiler
+    for _ in range(numSubsteps):
+        damBreak.substep(*args)
+    rows, _ = damBreak.profiler.endFrame(1)
+    np.savez(statePath, x=damBreak.xtdt_p.to_numpy(), v=damBreak.vtdt_p.to_numpy(), p=damBreak.ptdt_p.to_numpy())
+    workers.report({"particles": damBreak.num_p, "layout": damBreak.particleLayout,
+                    "ms": {row["phase"]: row["mean [ms]"] for row in rows}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--layouts", nargs="+", default=["soa", "aos", "hybrid"])
+    parser.add_argument("--np-x", type=int, nargs="+", default=[65])
+    parser.add_argument("--substeps", type=int, default=100)
+    parser.add_argument("--worker", metavar="STATE.npz", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        runWorker(args.substeps, args.worker)
+        return
+
+    layouts = ["soa"] + [layout for layout in args.layouts if layout != "soa"]
+    print(f"{'particles':>10s} {'layout':>7s} {'P2G [ms]':>9s} {'G2P [ms]':>9s} {'substep [ms]':>13s} {'P2G+G2P vs soa':>15s} {'max |dx| vs soa':>16s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for np_x in args.np_x:
+            results, states = {}, {}
+            for layout in layouts:
+                statePath = os.path.join(tmp, f"{layout}_{np_x}.npz")
+                env = {"DAMBREAK_PARTICLE_LAYOUT": layout, "DAMBREAK_NP_X": str(np_x)}
+                results[layout] = workers.runWorker(__file__, ["--substeps", args.substeps, "--worker", statePath], {"isProfiled": True}, env=env)
+                states[layout] = np.load(statePath)
+            soa = results["soa"]["ms"]["P2G"] + results["soa"]["ms"]["G2P"]
+            for layout in layouts:
+                ms = results[layout]["ms"]
+                error = np.max(np.abs(states[layout]["x"] - states["soa"]["x"]))
+                print(f"{results[layout]['particles']:10d} {layout:>7s} {ms['P2G']:9.3f} {ms['G2P']:9.3f} {sum(ms.values()):13.3f}"
+                      f" {(ms['P2G'] + ms['G2P']) / soa:15.2f} {error:16.3e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Benchmark suite of the dam-break: configuration matrix, resolution scaling and a baseline check.
+
+    python benchmarks/bench_suite.py --out suite.json
+    python benchmarks/bench_suite.py --baseline benchmarks/baseline.json --threshold 0.1
+
+Every case is a short fixed-step run (the best of --repeats timings of
+--substeps of dt, after one untimed substep that compiles) in its own process, since the switches and the field
+shapes are fixed when the kernels are compiled and the fields allocated.
+
+  matrix:  every combination (--matrix full), the default and each switch
+           flipped alone (axes) or the default only (default) of CSL/MPM,
+           APIC/PIC, brute-force/penalty BC and B-spline/tent kernel, at
+           --matrix-scale
+  scaling: the default configuration at every --scales factor s, i.e.
+           np_x = s * --np-x particles across the column and num_cell =
+           s * --num-cell cells across the tank (dx / s)
+
+Reports substeps/s, particle-updates/s (particles x substeps/s), the peak
+resident memory of the process and the field memory of memoryBudget(), and
+writes them with the machine and Taichi version as JSON to --out. With
+--baseline (a JSON written by an earlier run, e.g. on the same machine
+before a change) every case found in both is compared, and a case is
+flagged when its substeps/s drop or its peak memory grows by more than
+--threshold; the exit status is then 1. Runs on the CPU backend unless
+TI_ARCH is set (see workers.py).
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+import workers
+
+# switch -> (global of the damBreak script, {label: value}), default first
+switches = {
+    "scheme": ("isCSL_elseMPM", {"CSL": True, "MPM": False}),
+    "transfer": ("isAPIC_elsePIC", {"APIC": 1, "PIC": 0}),
+    "bc": ("isPenaltyBC_elseBruteforceBC", {"bruteforce": False, "penalty": True}),
+    "kernel": ("isBsplineKernel_elseTent", {"bspline": True, "tent": False}),
+}
+
+
+def configName(labels):
+    return "-".join(labels[switch] for switch in switches)
+
+
+def matrixConfigs(mode):
+    default = {switch: next(iter(values)) for switch, (_, values) in switches.items()}
+    if mode == "default":
+        return [default]
+    if mode == "axes":
+        return [default] + [{**default, switch: label} for switch, (_, values) in switches.items() for label in list(values)[1:]]
+    return [dict(zip(switches, labels)) for labels in itertools.product(*[list(values) for _, values in switches.values()])]
+
+
+def runWorker(numSubsteps, repeats):
+    import taichi as ti
+    damBreak = workers.importDamBreak()
+    args = damBreak.getSubstepArgs(damBreak.dt)
+    t0 = time.perf_counter()
+    damBreak.substepLauncher.advance(1, *args)
+    ti.sync()
+    compileSeconds = time.perf_counter() - t0
+    seconds = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        damBreak.substepLauncher.advance(numSubsteps, *args)
+        ti.sync()
+        seconds = min(seconds, time.perf_counter() - t0)
+    budget = damBreak.memoryBudget()
+    x = damBreak.xtdt_p.to_numpy()
+    workers.report({"particles": budget["particles"], "nodes": budget["nodes"], "substepsPerSecond": numSubsteps / seconds,
+                    "particleUpdatesPerSecond": budget["particles"] * numSubsteps / seconds, "compileSeconds": compileSeconds,
+                    "fieldBytes": sum(budget["bytes"].values()), "isFinite": bool(np.isfinite(x).all()),
+                    "peakRSS": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024})  # ru_maxrss in KiB on Linux
+
+
+def runCase(labels, scale, args):
+    settings = {switches[switch][0]: switches[switch][1][label] for switch, label in labels.items()}
+    result = workers.runWorker(__file__, ["--substeps", args.substeps, "--repeats", args.repeats, "--worker"], settings,
+                               env={"DAMBREAK_NP_X": str(args.np_x * scale), "DAMBREAK_NUM_CELL": str(args.num_cell * scale)})
+    return {"name": f"{configName(labels)}@{scale}x", "config": labels, "scale": scale, "substeps": args.substeps, **result}
+
+
+def compareBaseline(cases, baseline, threshold):
+    # Cases slower (substeps/s) or larger (peak memory) than in the baseline by more than threshold
+    previous = {case["name"]: case for case in baseline["cases"]}
+    flagged = []
+    print(f"\n{'case':>38s} {'substeps/s':>11s} {'baseline':>9s} {'change':>7s} {'peak RSS':>9s} {'change':>7s}")
+    for case in cases:
+        if case["name"] not in previous:
+            continue
+        old = previous[case["name"]]
+        speed = case["substepsPerSecond"] / old["substepsPerSecond"] - 1
+        memory = case["peakRSS"] / old["peakRSS"] - 1
+        isSlower, isLarger = speed < -threshold, memory > threshold
+        if isSlower or isLarger:
+            flagged.append(case["name"])
+        print(f"{case['name']:>38s} {case['substepsPerSecond']:11.1f} {old['substepsPerSecond']:9.1f} {100 * speed:+6.1f}%"
+              f" {case['peakRSS'] / 2**20:8.0f}M {100 * memory:+6.1f}%" + ("  SLOWER" if isSlower else "") + ("  LARGER" if isLarger else ""))
+    return flagged
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--substeps", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--np-x", type=int, default=65, help="particles across the column at scale 1")
+    parser.add_argument("--num-cell", type=int, default=100, help="cells across the tank at scale 1")
+    parser.add_argument("--matrix", choices=["full", "axes", "default"], default="full")
+    parser.add_argument("--matrix-scale", type=int, default=1)
+    parser.add_argument("--scales", type=int, nargs="*", default=[1, 2, 4])
+    parser.add_argument("--out", default="bench_suite.json")
+    parser.add_argument("--baseline", help="JSON of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown or memory growth flagged against the baseline")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        runWorker(args.substeps, args.repeats)
+        return
+
+    plan = [(labels, args.matrix_scale) for labels in matrixConfigs(args.matrix)]
+    default = matrixConfigs("default")[0]
+    plan += [(default, scale) for scale in args.scales if (default, scale) not in plan]
+
+    print(f"{'case':>38s} {'particles':>10s} {'nodes':>8s} {'substeps/s':>11s} {'particle-updates/s':>19s} {'peak RSS [MiB]':>15s}"
+          f" {'fields [MiB]':>13s} {'compile [s]':>12s}")
+    cases = []
+    for labels, scale in plan:
+        case = runCase(labels, scale, args)
+        if not case["isFinite"]:
+            print(f"{case['name']}: non-finite particle positions")
+        cases.append(case)
+        print(f"{case['name']:>38s} {case['particles']:10d} {case['nodes']:8d} {case['substepsPerSecond']:11.1f}"
+              f" {case['particleUpdatesPerSecond']:19.3e} {case['peakRSS'] / 2**20:15.0f} {case['fieldBytes'] / 2**20:13.1f}"
+              f" {case['compileSeconds']:12.1f}", flush=True)
+
+    import taichi as ti
+    result = {"machine": {"platform": platform.platform(), "processor": platform.processor() or platform.machine(), "cpus": os.cpu_count(),
+                          "arch": os.environ["TI_ARCH"], "taichi": ".".join(map(str, ti.__version__)), "python": platform.python_version()},
+              "settings": {"substeps": args.substeps, "repeats": args.repeats, "np_x": args.np_x, "num_cell": args.num_cell}, "cases": cases}
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=1)
+    print(f"\nwritten to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            flagged = compareBaseline(cases, json.load(f), args.threshold)
+        if flagged:
+            print(f"\n{len(flagged)} case(s) beyond the {100 * args.threshold:.0f}% threshold: {', '.join(flagged)}")
+            sys.exit(1)
+        print(f"\nno case beyond the {100 * args.threshold:.0f}% threshold")
+
+
+if __name__ == "__main__":
+    main()
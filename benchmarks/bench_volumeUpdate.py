@@ -0,0 +1,55 @@
+"""Cost of the volume updates (volumeUpdate) against the SVD of F.
+
+    python benchmarks/bench_volumeUpdate.py --substeps 500 --repeats 3
+
+Runs the dam-break with every volumeUpdate ("svd", "det", "incremental"), each
+in its own process since the mode is compiled into G2P. The first substep
+compiles and is not timed; the best of --repeats timings of --substeps
+substeps is reported as ms/substep, with the speedup over "svd". Their
+agreement with "svd" is checked by tests/test_volumeUpdate.py. Runs on the
+CPU backend unless TI_ARCH is set (see workers.py).
+"""
+import argparse
+import time
+
+import workers
+
+modes = ["svd", "det", "incremental"] # the first is the reference
+
+
+def runWorker(numSubsteps, repeats):
+    import taichi as ti
+    damBreak = workers.importDamBreak()
+    args = damBreak.getSubstepArgs(damBreak.dt)
+    damBreak.substep(*args)
+    ti.sync()
+    seconds = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for _ in range(numSubsteps):
+            damBreak.substep(*args)
+        ti.sync()
+        seconds.append((time.perf_counter() - t0) / numSubsteps)
+    workers.report({"substepSeconds": min(seconds), "substeps": 1 + repeats * numSubsteps})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--substeps", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        runWorker(args.substeps, args.repeats)
+        return
+
+    print(f"{'volumeUpdate':>12s} {'ms/substep':>11s} {'speedup':>8s}")
+    reference = None
+    for mode in modes:
+        result = workers.runWorker(__file__, ["--substeps", args.substeps, "--repeats", args.repeats, "--worker"], {"volumeUpdate": mode})
+        reference = reference or result
+        print(f"{mode:>12s} {1e3 * result['substepSeconds']:11.3f} {reference['substepSeconds'] / result['substepSeconds']:8.2f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Accuracy of the f32 storage policies against the f64 baseline.
+
+    python benchmarks/check_precision.py --sim-time 0.05 --dt 1e-5 --tolerance 1e-3
+
+Runs the dam-break once per precision policy (DAMBREAK_PARTICLE_FP,
+DAMBREAK_GRID_FP and DAMBREAK_RK_FP, one process each) and records L(T),
+H(T) and the maxima of the partition-of-unity, consistency and gradient
+consistency errors at every frame (computeConsistency()). Reports the largest deviation of L(T) and H(T)
+from the f64 run, the error maxima next to those of the f64 run, and whether
+the front stays within --tolerance. Runs on the CPU backend unless TI_ARCH
+is set (e.g. TI_ARCH=cuda, see workers.py).
+"""
+import argparse
+
+import numpy as np
+
+import workers
+
+policies = {  # name -> (particle, grid, rk) storage precision
+    "f64": ("f64", "f64", "f64"),
+    "f32 particle": ("f32", "f64", "f64"),
+    "f32 grid": ("f64", "f32", "f64"),
+    "f32 grid, gather P2G": ("f64", "f32", "f64"),
+    "f32 RK moment": ("f64", "f64", "f32"),
+    "f32 all": ("f32", "f32", "f32"),
+}
+
+
+def runWorker(simTime):
+    damBreak = workers.importDamBreak()
+    dt = damBreak.dt
+    timeTotal, count = 0.0, 0
+    frames = []
+    while True:
+        damBreak.computeDiagnostics()
+        diag = dict(zip(damBreak.diagnosticNames, damBreak.diagnostics.to_numpy()[0]))
+        T, L, H = damBreak.getWaterColumn(timeTotal, diag)
+        damBreak.computeConsistency()
+        frames.append({"T": T, "L": L, "H": H,
+                       "PoU": float(np.max(np.abs(damBreak.PartitionOfUnity.to_numpy() - 1.0))),
+                       "Cons": float(np.max(np.abs(damBreak.Cons.to_numpy()))),
+                       "Cons_dx": float(np.max(np.abs(damBreak.Cons_dx.to_numpy()))),
+                       "Cons_dy": float(np.max(np.abs(damBreak.Cons_dy.to_numpy())))})
+        if timeTotal >= simTime:
+            break
+        timeTotal, count = damBreak.advanceFixed(timeTotal, count, int(damBreak.frameRate // dt))
+    workers.report({"frames": frames})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sim-time", type=float, default=0.05)
+    parser.add_argument("--dt", type=float, default=1e-5)
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="max |L - L_f64| and |H - H_f64|")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        runWorker(args.sim_time)
+        return
+
+    results = {}
+    for name, (particle, grid, rk) in policies.items():
+        results[name] = workers.runWorker(__file__, ["--sim-time", args.sim_time, "--worker"], {"dt": args.dt, "isGatherP2G": "gather" in name},
+                                          env={"DAMBREAK_PARTICLE_FP": particle, "DAMBREAK_GRID_FP": grid, "DAMBREAK_RK_FP": rk})
+
+    def series(name, key):
+        return np.array([frame[key] for frame in results[name]["frames"]])
+
+    print(f"{'policy':>22s} {'max|dL|':>10s} {'max|dH|':>10s} {'PoU':>10s} {'Cons':>10s} {'Cons_dx':>10s} {'Cons_dy':>10s}  front")
+    for name in policies:
+        dL = np.max(np.abs(series(name, "L") - series("f64", "L")))
+        dH = np.max(np.abs(series(name, "H") - series("f64", "H")))
+        errors = " ".join(f"{np.max(series(name, key)):10.2e}" for key in ("PoU", "Cons", "Cons_dx", "Cons_dy"))
+        verdict = "ok" if max(dL, dH) <= args.tolerance else "EXCEEDS TOLERANCE"
+        print(f"{name:>22s} {dL:10.2e} {dH:10.2e} {errors}  {verdict}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Worker processes of the benchmarks.
+
+Every case of a benchmark runs in its own process: the dam-break fixes its
+field shapes at import (DAMBREAK_DIM, DAMBREAK_NP_X, ...) and compiles its
+switches into the kernels. runWorker() starts the benchmark script again with
+its worker arguments, the switches of the case in DAMBREAK_SETTINGS (applied by
+the dam-break right after its settings block, so also those read at import)
+and the environment of the case, and returns the JSON the worker printed last
+with report(). Importing this module puts the repository on sys.path and
+selects the CPU backend unless TI_ARCH is set.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+
+os.environ.setdefault("TI_ARCH", "arm64" if platform.machine() in ("arm64", "aarch64") else "x64")
+repoRoot = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, repoRoot)
+
+
+def importDamBreak():
+    # The dam-break module of the repository, set up with the settings and environment of this process
+    import CSL_numericalExample_Telikicherla2024_damBreak as damBreak
+    return damBreak
+
+
+def report(result):
+    # Last line of the worker output, read back by runWorker()
+    print(json.dumps(result), flush=True)
+
+
+def runWorker(script, arguments, settings=None, env=None):
+    # Runs `python script *arguments` with settings (name -> value of the dam-break) and env added to the environment
+    environment = dict(os.environ, **(env or {}))
+    if settings:
+        environment["DAMBREAK_SETTINGS"] = json.dumps(settings)
+    cmd = [sys.executable, os.path.abspath(script)] + [str(argument) for argument in arguments]
+    out = subprocess.run(cmd, env=environment, cwd=repoRoot, capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
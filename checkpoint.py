@@ -0,0 +1,52 @@
+import glob
+import os
+
+import numpy as np
+
+
+def checkpointFiles(directory):
+    # Checkpoints in directory, oldest first
+    return sorted(glob.glob(os.path.join(directory, 'checkpoint_*.npz')))
+
+
+def save_checkpoint(directory, count, fields, state, keep=3):
+    """Writes fields (name -> ti field) and state (name -> scalar or array) to
+    directory/checkpoint_<count>.npz and keeps only the newest keep files.
+
+    The file is written under a temporary name and renamed into place, so a
+    crash mid-write never leaves a truncated checkpoint behind.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'checkpoint_{count:012d}.npz')
+    arrays = {f'field/{name}': field.to_numpy() for name, field in fields.items()}
+    arrays.update({f'state/{name}': np.asarray(value) for name, value in state.items()})
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpPath, path)
+    for old in checkpointFiles(directory)[:-keep] if keep > 0 else []:
+        os.remove(old)
+    return path
+
+
+def load_checkpoint(path, fields):
+    """Restores fields (name -> ti field) from a checkpoint file, or from the
+    newest one if path is a directory, and returns its state dict (0-d arrays
+    as Python scalars)."""
+    if os.path.isdir(path):
+        files = checkpointFiles(path)
+        if not files:
+            raise FileNotFoundError(f'No checkpoint in {path}')
+        path = files[-1]
+    with np.load(path) as data:
+        for name, field in fields.items():
+            field.from_numpy(data[f'field/{name}'])
+        state = {}
+        for key in data.files:
+            if key.startswith('state/'):
+                value = data[key]
+                state[key[len('state/'):]] = value.item() if value.ndim == 0 else value
+    print('Resumed from', path)
+    return state
@@ -15,6 +15,8 @@ class PhysicalQuantities:
 class NumericalSettings:
     def __init__(self, physical: PhysicalQuantities):
         self.valueType = ti.f64
+        self.particleValueType = self.valueType  # storage precision of the particle fields, e.g. ti.f32 as they are bandwidth-bound
+        self.particleLayout = "soa"  # "soa", "aos" or "hybrid", see fields.placeParticleFields
         self.switch_vt_I_APIC = True  # True: velocity APIC, False: velocity PIC
         self.switch_overlineF = False  # F-Bar pressure stabilization
         self.switch_penaltyEBC = False
@@ -24,6 +26,7 @@ class NumericalSettings:
         self.simulationTime = 3
         self.totalTime = 0e-15
         self.timeStep = 1e-6
+        self.substepsPerLaunch = 100  # substeps replayed per ti.graph launch, 1: one launch per substep
         self.penalty = 1e6
         self.pressureMixingRatio = 0  # 1mixed, 0pt
         self.flipBlendParameter = 0 # 1flp, 0apic
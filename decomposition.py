@@ -0,0 +1,403 @@
+"""Slab domain decomposition of the dam-break over local processes.
+
+    python decomposition.py --ranks 4 --substeps 20000 --frame-interval 1000
+
+The grid columns (x) are cut into numRanks slabs [cuts[r], cuts[r + 1]), each
+advanced by its own process. Rank r imports
+CSL_numericalExample_Telikicherla2024_damBreak with DAMBREAK_RANK and
+DAMBREAK_NUM_RANKS set, so its particle fields hold particleCapacity slots
+rather than all particles. A rank owns the particles whose "base" column lies
+in its slab and keeps them while they stay within margin columns of it. Their
+stencils then reach margin columns left of the slab and margin + nodeNum - 1
+(= nodeNum for margin = 1) right of it, the ghost layers. Two neighbouring
+ranks therefore share a window of 2 * margin + nodeNum - 1 columns around
+their cut, and no third rank reaches into it. Every substep is split at the
+grid sums:
+
+    substepP2G()     clear the grid, P2G of the own particles
+    exchangeHalo()   add the neighbours' partial sums in the windows
+    substepG2P()     grid update (ghost nodes redundantly on both ranks), G2P, stress
+    migrate()        hand the particles that left their slab's margin to their owner
+
+At every frame the cuts are moved so that the slabs hold about the same
+number of particles, since the column spreads from one corner over the tank
+floor. All communication is an all-gather through a shared-memory block
+(SharedMemoryChannel). The grid keeps its global indexing in every rank:
+clearGrid() and updateGrid() visit only the columns of the slab and its ghost
+layers (rankColumns), and with isSparseGrid only their blocks are allocated. Results equal those of the single process up to the summation
+order of the grid sums.
+"""
+import argparse
+import multiprocessing
+import os
+import platform
+import resource
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import taichi as ti
+
+
+class SharedMemoryChannel:
+    """All-gather of float64 messages between numRanks local processes.
+
+    Every rank writes its message into its own slot of a shared-memory block
+    and waits at a barrier, after which the messages of all ranks are
+    readable. Two blocks alternate, so a message stays valid until the
+    next-but-one allGather() and one barrier per call suffices. Created by
+    the parent process and passed to the rank processes, which re-attach the
+    block by name; the parent unlinks it in close().
+    """
+
+    def __init__(self, numRanks, messageSize, context):
+        self.numRanks, self.messageSize = numRanks, messageSize
+        self.barrier = context.Barrier(numRanks)
+        self.memory = shared_memory.SharedMemory(create=True, size=2 * numRanks * (messageSize + 1) * 8)
+        self.name = self.memory.name
+        self._attach()
+
+    def _attach(self):
+        self.slots = np.ndarray((2, self.numRanks, self.messageSize + 1), dtype=np.float64, buffer=self.memory.buf)  # [block, rank, (length, message)]
+        self.block = 0
+
+    def __getstate__(self):
+        return {"numRanks": self.numRanks, "messageSize": self.messageSize, "barrier": self.barrier, "name": self.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memory = shared_memory.SharedMemory(name=self.name)
+        self._attach()
+
+    def allGather(self, rank, message):
+        message = np.ravel(message)
+        if message.size > self.messageSize:
+            raise ValueError(f"Message of {message.size} values exceeds the channel's messageSize of {self.messageSize}")
+        slot = self.slots[self.block, rank]
+        slot[0] = message.size
+        slot[1:1 + message.size] = message
+        self.barrier.wait()
+        messages = [self.slots[self.block, r, 1:1 + int(self.slots[self.block, r, 0])] for r in range(self.numRanks)]
+        self.block ^= 1
+        return messages
+
+    def close(self, unlink=False):
+        del self.slots
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def numValues(field):
+    return getattr(field, "n", 1) * getattr(field, "m", 1)
+
+
+@ti.func
+def getComponent(field: ti.template(), I, c: ti.template()):
+    # Value c of field[I], numbered row-major over its n x m (vector: n, scalar: 1) values
+    if ti.static(not isinstance(field, ti.MatrixField)):
+        return ti.cast(field[I], ti.f64)
+    elif ti.static(field.m == 1):
+        return ti.cast(field[I][c], ti.f64)
+    else:
+        return ti.cast(field[I][c // field.m, c % field.m], ti.f64)
+
+
+@ti.func
+def setComponent(field: ti.template(), I, c: ti.template(), value):
+    if ti.static(not isinstance(field, ti.MatrixField)):
+        field[I] = ti.cast(value, field.dtype)
+    elif ti.static(field.m == 1):
+        field[I][c] = ti.cast(value, field.dtype)
+    else:
+        field[I][c // field.m, c % field.m] = ti.cast(value, field.dtype)
+
+
+def balancedCuts(histogram, numRanks, minWidth):
+    # Column cuts [0, ..., numColumns] with about equal particle counts per slab, every slab at least minWidth columns wide
+    numColumns = len(histogram)
+    if numRanks * minWidth > numColumns:
+        raise ValueError(f"{numRanks} slabs of at least {minWidth} columns do not fit into {numColumns} columns")
+    cumulative = np.cumsum(histogram)
+    cuts = np.concatenate([[0], np.searchsorted(cumulative, cumulative[-1] * np.arange(1, numRanks) / numRanks) + 1, [numColumns]])
+    for r in range(1, numRanks):
+        cuts[r] = max(cuts[r], cuts[r - 1] + minWidth)
+    for r in range(numRanks - 1, 0, -1):
+        cuts[r] = min(cuts[r], cuts[r + 1] - minWidth)
+    return cuts
+
+
+@ti.data_oriented
+class SlabDecomposition:
+    """Halo exchange, particle migration and load balancing of one rank.
+
+    gridFields are the grid sums of P2G, indexed [column, row];
+    particleFields the particle state carried from one substep to the next,
+    including material, whose value -1 marks an empty slot. At most
+    migrationCapacity particles leave a rank per round of migrate(), as many
+    as fit into one message of the channel. columns, if given, receives the
+    grid columns [lo, hi) of the slab and its ghost layers whenever the cuts
+    move.
+    """
+
+    def __init__(self, rank, numRanks, channel, gridFields, particleFields, position, material, inv_dx, shift, nodeNum, margin=1, columns=None):
+        self.rank, self.numRanks, self.channel = rank, numRanks, channel
+        self.position, self.material, self.columns = position, material, columns
+        self.inv_dx, self.shift, self.margin = inv_dx, shift, margin
+        self.numColumns, self.numRows = gridFields[0].shape
+        self.window = 2 * margin + nodeNum - 1 # columns shared by two neighbouring ranks around their cut
+        self.gridLayout, numGridValues = self._layout(gridFields)
+        self.particleLayout, self.numParticleValues = self._layout(particleFields)
+        self.capacity = position.shape[0]
+        self.migrationCapacity = (channel.messageSize - 1) // (self.numParticleValues + 1)
+
+        self.halo = ti.field(ti.f64, shape=(2, numGridValues, self.window, self.numRows)) # [left/right window, value, column, row]
+        self.outbox = ti.field(ti.f64, shape=(self.migrationCapacity, self.numParticleValues + 1)) # values of a leaving particle, its owner
+        self.inbox = ti.field(ti.f64, shape=(self.migrationCapacity, self.numParticleValues))
+        self.cuts = ti.field(int, shape=numRanks + 1)
+        self.numLeaving = ti.field(int, shape=())
+        self.numClaimed = ti.field(int, shape=())
+        self.inboxHost = np.zeros(self.inbox.shape)
+        self.setCuts(np.linspace(0, self.numColumns, numRanks + 1).astype(int))
+        self.numActive = int(np.sum(material.to_numpy() >= 0))
+        self.exchangeTime = 0.0 # [s] spent in exchangeHalo() and migrate(), waiting for the other ranks included
+
+    @staticmethod
+    def _layout(fields):
+        # (field, index of its first value) of fields packed into rows of float64 values
+        layout, offset = [], 0
+        for field in fields:
+            layout.append((field, offset))
+            offset += numValues(field)
+        return layout, offset
+
+    def setCuts(self, cuts):
+        self.cutsHost = np.asarray(cuts, dtype=int)
+        self.cuts.from_numpy(self.cutsHost.astype(np.int32))
+        if self.columns is not None: # the stencils of the particles within margin of the slab
+            lo, hi = self.cutsHost[self.rank] - self.margin, self.cutsHost[self.rank + 1] - self.margin + self.window
+            self.columns.from_numpy(np.array([max(lo, 0), min(hi, self.numColumns)], dtype=np.int32))
+
+    @ti.kernel
+    def packHalo(self, side: ti.i32, lo: ti.i32):
+        for c, j in ti.ndrange(self.window, self.numRows):
+            I = ti.Vector([lo + c, j])
+            for field, offset in ti.static(self.gridLayout):
+                for v in ti.static(range(numValues(field))):
+                    self.halo[side, offset + v, c, j] = getComponent(field, I, v)
+
+    @ti.kernel
+    def addHalo(self, side: ti.i32, lo: ti.i32):
+        for c, j in ti.ndrange(self.window, self.numRows):
+            I = ti.Vector([lo + c, j])
+            for field, offset in ti.static(self.gridLayout):
+                for v in ti.static(range(numValues(field))):
+                    if self.halo[side, offset + v, c, j] != 0: # leaves inactive sparse blocks inactive
+                        setComponent(field, I, v, getComponent(field, I, v) + self.halo[side, offset + v, c, j])
+
+    @ti.kernel
+    def packMigrants(self) -> ti.i32:
+        self.numLeaving[None] = 0
+        for p in self.material:
+            if self.material[p] >= 0:
+                column = ti.cast(self.position[p][0] * self.inv_dx - self.shift, ti.i32) # "base" of P2G
+                if column < self.cuts[self.rank] - self.margin or column >= self.cuts[self.rank + 1] + self.margin:
+                    k = ti.atomic_add(self.numLeaving[None], 1)
+                    if k < self.migrationCapacity: # the others leave in the next round
+                        owner = 0
+                        for r in range(1, self.numRanks):
+                            if column >= self.cuts[r]:
+                                owner = r
+                        for field, offset in ti.static(self.particleLayout):
+                            for v in ti.static(range(numValues(field))):
+                                self.outbox[k, offset + v] = getComponent(field, p, v)
+                        self.outbox[k, self.numParticleValues] = owner
+                        self.material[p] = -1
+        return self.numLeaving[None]
+
+    @ti.kernel
+    def unpackArrivals(self, numArrivals: ti.i32):
+        self.numClaimed[None] = 0
+        for p in self.material:
+            if self.material[p] < 0:
+                k = ti.atomic_add(self.numClaimed[None], 1)
+                if k < numArrivals:
+                    for field, offset in ti.static(self.particleLayout):
+                        for v in ti.static(range(numValues(field))):
+                            setComponent(field, p, v, self.inbox[k, offset + v])
+
+    def exchangeHalo(self):
+        # After P2G: every window holds the sums of both neighbouring ranks
+        t0 = time.perf_counter()
+        lo = [int(self.cutsHost[self.rank]) - self.margin, int(self.cutsHost[self.rank + 1]) - self.margin] # first column of the left and right window
+        sides = [side for side, hasNeighbour in enumerate([self.rank > 0, self.rank < self.numRanks - 1]) if hasNeighbour]
+        for side in sides:
+            self.packHalo(side, lo[side])
+        halo = self.halo.to_numpy()
+        messages = self.channel.allGather(self.rank, halo)
+        for side in sides: # the left window is the right one of the left neighbour and vice versa
+            halo[side] = messages[self.rank - 1 if side == 0 else self.rank + 1].reshape(halo.shape)[1 - side]
+        self.halo.from_numpy(halo)
+        for side in sides:
+            self.addHalo(side, lo[side])
+        self.exchangeTime += time.perf_counter() - t0
+
+    def migrate(self):
+        # After G2P: rounds of at most migrationCapacity particles per rank until every particle is within margin of its slab
+        t0 = time.perf_counter()
+        while True:
+            numLeaving = self.packMigrants()
+            numPacked = min(numLeaving, self.migrationCapacity)
+            outgoing = self.outbox.to_numpy()[:numPacked] if numPacked > 0 else np.zeros((0, self.numParticleValues + 1))
+            messages = self.channel.allGather(self.rank, np.concatenate([[numLeaving - numPacked], outgoing.ravel()]))
+            isDone = all(m[0] == 0 for m in messages)
+            arrivals = np.concatenate([m[1:].reshape(-1, self.numParticleValues + 1) for m in messages])
+            arrivals = arrivals[arrivals[:, -1] == self.rank, :-1]
+            self.numActive += len(arrivals) - numPacked
+            if self.numActive > self.capacity:
+                raise RuntimeError(f"Rank {self.rank}: {self.numActive} particles exceed its {self.capacity} slots, raise rankCapacity")
+            for start in range(0, len(arrivals), self.migrationCapacity):
+                chunk = arrivals[start:start + self.migrationCapacity]
+                self.inboxHost[:len(chunk)] = chunk
+                self.inbox.from_numpy(self.inboxHost)
+                self.unpackArrivals(len(chunk))
+            if isDone:
+                break
+        self.exchangeTime += time.perf_counter() - t0
+
+    def activeParticles(self):
+        return self.material.to_numpy() >= 0
+
+    def rebalance(self):
+        # Moves the cuts so that every slab holds about the same number of particles, then migrates
+        x = self.position.to_numpy()[self.activeParticles(), 0]
+        columns = np.clip((x * self.inv_dx - self.shift).astype(int), 0, self.numColumns - 1)
+        histogram = np.sum(self.channel.allGather(self.rank, np.bincount(columns, minlength=self.numColumns)), axis=0)
+        self.setCuts(balancedCuts(histogram, self.numRanks, self.window))
+        self.migrate()
+
+    def extent(self):
+        # xMin, xMax, yMin, yMax over the particles of all ranks
+        x = self.position.to_numpy()[self.activeParticles()]
+        local = [x[:, 0].min(), -x[:, 0].max(), x[:, 1].min(), -x[:, 1].max()] if len(x) else [np.inf] * 4
+        gathered = np.min(self.channel.allGather(self.rank, local), axis=0)
+        return {"xMin": gathered[0], "xMax": -gathered[1], "yMin": gathered[2], "yMax": -gathered[3]}
+
+
+def runRank(rank, numRanks, channel, numSubsteps, frameInterval, numThreads, isStateReturned, results):
+    # One rank process: the dam-break of its slab, results (rows of rank 0) put into the results queue
+    os.environ.update(DAMBREAK_RANK=str(rank), DAMBREAK_NUM_RANKS=str(numRanks), TI_CPU_MAX_NUM_THREADS=str(numThreads))
+    os.environ.setdefault("TI_ARCH", "arm64" if platform.machine() in ("arm64", "aarch64") else "x64")
+    try:
+        import CSL_numericalExample_Telikicherla2024_damBreak as damBreak
+
+        particleId = ti.field(int, shape=damBreak.particleCapacity)
+        slots = np.arange(damBreak.particleCapacity)
+        particleId.from_numpy(np.where(slots < damBreak.numInitialParticles, damBreak.firstParticle + slots, -1).astype(np.int32))
+        gridFields = [damBreak.volumet_I, damBreak.mt_I, damBreak.vt_I, damBreak.at_I, damBreak.ut_I, damBreak.Delta_ut_I, damBreak.ft_I,
+                      damBreak.ptdt_I, damBreak.pt_I] # summed in P2G
+        particleFields = [getattr(damBreak, name) for name in damBreak.checkpointFields] + [particleId]
+        decomposition = SlabDecomposition(rank, numRanks, channel, gridFields, particleFields, damBreak.xtdt_p, damBreak.material,
+                                          damBreak.inv_dx, damBreak.shift, damBreak.nodeNum, columns=damBreak.rankColumns)
+        args = damBreak.getSubstepArgs(damBreak.dt)
+
+        rows = []
+        def recordFrame(count):
+            timeTotal = count * damBreak.dt
+            if numRanks > 1:
+                decomposition.rebalance()
+                extent = decomposition.extent()
+            else:
+                damBreak.computeDiagnostics()
+                extent = dict(zip(damBreak.diagnosticNames, damBreak.diagnostics.to_numpy()[0]))
+            T, L, H = damBreak.getWaterColumn(timeTotal, extent)
+            rows.append({"T": T, "L(T)": L, "H(T)": H, "particles": decomposition.numActive})
+
+        recordFrame(0)
+        for count in range(1, numSubsteps + 1):
+            if numRanks > 1:
+                damBreak.substepP2G(args[0])
+                decomposition.exchangeHalo()
+                damBreak.substepG2P(*args)
+                decomposition.migrate()
+            else:
+                damBreak.substep(*args)
+            if count == 1: # compiled, time the rest
+                ti.sync()
+                t0 = time.perf_counter()
+                decomposition.exchangeTime = 0.0
+            if count % frameInterval == 0:
+                recordFrame(count)
+        ti.sync()
+        result = {"rank": rank, "seconds": time.perf_counter() - t0, "timedSubsteps": numSubsteps - 1,
+                  "exchangeSeconds": decomposition.exchangeTime, "particles": decomposition.numActive, "rows": rows,
+                  "cuts": decomposition.cutsHost.tolist(), "peakRSS": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+        if isStateReturned:
+            active = decomposition.activeParticles()
+            result["state"] = {name: getattr(damBreak, name).to_numpy()[active] for name in damBreak.checkpointFields}
+            result["state"]["id"] = particleId.to_numpy()[active]
+        results.put(result)
+    except BaseException:
+        channel.barrier.abort() # the other ranks stop at their next exchange
+        raise
+
+
+def run(numRanks, numSubsteps, frameInterval=1000, numThreads=None, isStateReturned=False, messageSize=2**18):
+    """Runs numSubsteps of the dam-break on numRanks processes with numThreads
+    CPU threads each (default: the cores split evenly) and returns the results
+    of every rank, ordered by rank. With isStateReturned, "state" holds the
+    particle state of all ranks ordered by particle id."""
+    numSubsteps = max(numSubsteps, 2) # the first substep compiles and is not timed
+    numThreads = numThreads or max(1, os.cpu_count() // numRanks)
+    context = multiprocessing.get_context("spawn") # a fresh Taichi runtime per rank
+    channel = SharedMemoryChannel(numRanks, messageSize, context)
+    results = context.Queue()
+    processes = [context.Process(target=runRank, args=(rank, numRanks, channel, numSubsteps, frameInterval, numThreads, isStateReturned, results))
+                 for rank in range(numRanks)]
+    try:
+        for process in processes:
+            process.start()
+        collected = []
+        while len(collected) < numRanks: # before join(): a rank blocks until its result is taken off the queue
+            if not any(process.is_alive() for process in processes) and results.empty():
+                raise RuntimeError("A rank process failed, see its traceback above")
+            try:
+                collected.append(results.get(timeout=1))
+            except Exception: # queue.Empty
+                continue
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        channel.close(unlink=True)
+    collected.sort(key=lambda result: result["rank"])
+    if isStateReturned:
+        states = [result.pop("state") for result in collected]
+        state = {name: np.concatenate([s[name] for s in states]) for name in states[0]}
+        order = np.argsort(state["id"])
+        collected[0]["state"] = {name: values[order] for name, values in state.items()}
+    return collected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ranks", type=int, default=2)
+    parser.add_argument("--substeps", type=int, default=20000)
+    parser.add_argument("--frame-interval", type=int, default=1000, help="substeps between the L(T), H(T) records and rebalancing")
+    parser.add_argument("--threads", type=int, default=None, help="CPU threads per rank (default: the cores split evenly)")
+    parser.add_argument("--out", default="decomposition_damBreak_results.csv")
+    args = parser.parse_args()
+
+    results = run(args.ranks, args.substeps, args.frame_interval, args.threads)
+    for result in results:
+        print(f"rank {result['rank']}: {result['particles']} particles, {result['timedSubsteps'] / result['seconds']:.1f} substeps/s, "
+              f"{100 * result['exchangeSeconds'] / result['seconds']:.0f}% in exchanges, cuts {result['cuts']}")
+    pd.DataFrame(results[0]["rows"]).to_csv(args.out, index=False)
+    print("Results written to", args.out)
+
+
+if __name__ == "__main__":
+    main()
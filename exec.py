@@ -7,11 +7,13 @@ ti.init(arch=ti.gpu, device_memory_GB=3.0)
 from functionsConfidential import createFilePaths, progressBar, initialize_Cubes, post_process, subStep
 from config import NumericalSettings, PhysicalQuantities, GravityField
 from fields import ParticleFields, GridFields, StabilizationFields, ProjectionFields, PenaltyMethodFields
+from stepping import SubstepLauncher
 
 
 physical = PhysicalQuantities()
 numerical = NumericalSettings(physical)
-particle = ParticleFields(numerical.numParticles, numerical.valueType)
+particle = ParticleFields(numerical.numParticles, numerical.particleValueType, numerical.particleLayout, numerical.dimension)
+substepLauncher = SubstepLauncher(subStep, numerical.substepsPerLaunch)
 
 
 timeSimulationBegin = time.time()
@@ -25,8 +27,8 @@ count = 0
 # while not gui.get_event(ti.GUI.ESCAPE, ti.GUI.EXIT):
 while (numerical.totalTime < numerical.simulationTime):
     num_substeps = int(numerical.frameRate // numerical.timeStep)
+    substepLauncher.advance(num_substeps)
     for s in range(num_substeps):
-        subStep()
         count += 1
         numerical.totalTime += numerical.timeStep
 
@@ -1,39 +1,64 @@
 import taichi as ti
 
+particleLayouts = ("soa", "aos", "hybrid")
+
+
+def placeParticleFields(fields, num_p, layout="soa", hotFields=()):
+    """Places particle fields declared without a shape.
+
+    "soa" gives every field its own dense array (as shape=num_p does), "aos"
+    puts all of them into one array of structs, and "hybrid" interleaves only
+    hotFields, the ones read together in P2G/G2P, leaving the rest SoA.
+    Kernels index the fields the same way in every layout.
+    """
+    if layout == "soa":
+        groups = [[field] for field in fields]
+    elif layout == "aos":
+        groups = [list(fields)]
+    elif layout == "hybrid":
+        groups = [list(hotFields)] + [[field] for field in fields if all(field is not hot for hot in hotFields)]
+    else:
+        raise ValueError(f"Unknown particle layout {layout!r}, expected one of {particleLayouts}")
+    for group in groups:
+        ti.root.dense(ti.i, num_p).place(*group)
+
 
 class ParticleFields:
-    def __init__(self, num_p, valueType):
-        self.position = ti.Vector.field(2, dtype=valueType, shape=num_p)
-        self.velocity = ti.Vector.field(2, dtype=valueType, shape=num_p)
-        self.velocity_gradient = ti.Matrix.field(2, 2, dtype=valueType, shape=num_p)
-        self.deformation_gradient = ti.Matrix.field(2, 2, dtype=valueType, shape=num_p)
-        self.determinant_of_deformation_gradient = ti.field(dtype=valueType, shape=num_p)
-        self.stress = ti.Matrix.field(2, 2, dtype=valueType, shape=num_p)
-        self.material_id = ti.field(dtype=int, shape=num_p)
-        self.volume = ti.field(dtype=valueType, shape=num_p)
-        self.mass = ti.field(dtype=valueType, shape=num_p)
-        self.partitionofUnity = ti.field(dtype=valueType, shape=num_p)
-        self.consistency = ti.field(dtype=valueType, shape=num_p)
-        self.consistency_dx = ti.field(dtype=valueType, shape=num_p)
-        self.consistency_dy = ti.field(dtype=valueType, shape=num_p)
-        self.pressure = ti.field(dtype=valueType, shape=num_p)
-        self.divergenceofVelocity = ti.field(dtype=valueType, shape=num_p)
-        self.particleDensity = ti.field(dtype=valueType, shape=num_p)
+    def __init__(self, num_p, valueType, layout="soa", dim=2):
+        self.position = ti.Vector.field(dim, dtype=valueType)
+        self.velocity = ti.Vector.field(dim, dtype=valueType)
+        self.velocity_gradient = ti.Matrix.field(dim, dim, dtype=valueType)
+        self.deformation_gradient = ti.Matrix.field(dim, dim, dtype=valueType)
+        self.determinant_of_deformation_gradient = ti.field(dtype=valueType)
+        self.stress = ti.Matrix.field(dim, dim, dtype=valueType)
+        self.material_id = ti.field(dtype=int)
+        self.volume = ti.field(dtype=valueType)
+        self.mass = ti.field(dtype=valueType)
+        self.partitionofUnity = ti.field(dtype=valueType)
+        self.consistency = ti.field(dtype=valueType)
+        self.consistency_dx = ti.field(dtype=valueType)
+        self.consistency_dy = ti.field(dtype=valueType)
+        self.pressure = ti.field(dtype=valueType)
+        self.divergenceofVelocity = ti.field(dtype=valueType)
+        self.particleDensity = ti.field(dtype=valueType)
+        placeParticleFields([getattr(self, name) for name in vars(self)], num_p, layout,
+                            hotFields=[self.position, self.velocity, self.velocity_gradient, self.stress, self.volume, self.mass])
 
 
 class GridFields:
-    def __init__(self, num_g, valueType):
-        self.velocity_grid = ti.Vector.field(2, dtype=valueType, shape=(num_g, num_g))
-        self.velocity_grid_initial = ti.Vector.field(2, dtype=valueType, shape=(num_g, num_g))
-        self.mass_grid = ti.Matrix.field(2, 2, dtype=valueType, shape=(num_g, num_g))
-        self.volume_grid = ti.field(dtype=valueType, shape=(num_g, num_g))
-        self.pressure_grid = ti.field(dtype=valueType, shape=(num_g, num_g))
+    def __init__(self, num_g, valueType, dim=2):
+        self.velocity_grid = ti.Vector.field(dim, dtype=valueType, shape=(num_g,) * dim)
+        self.velocity_grid_initial = ti.Vector.field(dim, dtype=valueType, shape=(num_g,) * dim)
+        self.mass_grid = ti.Matrix.field(dim, dim, dtype=valueType, shape=(num_g,) * dim)
+        self.volume_grid = ti.field(dtype=valueType, shape=(num_g,) * dim)
+        self.pressure_grid = ti.field(dtype=valueType, shape=(num_g,) * dim)
 
 
 class StabilizationFields:
-    def __init__(self, num_g, valueType):
-        self.volume_0 = ti.field(dtype=valueType, shape=(num_g - 1, num_g - 1))
-        self.cell = ti.field(dtype=valueType, shape=(num_g - 1, num_g - 1))
+    def __init__(self, num_g, valueType, dim=2):
+        self.volume_0 = ti.field(dtype=valueType, shape=(num_g - 1,) * dim)
+        self.volume_t = ti.field(dtype=valueType, shape=(num_g - 1,) * dim)
+        self.cell = ti.field(dtype=valueType, shape=(num_g - 1,) * dim)
 
 
 class ProjectionFields:
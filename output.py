@@ -0,0 +1,80 @@
+import queue
+import threading
+
+import taichi as ti
+
+
+@ti.kernel
+def copyField(field: ti.template(), host: ti.types.ndarray()):
+    for I in ti.grouped(field):
+        if ti.static(not isinstance(field, ti.MatrixField)):
+            host[I] = field[I]
+        elif ti.static(field.m == 1):  # vector field, host has the layout of to_numpy()
+            for i in ti.static(range(field.n)):
+                host[I, i] = field[I][i]
+        else:
+            for i, j in ti.static(ti.ndrange(field.n, field.m)):
+                host[I, i, j] = field[I][i, j]
+
+
+class FrameWriter:
+    """Writes frames on a background thread while the solver keeps stepping.
+
+    snapshot() copies the registered particle/grid fields into one of
+    numBuffers reusable host buffers, blocking while all of them are still
+    queued or being written (backpressure). submit() hands the buffer to the
+    writer thread, which calls writeFrame(buffer) and then returns it to the
+    pool. Frames are written in submission order. An exception raised by
+    writeFrame is re-raised in the solver thread on the next submit(), flush()
+    or close().
+    """
+
+    def __init__(self, fields, writeFrame, numBuffers=2):
+        self.fields = fields  # name -> ti field
+        self.writeFrame = writeFrame
+        self.freeBuffers = queue.Queue()
+        for _ in range(numBuffers):
+            self.freeBuffers.put({name: field.to_numpy() for name, field in fields.items()})
+        self.pending = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            buffer = self.pending.get()
+            if buffer is None:
+                self.pending.task_done()
+                return
+            try:
+                if self.error is None:
+                    self.writeFrame(buffer)
+            except Exception as e:  # surfaced in the solver thread
+                self.error = e
+            self.freeBuffers.put(buffer)
+            self.pending.task_done()
+
+    def _raiseError(self):
+        if self.error is not None:
+            raise RuntimeError('Frame output failed') from self.error
+
+    def snapshot(self):
+        buffer = self.freeBuffers.get()
+        for name in self.fields:
+            buffer[name].fill(0)  # cells of inactive sparse blocks are not visited by the copy
+            copyField(self.fields[name], buffer[name])
+        return buffer
+
+    def submit(self, buffer):
+        self._raiseError()
+        self.pending.put(buffer)
+
+    def flush(self):
+        # Wait until every submitted frame is on disk
+        self.pending.join()
+        self._raiseError()
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        self._raiseError()
@@ -0,0 +1,65 @@
+import json
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import taichi as ti
+
+
+class PhaseProfiler:
+    """Wall-clock time of the named phases of a substep, aggregated per frame.
+
+    Each phase() block is bracketed by ti.sync(), so its time is that of the
+    kernels it launches, run to completion on the device, and of nothing
+    queued before it. The first block of every phase compiles its kernels
+    and is not recorded. endFrame() reduces the samples taken since the last
+    call to min/mean/p99/total per phase, keeps them as rows and returns them
+    with a one-line summary. write(path) saves the rows of all frames to
+    path.csv, and to path.json together with the totals of the run.
+    """
+
+    def __init__(self, sync=ti.sync):
+        self.sync = sync
+        self.samples = {}  # phase -> seconds since the last endFrame(), phases in the order first seen
+        self.compiled = set()  # phases run at least once
+        self.rows = []
+
+    @contextmanager
+    def phase(self, name):
+        self.sync()
+        t0 = time.perf_counter()
+        yield
+        self.sync()
+        if name in self.compiled:
+            self.samples.setdefault(name, []).append(time.perf_counter() - t0)
+        self.compiled.add(name)
+
+    def endFrame(self, frame):
+        rows = []
+        for name, seconds in self.samples.items():
+            seconds = np.array(seconds)
+            rows.append({"frame": frame, "phase": name, "count": len(seconds), "min [ms]": 1e3 * seconds.min(),
+                         "mean [ms]": 1e3 * seconds.mean(), "p99 [ms]": 1e3 * np.percentile(seconds, 99), "total [s]": seconds.sum()})
+        self.rows += rows
+        self.samples = {}
+        total = sum(row["total [s]"] for row in rows)
+        phases = " | ".join(f"{row['phase']} {row['mean [ms]']:.3f} ms (p99 {row['p99 [ms]']:.3f}, {100 * row['total [s]'] / total:.0f}%)"
+                            for row in rows)
+        return rows, f"Phases of frame {frame}: {phases}" if rows else f"Phases of frame {frame}: no substeps"
+
+    def totals(self):
+        # Per phase over all frames: substeps, total time, mean, the smallest min and the largest p99 of a frame
+        df = pd.DataFrame(self.rows)
+        if df.empty:
+            return {}
+        grouped = df.groupby("phase", sort=False)
+        return {name: {"count": int(g["count"].sum()), "total [s]": float(g["total [s]"].sum()),
+                       "mean [ms]": 1e3 * float(g["total [s]"].sum() / g["count"].sum()),
+                       "min [ms]": float(g["min [ms]"].min()), "max p99 [ms]": float(g["p99 [ms]"].max())}
+                for name, g in grouped}
+
+    def write(self, path):
+        pd.DataFrame(self.rows).to_csv(path + ".csv", index=False)
+        with open(path + ".json", "w") as f:
+            json.dump({"run": self.totals(), "frames": self.rows}, f, indent=1)
@@ -0,0 +1,56 @@
+import taichi as ti
+
+
+def isGraphSupported():
+    # ti.graph runs on Vulkan, and on the LLVM backends (CPU/CUDA) from Taichi 1.3 on
+    arch = ti.lang.impl.current_cfg().arch
+    if arch == ti.vulkan:
+        return True
+    return tuple(ti.__version__) >= (1, 3, 0) and arch in (ti.x64, ti.arm64, ti.cuda)
+
+
+class SubstepLauncher:
+    """Advances a substep kernel many times per Python call.
+
+    With substepsPerLaunch > 1 the kernel is recorded that many times into a
+    ti.graph, which is then replayed with a single launch. Every replay runs
+    the same compiled kernel in the same order, so the result is bit-identical
+    to calling the kernel once per substep. The remainder of a batch, or any
+    backend without ti.graph support, falls back to one launch per substep.
+
+    scalarArgs lists the (name, dtype) of the kernel's scalar arguments in
+    order, e.g. [('dt', ti.f64)]; advance() passes the same values to every
+    substep of the call.
+    """
+
+    def __init__(self, kernel, substepsPerLaunch=1, scalarArgs=()):
+        self.kernel = kernel
+        self.substepsPerLaunch = substepsPerLaunch
+        self.scalarArgs = list(scalarArgs)
+        self.isFused = substepsPerLaunch > 1 and hasattr(kernel, '_primal')  # only plain ti.kernel can be recorded
+        self.graph = None
+        self.numLaunches = 0
+
+    def compile(self):
+        if self.isFused and not isGraphSupported():
+            print(f'ti.graph is not supported with Taichi {".".join(map(str, ti.__version__))} on this arch; '
+                  'launching every substep from Python')
+            self.isFused = False
+        if self.isFused and self.graph is None:
+            symbols = [ti.graph.Arg(ti.graph.ArgKind.SCALAR, name, dtype) for name, dtype in self.scalarArgs]
+            builder = ti.graph.GraphBuilder()
+            for _ in range(self.substepsPerLaunch):
+                builder.dispatch(self.kernel, *symbols)
+            self.graph = builder.compile()
+
+    def advance(self, numSubsteps, *args):
+        self.compile()
+        if self.isFused:
+            graphArgs = {name: value for (name, _), value in zip(self.scalarArgs, args)}
+            for _ in range(numSubsteps // self.substepsPerLaunch):
+                self.graph.run(graphArgs)
+                self.numLaunches += 1
+            numSubsteps %= self.substepsPerLaunch
+        for _ in range(numSubsteps):
+            self.kernel(*args)
+            self.numLaunches += 1
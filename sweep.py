@@ -0,0 +1,117 @@
+"""Parameter sweep of the dam-break example.
+
+    python sweep.py isCSL_elseMPM=True,False eta_v=0,0.5,1 dt=1e-5,2e-5 --sim-time 0.1 --workers 4
+
+Every combination of the listed values is one case. eta_v, eta_u, eta_p,
+ifAV and dt are arguments of substep() and change without recompiling;
+isCSL_elseMPM, isMixedFormulation_elsePointwise and isFBar are compiled into
+the kernels (and partly read at import), so the cases are grouped by them and
+every worker process imports the dam-break with the settings of one group in
+DAMBREAK_SETTINGS, compiling substep() once. The groups are split over
+--workers processes that run concurrently, sharing the CPU threads. All cases
+start from the initial state of CSL_numericalExample_Telikicherla2024_damBreak.py
+and record T, L(T) and H(T) every frameRate; the rows of all cases are written
+to one CSV table together with the wall time of each case.
+"""
+import argparse
+import ast
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import time
+
+import pandas as pd
+
+runtimeParameters = ["eta_v", "eta_u", "eta_p", "ifAV", "dt"]
+compileParameters = ["isCSL_elseMPM", "isMixedFormulation_elsePointwise", "isFBar"]
+
+
+def runCases(compileSettings, cases, simTime, numThreads):
+    # Worker process: one compiled substep() for all cases of a group
+    os.environ.setdefault("TI_ARCH", "arm64" if platform.machine() in ("arm64", "aarch64") else "x64")
+    os.environ["TI_CPU_MAX_NUM_THREADS"] = str(numThreads)
+    os.environ["DAMBREAK_SETTINGS"] = json.dumps({**json.loads(os.environ.get("DAMBREAK_SETTINGS", "{}")), **compileSettings}) # applied at import
+    import CSL_numericalExample_Telikicherla2024_damBreak as damBreak
+
+    fields = {name: getattr(damBreak, name) for name in damBreak.checkpointFields}
+    state0 = {name: field.to_numpy() for name, field in fields.items()}
+    t0 = time.perf_counter()
+    damBreak.substep(*damBreak.getSubstepArgs(damBreak.dt))
+    damBreak.substepLauncher.compile()
+    damBreak.ti.sync()
+    compileTime = time.perf_counter() - t0
+
+    rows = []
+    for case in cases:
+        for name, value in case.items():
+            setattr(damBreak, name, value)  # runtime parameters, read by getSubstepArgs()
+        for name, field in fields.items():
+            field.from_numpy(state0[name])
+        t0 = time.perf_counter()
+        timeTotal, count, frame = 0.0, 0, 0
+        series = []
+        while True:
+            damBreak.computeDiagnostics()
+            diag = dict(zip(damBreak.diagnosticNames, damBreak.diagnostics.to_numpy()[0]))
+            series.append(damBreak.getWaterColumn(timeTotal, diag))
+            if timeTotal >= simTime:
+                break
+            timeTotal, count = damBreak.advanceFixed(timeTotal, count, int(damBreak.frameRate // damBreak.dt))
+            frame += 1
+        wallTime = time.perf_counter() - t0
+        for T, L, H in series:
+            rows.append({**compileSettings, **case, "T": T, "L(T)": L, "H(T)": H,
+                         "wall time [s]": wallTime, "substeps": count, "compile time [s]": compileTime})
+        print(f"{compileSettings} {case}: {count} substeps in {wallTime:.1f} s", flush=True)
+    return rows
+
+
+def parseGrid(assignments):
+    grid = {}
+    for assignment in assignments:
+        name, values = assignment.split("=", 1)
+        if name not in runtimeParameters + compileParameters:
+            raise ValueError(f"Cannot sweep {name}; choose from {runtimeParameters + compileParameters}")
+        grid[name] = [ast.literal_eval(v) for v in values.split(",")]
+    return grid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("grid", nargs="+", help="name=value1,value2,...")
+    parser.add_argument("--sim-time", type=float, default=0.1, help="[s] simulated time per case")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count()))
+    parser.add_argument("--out", default="sweep_damBreak_results.csv")
+    args = parser.parse_args()
+
+    grid = parseGrid(args.grid)
+    groups = {}
+    for values in itertools.product(*grid.values()):
+        setting = dict(zip(grid, values))
+        compileSettings = {k: v for k, v in setting.items() if k in compileParameters}
+        case = {k: v for k, v in setting.items() if k in runtimeParameters}
+        groups.setdefault(tuple(compileSettings.items()), []).append(case)
+
+    # Split groups into at most --workers tasks, larger groups into more tasks
+    numCases = sum(len(cases) for cases in groups.values())
+    tasks = []
+    for key, cases in groups.items():
+        numChunks = max(1, min(len(cases), round(args.workers * len(cases) / numCases)))
+        tasks += [(dict(key), cases[i::numChunks]) for i in range(numChunks)]
+    numThreads = max(1, os.cpu_count() // min(args.workers, len(tasks)))
+    print(f"{numCases} cases in {len(groups)} compile groups, {len(tasks)} tasks on {args.workers} workers")
+
+    rows = []
+    context = multiprocessing.get_context("spawn")  # a fresh Taichi runtime per worker
+    with context.Pool(args.workers, maxtasksperchild=1) as pool:  # and a fresh import of the dam-break per task
+        results = [pool.apply_async(runCases, (compileSettings, cases, args.sim_time, numThreads)) for compileSettings, cases in tasks]
+        for result in results:
+            rows += result.get()
+    pd.DataFrame(rows).to_csv(args.out, index=False)
+    print("Results written to", args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Runs of a small dam-break for the tests.
+
+Every run is its own process, since the dam-break fixes its field shapes at
+import (DAMBREAK_NP_X, DAMBREAK_NUM_CELL, ...) and compiles its switches into
+the kernels; the switches of a run are passed in DAMBREAK_SETTINGS. Runs on
+the CPU backend unless TI_ARCH is set.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+repoRoot = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, repoRoot) # the modules of the repository, for the tests that import them
+script = os.path.join(repoRoot, "CSL_numericalExample_Telikicherla2024_damBreak.py")
+smallCase = {"DAMBREAK_NP_X": "9", "DAMBREAK_NUM_CELL": "20"} # 162 particles on a 21 x 21 grid
+
+substepWorker = """
+import sys
+import numpy as np
+import CSL_numericalExample_Telikicherla2024_damBreak as damBreak
+args = damBreak.getSubstepArgs(damBreak.dt)
+for _ in range(int(sys.argv[2])):
+    damBreak.substep(*args)
+np.savez(sys.argv[1], **{name: getattr(damBreak, name).to_numpy() for name in sys.argv[3:]})
+"""
+
+
+def run(arguments, settings, cwd=repoRoot, check=True):
+    # `python *arguments` on the small dam-break with settings (name -> value) in DAMBREAK_SETTINGS
+    env = dict(os.environ, **smallCase, DAMBREAK_SETTINGS=json.dumps(settings))
+    env.setdefault("TI_ARCH", "arm64" if platform.machine() in ("arm64", "aarch64") else "x64")
+    result = subprocess.run([sys.executable] + [str(argument) for argument in arguments], env=env, cwd=cwd, capture_output=True, text=True)
+    if check:
+        assert result.returncode == 0, result.stderr[-3000:]
+    return result
+
+
+@pytest.fixture
+def runScript(tmp_path):
+    # Runs the dam-break script in directory (default tmp_path), where it writes its output
+    def runScript(settings, directory=tmp_path, check=True):
+        os.makedirs(directory, exist_ok=True)
+        return run([script], settings, cwd=directory, check=check)
+    return runScript
+
+
+@pytest.fixture(scope="module")
+def runSubsteps(tmp_path_factory):
+    # Imports the dam-break, advances it numSubsteps substeps of dt and returns the named fields
+    directory = tmp_path_factory.mktemp("substeps")
+    def runSubsteps(settings, numSubsteps, names):
+        path = directory / f"{len(os.listdir(directory))}.npz"
+        run(["-c", substepWorker, path, numSubsteps] + list(names), settings)
+        with np.load(path) as data:
+            return dict(data)
+    return runSubsteps
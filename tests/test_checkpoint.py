@@ -0,0 +1,41 @@
+"""A run resumed from its checkpoint (isResume) against the same run uninterrupted.
+
+Both write their frames as a time series (frameFormat = "series"), so the
+resumed container is also checked to continue where the checkpoint left it.
+"""
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from timeseries import TimeSeriesReader
+
+settings = {"dt": 1e-4, "frameRate": 2e-3, "consistencyChecks": "off", "frameFormat": "series", "particleOutput": ["Pressure", "Velocity Mag"]}
+endTime, checkpointTime = 5e-3, 3e-3 # 3 frames of 19 substeps (frameRate // dt), the run is interrupted after 2
+
+
+def output(directory, pattern):
+    return glob.glob(os.path.join(directory, pattern))[0]
+
+
+@pytest.fixture
+def runs(runScript, tmp_path):
+    runScript(dict(settings, simTime=endTime), tmp_path / "uninterrupted")
+    runScript(dict(settings, simTime=checkpointTime, checkpointInterval=1), tmp_path / "resumed")
+    stdout = runScript(dict(settings, simTime=endTime, checkpointInterval=1, isResume=True), tmp_path / "resumed").stdout
+    assert "Resumed from" in stdout
+    return tmp_path / "uninterrupted", tmp_path / "resumed"
+
+
+def test_resume(runs):
+    uninterrupted, resumed = runs
+    for pattern in ["water_column_*_data.csv", "diagnostics_*_data.csv"]:
+        pd.testing.assert_frame_equal(pd.read_csv(output(resumed, pattern)), pd.read_csv(output(uninterrupted, pattern)), check_exact=True)
+    reference, series = [TimeSeriesReader(output(directory, "vtk_*/frames.idx")[:-len(".idx")]) for directory in runs]
+    assert series.frames == reference.frames == [0, 1, 2, 3] # initial state and 3 frames
+    pd.testing.assert_frame_equal(series.scalars(), reference.scalars(), check_exact=True)
+    for frame in reference.frames:
+        for name in reference.names(frame):
+            np.testing.assert_array_equal(series.read(frame, name), reference.read(frame, name))
@@ -0,0 +1,7 @@
+"""Settings replaced through DAMBREAK_SETTINGS."""
+
+
+def test_unknown_setting(runScript):
+    result = runScript({"isFbar": True}, check=False) # misspelt isFBar
+    assert result.returncode != 0
+    assert "unknown settings ['isFbar']" in result.stderr
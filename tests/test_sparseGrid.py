@@ -0,0 +1,22 @@
+"""The sparse grid (isSparseGrid) against the dense one, through the whole script."""
+import glob
+
+import pandas as pd
+
+settings = {"dt": 1e-4, "frameRate": 2e-3, "simTime": 3e-3, "consistencyChecks": "off"} # 2 frames of 19 substeps (frameRate // dt)
+
+
+def diagnostics(runScript, isSparseGrid):
+    stdout = runScript(dict(settings, isSparseGrid=isSparseGrid)).stdout
+    return stdout, pd.read_csv(glob.glob("diagnostics_*_data.csv")[0])
+
+
+def test_matches_dense(runScript, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    stdout, sparse = diagnostics(runScript, True)
+    assert "grid nodes" in stdout # memoryBudget() at start-up
+    assert len(sparse) == 3 # initial state and 2 frames
+    for path in glob.glob("*.csv"):
+        (tmp_path / path).unlink()
+    _, dense = diagnostics(runScript, False)
+    pd.testing.assert_frame_equal(sparse, dense, rtol=1e-10)
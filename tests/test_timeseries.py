@@ -0,0 +1,78 @@
+"""Round trip of frames through TimeSeriesWriter and TimeSeriesReader."""
+import os
+
+import numpy as np
+import pytest
+
+from timeseries import TimeSeriesReader, TimeSeriesWriter, writeVTK
+
+numFrames = 3
+
+
+def frameData(frame):
+    rng = np.random.default_rng(frame)
+    points = {"position": rng.random((50, 2)), "ID": np.arange(50, dtype=np.int32), "Pressure": rng.standard_normal(50)}
+    grid = {"Velocity": (rng.random((8, 8)), rng.random((8, 8)), np.zeros((8, 8))), "Mass": rng.random((8, 8))}
+    return points, grid, {"time": 0.01 * frame, "L(T)": 1 + frame}
+
+
+def writeFrames(path, frames, **kwargs):
+    writer = TimeSeriesWriter(str(path), attributes={"dx": 0.5}, **kwargs)
+    for frame in frames:
+        points, grid, scalars = frameData(frame)
+        writer.append(frame, points, grid, scalars)
+    writer.close()
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_round_trip(tmp_path, compression):
+    writeFrames(tmp_path / "frames", range(numFrames), compression=compression)
+    reader = TimeSeriesReader(str(tmp_path / "frames"))
+    assert reader.frames == list(range(numFrames))
+    assert reader.header["attributes"] == {"dx": 0.5}
+    for frame in reversed(reader.frames): # in any order
+        points, grid, scalars = frameData(frame)
+        for name, array in points.items():
+            assert reader.read(frame, name).dtype == array.dtype
+            np.testing.assert_array_equal(reader.read(frame, name), array)
+        np.testing.assert_array_equal(reader.read(frame, "Mass", "grid"), grid["Mass"])
+        velocity = reader.read(frame, "Velocity", "grid")
+        assert isinstance(velocity, tuple)
+        for component, expected in zip(velocity, grid["Velocity"]):
+            np.testing.assert_array_equal(component, expected)
+        assert reader.scalars().iloc[frame].to_dict() == {"frame": frame, **scalars}
+
+
+def test_downcast(tmp_path):
+    writeFrames(tmp_path / "frames", [0], downcast={"Pressure"})
+    reader = TimeSeriesReader(str(tmp_path / "frames"))
+    points, _, _ = frameData(0)
+    assert reader.read(0, "Pressure").dtype == np.float32
+    np.testing.assert_array_equal(reader.read(0, "Pressure"), points["Pressure"].astype(np.float32))
+    assert reader.read(0, "position").dtype == np.float64
+
+
+def test_torn_last_frame(tmp_path):
+    # A crash while writing the data of the last frame leaves its index line pointing past the end of the data
+    path = tmp_path / "frames"
+    writeFrames(path, range(numFrames), compression="zlib")
+    with open(str(path) + ".bin", "r+b") as data:
+        data.truncate(os.path.getsize(str(path) + ".bin") - 1)
+    assert TimeSeriesReader(str(path)).frames == list(range(numFrames - 1))
+
+
+def test_resume_drops_later_frames(tmp_path):
+    path = tmp_path / "frames"
+    writeFrames(path, range(numFrames), compression="zlib")
+    writeFrames(path, [1, 2], compression=None, startFrame=1) # resumed after frame 0, keeping the container's compression
+    reader = TimeSeriesReader(str(path))
+    assert reader.frames == [0, 1, 2]
+    assert reader.header["compression"] == "zlib"
+    for frame in reader.frames:
+        np.testing.assert_array_equal(reader.read(frame, "position"), frameData(frame)[0]["position"])
+
+
+def test_vtk(tmp_path):
+    writeFrames(tmp_path / "frames", range(numFrames))
+    writeVTK(TimeSeriesReader(str(tmp_path / "frames")), str(tmp_path / "vtk"), frames=[1])
+    assert sorted(os.listdir(tmp_path / "vtk")) == ["grid000001.vti", "points000001.vtu"]
@@ -0,0 +1,37 @@
+"""The closed-form and incremental volume updates (volumeUpdate) against the SVD of F.
+
+Every mode runs a small dam-break in its own process, since the mode is
+compiled into G2P (see conftest.py).
+"""
+import numpy as np
+import pytest
+
+numSubsteps, dt = 200, 1e-5 # long enough for the column to compress under gravity
+tolerance = 1e-10 # largest difference relative to the largest value of the field
+compared = ["detF", "volumet_p", "rho_p"]
+
+
+@pytest.fixture(scope="module")
+def states(runSubsteps):
+    return {mode: runSubsteps({"volumeUpdate": mode, "dt": dt}, numSubsteps, compared + ["Ft_p"]) for mode in ("svd", "det", "incremental")}
+
+
+def relativeDifference(a, b):
+    return np.max(np.abs(a - b)) / np.max(np.abs(b))
+
+
+@pytest.mark.parametrize("mode", ["det", "incremental"])
+@pytest.mark.parametrize("name", compared)
+def test_matches_svd(states, mode, name):
+    assert np.isfinite(states[mode][name]).all()
+    assert relativeDifference(states[mode][name], states["svd"][name]) < tolerance
+
+
+def test_deformed(states):
+    # The column has started to collapse, so the comparisons above are not between states at J = 1
+    assert np.max(np.abs(states["svd"]["detF"] - 1)) > 1e3 * tolerance
+
+
+def test_incremental_follows_detF(states):
+    J = states["incremental"]["detF"]
+    assert relativeDifference(J, np.linalg.det(states["incremental"]["Ft_p"])) < tolerance
@@ -0,0 +1,209 @@
+"""Append-only container for the output frames of a run, with random frame access.
+
+    python timeseries.py info vtk_damBreak_.../frames
+    python timeseries.py vtk vtk_damBreak_.../frames --frames 10:20 --out vtk_frames
+
+A container is two files: path.bin holds the arrays of every frame back to
+back, path.idx is a header line followed by one JSON line per frame with its
+scalars (time, T, L(T), H(T)) and the dtype, shape, offset and size of each
+point and grid array in path.bin. Reading a frame looks it up in the index and reads only
+its own bytes; uncompressed arrays are memory-mapped. The VTK files of
+selected frames are written on demand by the "vtk" command.
+"""
+import argparse
+import json
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+from pyevtk.hl import pointsToVTK, imageToVTK
+
+formatName, formatVersion = "damBreak-timeseries", 1
+compressions = (None, "zlib")
+kinds = ("points", "grid")
+
+
+def _shuffle(data):
+    # Byte planes of the array (all first bytes, then all second bytes, ...), which zlib compresses far better for floats
+    return np.ascontiguousarray(data).view(np.uint8).reshape(-1, data.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(raw, dtype, shape):
+    itemsize = np.dtype(dtype).itemsize
+    return np.frombuffer(raw, dtype=np.uint8).reshape(itemsize, -1).T.copy().view(dtype).reshape(shape)
+
+
+class TimeSeriesWriter:
+    """Appends frames of named arrays to path.bin and path.idx.
+
+    append() takes the point data (positions under "position") and grid
+    data of one frame; a grid quantity given as a tuple of components (as
+    gridVector returns) is stored stacked. compression "zlib" byte-shuffles
+    and deflates every array losslessly; downcast stores float64 arrays as
+    float32 (True: all of them, or a collection of names). attributes (e.g.
+    dx) go into the header. The index line of a frame is written after its
+    data is flushed, so a crash leaves at most a partial last frame, which
+    TimeSeriesReader ignores. Frames from startFrame on, e.g. those written
+    after the checkpoint a run resumes from, are dropped when the container is
+    opened; startFrame = 0 starts a new container.
+    """
+
+    def __init__(self, path, compression=None, downcast=False, attributes=None, level=1, startFrame=0):
+        if compression not in compressions:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {compressions}")
+        self.path, self.compression, self.downcast, self.level = path, compression, downcast, level
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        header = {"format": formatName, "version": formatVersion, "compression": compression, "attributes": attributes or {}}
+        lines, dataSize = [], 0
+        if startFrame > 0 and os.path.exists(path + ".idx"):
+            reader = TimeSeriesReader(path)
+            header = reader.header
+            lines = [json.dumps(entry) for entry in reader.entries if entry["frame"] < startFrame]
+            dataSize = max([_end(entry) for entry in reader.entries if entry["frame"] < startFrame], default=0)
+            self.compression = header["compression"] # keep the container's own
+        with open(path + ".bin", "ab") as data:
+            data.truncate(dataSize)
+        with open(path + ".idx", "w") as index:
+            index.write("\n".join([json.dumps(header)] + lines) + "\n")
+        self.data = open(path + ".bin", "ab")
+        self.index = open(path + ".idx", "a")
+
+    def _isDowncast(self, name, array):
+        return array.dtype == np.float64 and (self.downcast is True or (self.downcast and name in self.downcast))
+
+    def _write(self, name, array):
+        isTuple = isinstance(array, tuple)
+        array = np.stack(array) if isTuple else np.asarray(array)
+        if self._isDowncast(name, array):
+            array = array.astype(np.float32)
+        raw = _shuffle(array) if self.compression == "zlib" else np.ascontiguousarray(array).tobytes()
+        if self.compression == "zlib":
+            raw = zlib.compress(raw, self.level)
+        offset = self.data.tell()
+        self.data.write(raw)
+        return {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset, "size": len(raw), "tuple": isTuple}
+
+    def append(self, frame, points, grid=None, scalars=None):
+        entry = {"frame": int(frame), "scalars": {k: float(v) for k, v in (scalars or {}).items()},
+                 "points": {name: self._write(name, array) for name, array in points.items()},
+                 "grid": {name: self._write(name, array) for name, array in (grid or {}).items()}}
+        self.data.flush()
+        self.index.write(json.dumps(entry) + "\n")
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+def _end(entry):
+    return max([a["offset"] + a["size"] for kind in kinds for a in entry[kind].values()], default=0)
+
+
+class TimeSeriesReader:
+    """Random access to the frames of a container written by TimeSeriesWriter."""
+
+    def __init__(self, path):
+        self.path = path
+        dataSize = os.path.getsize(path + ".bin")
+        with open(path + ".idx") as index:
+            lines = index.read().split("\n")
+        self.header = json.loads(lines[0])
+        if self.header.get("format") != formatName or self.header.get("version") != formatVersion:
+            raise ValueError(f"{path}.idx is not a {formatName} v{formatVersion} container")
+        self.entries = []
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError: # empty or torn last line
+                break
+            if _end(entry) > dataSize: # index line of a frame whose data did not reach the disk
+                break
+            self.entries.append(entry)
+        self.byFrame = {entry["frame"]: entry for entry in self.entries}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def frames(self):
+        return [entry["frame"] for entry in self.entries]
+
+    def names(self, frame, kind="points"):
+        return list(self.byFrame[frame][kind])
+
+    def read(self, frame, name, kind="points"):
+        # Point or grid array name of frame (read-only memory map when stored uncompressed; a tuple for stacked grid vectors)
+        a = self.byFrame[frame][kind][name]
+        dtype, shape = np.dtype(a["dtype"]), tuple(a["shape"])
+        if self.header["compression"] == "zlib":
+            with open(self.path + ".bin", "rb") as data:
+                data.seek(a["offset"])
+                array = _unshuffle(zlib.decompress(data.read(a["size"])), dtype, shape)
+        else:
+            array = np.memmap(self.path + ".bin", dtype=dtype, mode="r", offset=a["offset"], shape=shape)
+        return tuple(array) if a["tuple"] else array
+
+    def scalars(self):
+        # One row of scalars (time, T, L(T), H(T), ...) per frame
+        return pd.DataFrame([{"frame": entry["frame"], **entry["scalars"]} for entry in self.entries])
+
+
+def writeVTK(reader, directory, frames=None):
+    # points<frame>.vtu (and grid<frame>.vti) of the frames, as the solver writes them with frameFormat = "vtk"
+    os.makedirs(directory, exist_ok=True)
+    spacing = reader.header["attributes"].get("dx", 1.0)
+    for frame in reader.frames if frames is None else frames:
+        position = np.asarray(reader.read(frame, "position"), dtype=np.float64)
+        z = position[:, 2] if position.shape[1] == 3 else np.zeros(len(position))
+        pointData = {name: np.ascontiguousarray(reader.read(frame, name)) for name in reader.names(frame) if name != "position"}
+        pointsToVTK(os.path.join(directory, f"points{frame:06d}"), np.ascontiguousarray(position[:, 0]), np.ascontiguousarray(position[:, 1]),
+                    np.ascontiguousarray(z), data=pointData)
+        gridNames = reader.names(frame, "grid")
+        if gridNames:
+            def toImage(a): # 2D grids as (num_g, num_g, 1)
+                return np.ascontiguousarray(a[..., None] if a.ndim == 2 else a)
+            gridData = {}
+            for name in gridNames:
+                data = reader.read(frame, name, "grid")
+                gridData[name] = tuple(toImage(np.asarray(c)) for c in data) if isinstance(data, tuple) else toImage(np.asarray(data))
+            imageToVTK(os.path.join(directory, f"grid{frame:06d}"), origin=(0.0, 0.0, 0.0), spacing=(spacing,) * 3, pointData=gridData)
+
+
+def parseFrames(text, frames):
+    # "a:b" (Python slice of the stored frame numbers) or "3,7,9"
+    if text is None:
+        return frames
+    if ":" in text:
+        start, stop = [int(v) if v else None for v in text.split(":")[:2]]
+        return [frame for frame in frames if (start is None or frame >= start) and (stop is None or frame < stop)]
+    return [int(v) for v in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["info", "vtk"])
+    parser.add_argument("path", help="container path without the .bin/.idx suffix")
+    parser.add_argument("--frames", help="frames to convert, e.g. 10:20 or 3,7,9 (default: all)")
+    parser.add_argument("--out", help="directory of the VTK files (default: next to the container)")
+    args = parser.parse_args()
+
+    reader = TimeSeriesReader(args.path)
+    if args.command == "info":
+        sizes = os.path.getsize(args.path + ".bin")
+        print(f"{len(reader)} frames, {sizes / 2**20:.1f} MiB, compression {reader.header['compression']}")
+        if len(reader):
+            for kind in kinds:
+                for name, a in reader.entries[0][kind].items():
+                    print(f"  {kind:>6s} {name:>20s} {a['dtype']:>4s} {tuple(a['shape'])}")
+            print(reader.scalars().to_string(index=False))
+    else:
+        directory = args.out or os.path.dirname(os.path.abspath(args.path))
+        frames = parseFrames(args.frames, reader.frames)
+        writeVTK(reader, directory, frames)
+        print(f"{len(frames)} frames written to {directory}")
+
+
+if __name__ == "__main__":
+    main()